@@ -0,0 +1,148 @@
+# coding=utf-8
+"""
+This script is used to benchmark the training (or prediction) steps of the kCON
+model with different XLA JIT modes. The batches are read from the dataset by
+`kcnn_from_dataset` just like `train.py`, so `benchmark_pipeline.py` should be
+used first to make sure the input pipeline is not the bottleneck.
+
+Each mode is benchmarked in a new process so that the XLA compilation caches
+and the thread pools of the modes are independent. The first `num_warmup_steps`
+steps, which include the XLA compilation, are timed separately. The speedups are
+relative to the first mode.
+
+Example:
+
+  python benchmark_model.py --dataset=qm7 --conv_sizes=128,64,32 \
+         --xla_jit_modes=none,global,scope --num_steps=200
+
+"""
+from __future__ import print_function, absolute_import
+
+import json
+import subprocess
+import sys
+import time
+import tensorflow as tf
+import kcnn
+from os.path import abspath
+from kcnn import kcnn_from_dataset, get_session_config
+
+__author__ = 'Xin Chen'
+__email__ = 'Bismarrck@me.com'
+
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('xla_jit_modes', 'none,global,scope',
+                           """Comma-separated XLA JIT modes to benchmark.""")
+tf.app.flags.DEFINE_integer('num_steps', 100,
+                            """The number of timed steps of each mode.""")
+tf.app.flags.DEFINE_integer('num_warmup_steps', 10,
+                            """The number of steps to run before timing.""")
+tf.app.flags.DEFINE_boolean('train_step', True,
+                            """Time the training steps (forward and backward)
+                            if True. Otherwise only the energies (and forces)
+                            are predicted.""")
+tf.app.flags.DEFINE_boolean('isolated', True,
+                            """Run each mode in a new process.""")
+tf.app.flags.DEFINE_string('output', None,
+                           """Save the results to this json file.""")
+
+
+def run_once(xla_jit):
+  """
+  Benchmark the model steps with the given XLA JIT mode.
+
+  Args:
+    xla_jit: a `str` as the XLA JIT mode: 'none', 'global' or 'scope'.
+
+  Returns:
+    result: a `dict` of the mode and the measured metrics.
+
+  """
+  FLAGS.xla_jit = xla_jit
+
+  with tf.Graph().as_default():
+    global_step = tf.contrib.framework.get_or_create_global_step()
+    y_calc, y_true, y_weights, f_calc, f_true, _ = kcnn_from_dataset(
+      FLAGS.dataset, for_training=True)
+    y_calc.set_shape(y_true.get_shape().as_list())
+    y_true = tf.cast(y_true, tf.float32)
+
+    if not FLAGS.train_step:
+      op = [y_calc, f_calc] if FLAGS.forces else y_calc
+    elif FLAGS.forces:
+      total_loss, _, _ = kcnn.get_yf_joint_loss(
+        y_true, y_calc, tf.cast(f_true, tf.float32), f_calc)
+      op = kcnn.get_joint_loss_train_op(total_loss, global_step)
+    else:
+      total_loss = kcnn.get_y_loss(y_true, y_calc, y_weights)
+      op = kcnn.get_joint_loss_train_op(total_loss, global_step)
+
+    with tf.Session(config=get_session_config()) as sess:
+      sess.run(tf.global_variables_initializer())
+
+      tic = time.time()
+      for _ in range(FLAGS.num_warmup_steps):
+        sess.run(op)
+      warmup = time.time() - tic
+
+      tic = time.time()
+      for _ in range(FLAGS.num_steps):
+        sess.run(op)
+      elapsed = time.time() - tic
+
+  return {
+    "xla_jit": xla_jit,
+    "train_step": FLAGS.train_step,
+    "batch_size": FLAGS.batch_size,
+    "steps_per_sec": FLAGS.num_steps / elapsed,
+    "examples_per_sec": FLAGS.num_steps * FLAGS.batch_size / elapsed,
+    "warmup_sec": warmup,
+  }
+
+
+def run_isolated(xla_jit):
+  """
+  Run `run_once` in a new process with the same flags and return its result.
+  """
+  excluded = ("--xla_jit_modes", "--isolated", "--output")
+  args = [sys.executable, abspath(__file__)]
+  args += [arg for arg in sys.argv[1:] if not arg.startswith(excluded)]
+  args += ["--xla_jit_modes={}".format(xla_jit), "--isolated=False"]
+  output = subprocess.check_output(args).decode()
+  return json.loads(output.strip().splitlines()[-1])
+
+
+def main(_):
+  """
+  The main function.
+  """
+  modes = [x.strip() for x in FLAGS.xla_jit_modes.split(",") if x.strip()]
+
+  # A single mode in a child process: print the result as json.
+  if not FLAGS.isolated and len(modes) == 1:
+    print(json.dumps(run_once(modes[0])))
+    return
+
+  results = []
+  print("{:>8s} {:>10s} {:>12s} {:>10s} {:>8s}".format(
+    "xla_jit", "steps/s", "examples/s", "warmup(s)", "speedup"))
+  for mode in modes:
+    if FLAGS.isolated:
+      result = run_isolated(mode)
+    else:
+      result = run_once(mode)
+    results.append(result)
+    print("{:>8s} {:>10.2f} {:>12.1f} {:>10.2f} {:>8.2f}".format(
+      result["xla_jit"], result["steps_per_sec"], result["examples_per_sec"],
+      result["warmup_sec"],
+      result["steps_per_sec"] / results[0]["steps_per_sec"]))
+
+  if FLAGS.output:
+    with open(FLAGS.output, "w+") as fp:
+      json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+  tf.app.run(main=main)
@@ -0,0 +1,265 @@
+# coding=utf-8
+"""
+This script is used to benchmark the input pipeline alone. No model will be
+built so the measured throughput is the upper bound of the training speed and
+can be directly compared with the examples/sec logged by `RunHook`.
+
+Each combination of the batch size, the number of parallel calls, the shuffle
+buffer size, the cache option and the tfrecords compression is benchmarked in
+a new process so that the peak memory usages are independent.
+
+Example:
+
+  python benchmark_pipeline.py --dataset=qm7 --batch_sizes=25,50,100 \
+         --num_parallel_calls_list=0,4 --cache_options=false,true \
+         --compressions=none,gzip
+
+"""
+from __future__ import print_function, absolute_import
+
+import json
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+import pipeline
+from itertools import product
+from os.path import isfile, abspath
+from store import get_forces_filename, get_term_filename
+
+__author__ = 'Xin Chen'
+__email__ = 'Bismarrck@me.com'
+
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_integer('num_batches', 200,
+                            """The number of batches to fetch for each
+                            combination.""")
+tf.app.flags.DEFINE_boolean('for_training', True,
+                            """Benchmark the training set if True. Otherwise
+                            the validation set will be used.""")
+tf.app.flags.DEFINE_string('batch_sizes', '50',
+                           """Comma-separated batch sizes.""")
+tf.app.flags.DEFINE_string('num_parallel_calls_list', '0',
+                           """Comma-separated numbers of parallel calls. 0
+                           means AUTOTUNE.""")
+tf.app.flags.DEFINE_string('shuffle_buffer_sizes', '1000',
+                           """Comma-separated shuffle buffer sizes. 0 disables
+                           shuffling.""")
+tf.app.flags.DEFINE_string('cache_options', 'false',
+                           """Comma-separated cache options: true or false.""")
+tf.app.flags.DEFINE_string('compressions', 'none',
+                           """Comma-separated tfrecords compressions: none,
+                           gzip or zlib.""")
+tf.app.flags.DEFINE_boolean('isolated', True,
+                            """Run each combination in a new process. If False,
+                            the reported peak memory is the peak of this
+                            process so far.""")
+tf.app.flags.DEFINE_string('output', None,
+                           """Save the results to this json file.""")
+
+
+def _split(value, dtype=int):
+  """
+  Split a comma-separated string.
+  """
+  return [dtype(x.strip()) for x in value.split(",") if x.strip()]
+
+
+def _str_to_bool(value):
+  """
+  Convert a string to a `bool`.
+  """
+  return value.lower() in ("true", "1", "yes")
+
+
+def get_compressed_dataset(dataset_name, for_training, compression):
+  """
+  Return the name of a compressed copy of the dataset. The copy will be created
+  if it does not exist.
+
+  Args:
+    dataset_name: a `str` as the name of the dataset.
+    for_training: a `bool` selecting between the training (True) and validation
+      (False) data.
+    compression: a `str` as the compression type: 'gzip' or 'zlib'.
+
+  Returns:
+    name: a `str` as the name of the compressed dataset.
+
+  """
+  if compression.lower() == "none":
+    return dataset_name
+
+  name = "{}.{}".format(dataset_name, compression.lower())
+  tfrecords_file, _ = pipeline.get_filenames(
+    train=for_training, dataset_name=dataset_name)
+  configs = pipeline.get_configs(
+    for_training=for_training, dataset_name=dataset_name)
+  new_tfrecords_file, new_json_file = pipeline.get_filenames(
+    train=for_training, dataset_name=name)
+  if isfile(new_json_file):
+    return name
+
+  compression_type = getattr(
+    tf.python_io.TFRecordCompressionType, compression.upper())
+  options = tf.python_io.TFRecordOptions(compression_type)
+
+  def _copy(filenames, new_filename):
+    with tf.python_io.TFRecordWriter(new_filename, options) as writer:
+      for filename in filenames:
+        for record in tf.python_io.tf_record_iterator(filename):
+          writer.write(record)
+
+  filenames = pipeline.get_shard_filenames(tfrecords_file, configs)
+  _copy(filenames, new_tfrecords_file)
+  if configs.get("columnar", False):
+    for i in range(len(configs["split_dims"])):
+      _copy([get_term_filename(x, i) for x in filenames],
+            get_term_filename(new_tfrecords_file, i))
+  forces_filenames = pipeline.get_forces_shard_filenames(
+    tfrecords_file, configs)
+  if forces_filenames is not None:
+    _copy(forces_filenames, get_forces_filename(new_tfrecords_file))
+    configs["forces_shards"] = []
+
+  # The compressed copy always has a single shard.
+  configs["shards"] = []
+  configs["compression"] = compression.upper()
+  with open(new_json_file, "w+") as fp:
+    json.dump(configs, fp, indent=2)
+  return name
+
+
+def run_once(batch_size, num_parallel_calls, shuffle_buffer_size, cache,
+             compression):
+  """
+  Benchmark the input pipeline with the given settings.
+
+  Args:
+    batch_size: an `int` as the batch size.
+    num_parallel_calls: an `int` as the number of parallel calls. 0 means
+      AUTOTUNE.
+    shuffle_buffer_size: an `int` as the shuffle buffer size. 0 disables
+      shuffling.
+    cache: a `bool` indicating whether the decoded examples should be cached.
+    compression: a `str` as the tfrecords compression.
+
+  Returns:
+    result: a `dict` of the settings and the measured metrics.
+
+  """
+  FLAGS.num_parallel_calls = num_parallel_calls
+  FLAGS.shuffle_buffer_size = max(shuffle_buffer_size, 1)
+  FLAGS.cache = cache
+  dataset_name = get_compressed_dataset(
+    FLAGS.dataset, FLAGS.for_training, compression)
+
+  with tf.Graph().as_default():
+    tic = time.time()
+    batch = pipeline.next_batch(dataset_name,
+                                for_training=FLAGS.for_training,
+                                batch_size=batch_size,
+                                num_epochs=None,
+                                shuffle=shuffle_buffer_size > 0)
+    with tf.Session() as sess:
+      values = sess.run(batch)
+      time_to_first_batch = time.time() - tic
+
+      num_examples = 0
+      num_bytes = 0
+      tic = time.time()
+      for _ in range(FLAGS.num_batches):
+        values = sess.run(batch)
+        num_examples += len(values[0])
+        num_bytes += sum(np.asarray(value).nbytes for value in values)
+      elapsed = time.time() - tic
+
+  # `ru_maxrss` is in kilobytes on Linux.
+  peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+  return {
+    "batch_size": batch_size,
+    "num_parallel_calls": num_parallel_calls,
+    "shuffle_buffer_size": shuffle_buffer_size,
+    "cache": cache,
+    "compression": compression,
+    "examples_per_sec": num_examples / elapsed,
+    "mbytes_per_sec": num_bytes / elapsed / 1024.0 ** 2,
+    "time_to_first_batch": time_to_first_batch,
+    "peak_memory_mb": peak_memory,
+  }
+
+
+def run_isolated(batch_size, num_parallel_calls, shuffle_buffer_size, cache,
+                 compression):
+  """
+  Run `run_once` in a new process and return its result.
+  """
+  args = [
+    sys.executable, abspath(__file__),
+    "--dataset={}".format(FLAGS.dataset),
+    "--binary_dir={}".format(FLAGS.binary_dir),
+    "--forces={}".format(FLAGS.forces),
+    "--for_training={}".format(FLAGS.for_training),
+    "--num_batches={}".format(FLAGS.num_batches),
+    "--batch_sizes={}".format(batch_size),
+    "--num_parallel_calls_list={}".format(num_parallel_calls),
+    "--shuffle_buffer_sizes={}".format(shuffle_buffer_size),
+    "--cache_options={}".format(cache),
+    "--compressions={}".format(compression),
+    "--cache_budget_mb={}".format(FLAGS.cache_budget_mb),
+    "--isolated=False",
+  ]
+  if FLAGS.cache_dir:
+    args.append("--cache_dir={}".format(FLAGS.cache_dir))
+  output = subprocess.check_output(args).decode()
+  return json.loads(output.strip().splitlines()[-1])
+
+
+def main(_):
+  """
+  The main function.
+  """
+  combinations = list(product(_split(FLAGS.batch_sizes),
+                              _split(FLAGS.num_parallel_calls_list),
+                              _split(FLAGS.shuffle_buffer_sizes),
+                              _split(FLAGS.cache_options, _str_to_bool),
+                              _split(FLAGS.compressions, str)))
+
+  # A single combination in a child process: print the result as json.
+  if not FLAGS.isolated and len(combinations) == 1:
+    print(json.dumps(run_once(*combinations[0])))
+    return
+
+  results = []
+  print("{:>6s} {:>8s} {:>8s} {:>6s} {:>6s} {:>12s} {:>10s} {:>10s} "
+        "{:>10s}".format("batch", "parallel", "shuffle", "cache", "comp",
+                         "examples/s", "MB/s", "first(s)", "peak(MB)"))
+  for combination in combinations:
+    if FLAGS.isolated:
+      result = run_isolated(*combination)
+    else:
+      result = run_once(*combination)
+    results.append(result)
+    print("{:>6d} {:>8d} {:>8d} {:>6s} {:>6s} {:>12.1f} {:>10.2f} {:>10.3f} "
+          "{:>10.1f}".format(result["batch_size"],
+                             result["num_parallel_calls"],
+                             result["shuffle_buffer_size"],
+                             str(result["cache"]),
+                             result["compression"],
+                             result["examples_per_sec"],
+                             result["mbytes_per_sec"],
+                             result["time_to_first_batch"],
+                             result["peak_memory_mb"]))
+
+  if FLAGS.output:
+    with open(FLAGS.output, "w+") as fp:
+      json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+  tf.app.run(main=main)
@@ -1,7 +1,8 @@
 #!coding=utf-8
 """
-This module is used to build datasets. The dataset xyz files must be saved in
-dir '../datasets'.
+This module is used to build datasets. The dataset files must be saved in dir
+'../datasets'. Supported inputs are (compressed) xyz files, ASE trajectories
+('.traj'), ASE databases ('.db') and columnar stores ('.npz').
 """
 from __future__ import print_function, absolute_import
 
@@ -10,9 +11,10 @@ import tensorflow as tf
 import transformer
 import re
 from functools import partial
-from os.path import join, isfile
+from os.path import join, isfile, splitext
 from database import Database
-from pipeline import get_filenames
+from compression import resolve_compressed
+from pipeline import get_filenames, get_indexed_filenames
 
 __author__ = 'Xin Chen'
 __email__ = 'Bismarrck@me.com'
@@ -23,7 +25,8 @@ tf.app.flags.DEFINE_float('unit', None,
 tf.app.flags.DEFINE_boolean('periodic', False,
                             """The isomers are periodic structures.""")
 tf.app.flags.DEFINE_string('format', 'xyz',
-                           """The format of the xyz file.""")
+                           """The format of the xyz file: xyz, ase or 
+                           extxyz.""")
 tf.app.flags.DEFINE_integer('num_examples', None,
                             """The total number of examples to use.""")
 tf.app.flags.DEFINE_float('test_size', 0.2,
@@ -48,6 +51,38 @@ tf.app.flags.DEFINE_string('lr_algorithm', 'default',
                            one-body weights. Available: default, minimal.""")
 tf.app.flags.DEFINE_float('cutoff', None,
                           """Defines the cutoff, the unit is r(ab)/L(ab).""")
+tf.app.flags.DEFINE_integer('examples_per_shard', 1000,
+                            """The maximum number of examples per tfrecords 
+                            shard. Set this to 0 to write a single file.""")
+tf.app.flags.DEFINE_string('output_format', 'tfrecords',
+                           """The output format: tfrecords or npy. The npy 
+                           format saves contiguous arrays which are read by 
+                           memory maps.""")
+tf.app.flags.DEFINE_boolean('split_forces', True,
+                            """Save the force-path fields (coef, indexing and 
+                            forces) to separate tfrecords files so that 
+                            energy-only training skips them.""")
+tf.app.flags.DEFINE_boolean('columnar', False,
+                            """Save the features of each k-body term as a 
+                            separate npy array or tfrecords stream so that 
+                            training with a smaller `trainable_k_max` only reads 
+                            the active terms.""")
+tf.app.flags.DEFINE_boolean('indexed', False,
+                            """Transform all examples once into a single indexed 
+                            npy store. The train, test and fold views are then 
+                            selected at training time with `view_test_size`, 
+                            `num_folds` and `fold` without re-transforming.""")
+tf.app.flags.DEFINE_boolean('positions', False,
+                            """Save the atomic positions instead of the features 
+                            and the force-path auxiliary fields. The features 
+                            and the forces are then computed in the graph. Only 
+                            force datasets are supported.""")
+tf.app.flags.DEFINE_boolean('native', False,
+                            """Use the native mixed-k layout: the 2-body terms 
+                            are not padded with ghost atoms and each k-body 
+                            term is saved with its own width C(k, 2). This 
+                            only reduces the size of the datasets. Only 
+                            effective with `include_all_k` and k_max = 3.""")
 tf.app.flags.DEFINE_string('tag', None,
                            """Additional tag added to the dataset files: 
                            '{dataset}_{tag}-train/test.{tfrecords|json}'""")
@@ -55,8 +90,11 @@ tf.app.flags.DEFINE_string('tag', None,
 FLAGS = tf.app.flags.FLAGS
 
 
+# The extensions of the dataset files which can be ingested directly.
+_direct_exts = ('.traj', '.db', '.npz')
+
 # The regex pattern to filter tfrecords files.
-_file_patt = re.compile("(.*)-(train|test).tfrecords")
+_file_patt = re.compile("(.*)-(train|test|all).tfrecords")
 
 
 def exponentially_weighted_loss(x, x0=0.0, beta=1.0):
@@ -88,6 +126,29 @@ def _add_tag(filename, tag):
     return filename
 
 
+def find_dataset_file(dataset):
+  """
+  Find the input file of the dataset in '../datasets'. The (compressed) xyz
+  file has the highest priority, followed by the '.traj', '.db' and '.npz'
+  files.
+
+  Args:
+    dataset: a `str` as the name of the dataset.
+
+  Returns:
+    filename: a `str` as the input file of the dataset.
+
+  """
+  xyzfile = resolve_compressed(join("..", "datasets", "{}.xyz".format(dataset)))
+  if xyzfile is not None:
+    return xyzfile
+  for ext in _direct_exts:
+    filename = join("..", "datasets", "{}{}".format(dataset, ext))
+    if isfile(filename):
+      return filename
+  raise IOError("The dataset file of %s can not be accessed!" % dataset)
+
+
 def may_build_dataset(dataset=None, verbose=True):
   """
   Build the dataset if needed.
@@ -98,24 +159,28 @@ def may_build_dataset(dataset=None, verbose=True):
     dataset: a `str` as the name of the dataset.
 
   """
-  train_file, _ = get_filenames(train=True, dataset_name=dataset)
-  valid_file, _ = get_filenames(train=False, dataset_name=dataset)
+  if FLAGS.indexed:
+    train_file, _ = get_indexed_filenames(dataset_name=dataset)
+    valid_file = None
+  else:
+    train_file, _ = get_filenames(train=True, dataset_name=dataset)
+    valid_file, _ = get_filenames(train=False, dataset_name=dataset)
 
-  # Check if the xyz file is accessible.
-  xyzfile = join("..", "datasets", "{}.xyz".format(FLAGS.dataset))
-  if not isfile(xyzfile):
-    raise IOError("The dataset file %s can not be accessed!" % xyzfile)
+  # Find the input file. Trajectories, databases and columnar stores are
+  # streamed directly into the transformer without an intermediate xyz file.
+  filename = find_dataset_file(FLAGS.dataset)
+  is_xyz = splitext(filename)[1] not in _direct_exts
 
   # Add the tag if provided.
   if FLAGS.tag is not None:
     train_file = _add_tag(train_file, FLAGS.tag)
-    valid_file = _add_tag(valid_file, FLAGS.tag)
+    valid_file = valid_file and _add_tag(valid_file, FLAGS.tag)
 
   # Extract the xyz file and split it into two sets: a training set and a
   # testing set.
-  if FLAGS.forces and FLAGS.format != 'ase':
-    raise ValueError("Currently only ASE-generated xyz files are supported if "
-                     "forces training is enabled.")
+  if is_xyz and FLAGS.forces and FLAGS.format not in ('ase', 'extxyz'):
+    raise ValueError("Currently only ASE-generated or extended xyz files are "
+                     "supported if forces training is enabled.")
 
   # Set the unit to 1.0 when building LJ datasets.
   if FLAGS.lj:
@@ -123,12 +188,20 @@ def may_build_dataset(dataset=None, verbose=True):
   else:
     unit = FLAGS.unit
 
-  database = Database.from_xyz(xyzfile,
-                               num_examples=FLAGS.num_examples,
-                               verbose=verbose,
-                               xyz_format=FLAGS.format,
-                               unit_to_ev=unit)
-  database.split(test_size=min(max(FLAGS.test_size, 0.0), 1.0))
+  num_examples = FLAGS.num_examples
+  if filename.endswith('.db') and (num_examples or unit):
+    tf.logging.warning("`num_examples` and `unit` are ignored for ase "
+                       "databases.")
+    num_examples = None
+    unit = None
+
+  database = Database.from_file(filename,
+                                num_examples=num_examples,
+                                verbose=verbose,
+                                xyz_format=FLAGS.format,
+                                unit_to_ev=unit)
+  if not FLAGS.indexed:
+    database.split(test_size=min(max(FLAGS.test_size, 0.0), 1.0))
 
   # The maximum supported `k` is 5.
   k_max = min(5, FLAGS.k_max)
@@ -156,6 +229,7 @@ def may_build_dataset(dataset=None, verbose=True):
     atomic_forces=FLAGS.forces,
     lj=FLAGS.lj,
     cutoff=FLAGS.cutoff,
+    native=FLAGS.native,
   )
   clf.transform_and_save(
     database,
@@ -165,7 +239,13 @@ def may_build_dataset(dataset=None, verbose=True):
                      'factor': FLAGS.lr_scaling_factor,
                      'include_perturbations': True},
     verbose=True,
-    loss_fn=exp_rmse_fn
+    loss_fn=exp_rmse_fn,
+    examples_per_shard=FLAGS.examples_per_shard,
+    output_format=FLAGS.output_format,
+    split_forces=FLAGS.split_forces,
+    columnar=FLAGS.columnar,
+    indexed=FLAGS.indexed,
+    positions=FLAGS.positions
   )
 
 
@@ -173,9 +253,17 @@ def main(_):
   """
   The main function.
   """
-  if FLAGS.periodic and (FLAGS.format != 'ase'):
+  if FLAGS.output_format not in ('tfrecords', 'npy'):
+    raise ValueError(
+      "Unsupported output format: {}".format(FLAGS.output_format))
+  if FLAGS.indexed and FLAGS.output_format != 'npy':
+    raise ValueError("`indexed` requires `output_format=npy`.")
+  if FLAGS.positions and not FLAGS.forces:
+    raise ValueError("`positions` requires `forces`.")
+  is_xyz = splitext(find_dataset_file(FLAGS.dataset))[1] not in _direct_exts
+  if is_xyz and FLAGS.periodic and (FLAGS.format not in ('ase', 'extxyz')):
     tf.logging.error(
-      "The xyz format must be `ase` if `periodic` is True!")
+      "The xyz format must be `ase` or `extxyz` if `periodic` is True!")
   else:
     may_build_dataset(verbose=True)
 
@@ -22,16 +22,19 @@ class Kcnn(Calculator):
   default_parameters = {}
   nolabel = True
 
-  def __init__(self, graph_model_path):
+  def __init__(self, graph_model_path, specialize=False):
     """
     Initialization method.
 
     Args:
       graph_model_path: a `str` as the model file to read.
+      specialize: a `bool`. If True, the structures will be evaluated by the
+        static-shape graphs specialized for their stoichiometries. This is
+        recommended for MD runs of a single molecule.
 
     """
     Calculator.__init__(self)
-    self._clf = KcnnPredictor(graph_model_path)
+    self._clf = KcnnPredictor(graph_model_path, specialize=specialize)
 
   def calculate(self, atoms=None, properties=('energy', 'atomic'), *args):
     """
@@ -0,0 +1,211 @@
+#!coding=utf-8
+"""
+This module provides transparent reading of compressed (gzip, bz2 and xz) text
+files. Decompression can be overlapped with parsing by running it on a
+background thread.
+
+Only the standard library is used here so that the scripts under '../scripts'
+can import this module as well.
+"""
+from __future__ import print_function, absolute_import
+
+import bz2
+import gzip
+import threading
+from os.path import isfile
+from queue import Queue, Empty, Full
+
+try:
+  import lzma
+except ImportError:
+  lzma = None
+
+__author__ = 'Xin Chen'
+__email__ = 'Bismarrck@me.com'
+
+
+"""
+The supported compression formats: extension -> (magic bytes, opener).
+"""
+_formats = {
+  ".gz": (b"\x1f\x8b", gzip.open),
+  ".bz2": (b"BZh", bz2.open),
+  ".xz": (b"\xfd7zXZ\x00", lzma.open if lzma else None),
+}
+
+# The sentinel put into the queue when the producer thread is finished.
+_EOF = None
+
+
+def strip_compression_ext(filename):
+  """
+  Remove the compression extension, e.g. '.gz', from the filename.
+  """
+  for ext in _formats:
+    if filename.endswith(ext):
+      return filename[:-len(ext)]
+  return filename
+
+
+def resolve_compressed(filename):
+  """
+  Return the first existing file among `filename` and its compressed versions
+  `filename.gz`, `filename.bz2` and `filename.xz`.
+
+  Args:
+    filename: a `str` as the uncompressed filename.
+
+  Returns:
+    filename: a `str` as the existing file or None.
+
+  """
+  for candidate in [filename] + [filename + ext for ext in _formats]:
+    if isfile(candidate):
+      return candidate
+  return None
+
+
+def _get_opener(filename):
+  """
+  Return the opener for the given file by checking its extension and then its
+  magic bytes. None will be returned if the file is not compressed.
+  """
+  for ext, (_, opener) in _formats.items():
+    if filename.endswith(ext):
+      break
+  else:
+    with open(filename, "rb") as fp:
+      head = fp.read(6)
+    for ext, (magic, opener) in _formats.items():
+      if head.startswith(magic):
+        break
+    else:
+      return None
+  if opener is None:
+    raise IOError("The `lzma` module is required to read {}!".format(filename))
+  return opener
+
+
+class ThreadedLineReader(object):
+  """
+  Iterate through the lines of a compressed text file while the decompression
+  is done by a background thread. `zlib`, `bz2` and `lzma` all release the GIL
+  so the decompression runs concurrently with the parsing.
+  """
+
+  def __init__(self, filename, opener, chunk_size=1 << 20, max_chunks=8,
+               encoding="utf-8"):
+    """
+    Initialization method.
+
+    Args:
+      filename: a `str` as the compressed file to read.
+      opener: a `Callable` to open the compressed file in binary mode.
+      chunk_size: an `int` as the number of decompressed bytes per chunk.
+      max_chunks: an `int` as the maximum number of decoded chunks buffered
+        in memory.
+      encoding: a `str` as the text encoding.
+
+    """
+    self._stream = opener(filename, "rb")
+    self._chunk_size = chunk_size
+    self._encoding = encoding
+    self._queue = Queue(maxsize=max_chunks)
+    self._stop = threading.Event()
+    self._error = None
+    self._thread = threading.Thread(target=self._produce)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _produce(self):
+    """
+    The target of the background thread. Decompress the file chunk by chunk and
+    put blocks of complete lines into the queue.
+    """
+    remainder = b""
+    try:
+      while not self._stop.is_set():
+        chunk = self._stream.read(self._chunk_size)
+        if not chunk:
+          break
+        chunk = remainder + chunk
+        pos = chunk.rfind(b"\n")
+        if pos < 0:
+          remainder = chunk
+          continue
+        remainder = chunk[pos + 1:]
+        self._put(chunk[:pos + 1].decode(self._encoding))
+      if remainder and not self._stop.is_set():
+        self._put(remainder.decode(self._encoding))
+    except Exception as excp:  # pylint: disable=broad-except
+      self._error = excp
+    finally:
+      self._put(_EOF)
+
+  def _put(self, block):
+    """
+    Put a block into the queue unless the reader has been closed.
+    """
+    while not self._stop.is_set():
+      try:
+        self._queue.put(block, timeout=0.1)
+        return
+      except Full:
+        continue
+
+  def __iter__(self):
+    """
+    Yield the decompressed lines.
+    """
+    while True:
+      block = self._queue.get()
+      if block is _EOF:
+        break
+      for line in block.splitlines(True):
+        yield line
+    if self._error is not None:
+      raise IOError(self._error)
+
+  def close(self):
+    """
+    Stop the background thread and close the underlying stream.
+    """
+    self._stop.set()
+    while True:
+      try:
+        self._queue.get_nowait()
+      except Empty:
+        break
+    self._thread.join()
+    self._stream.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+
+def open_text(filename, threaded=True, **kwargs):
+  """
+  Open a plain or compressed text file for reading lines.
+
+  Args:
+    filename: a `str` as the file to open. Compressed files are detected by the
+      extension ('.gz', '.bz2', '.xz') or the magic bytes.
+    threaded: a `bool`. If True, compressed files will be decompressed on a
+      background thread.
+    kwargs: additional key-value args for `ThreadedLineReader`.
+
+  Returns:
+    fp: a file-like object which supports iterating lines and the context
+      manager protocol.
+
+  """
+  opener = _get_opener(filename)
+  if opener is None:
+    return open(filename)
+  elif threaded:
+    return ThreadedLineReader(filename, opener, **kwargs)
+  else:
+    return opener(filename, "rt")
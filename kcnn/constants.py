@@ -70,7 +70,9 @@ class KcnnGraphKeys:
 
   * `ENERGY_VARIABLES`: variables that should be updated during energy training.
   * `FORCES_VARIABLES`: variables that should be updated during forces training.
+  * `INPUT_STATE`: saveable objects of the training input iterator.
 
   """
   ENERGY_VARIABLES = 'energy'
   FORCES_VARIABLES = 'forces'
+  INPUT_STATE = 'input_state'
@@ -9,13 +9,17 @@ import sys
 import time
 import json
 import numpy as np
+from multiprocessing import Pool, cpu_count
 from tensorflow.python.estimator.model_fn import ModeKeys
 from ase.atoms import Atom, Atoms
+from ase.data import chemical_symbols
 from ase.db import connect
+from ase.io.trajectory import Trajectory
 from ase.calculators.calculator import Calculator
 from os.path import splitext, isfile
 from os import remove
 from constants import hartree_to_ev, SEED
+from compression import open_text, strip_compression_ext
 from collections import namedtuple, Counter
 from sklearn.model_selection import train_test_split
 
@@ -49,6 +53,18 @@ _ase_xyz = XyzFormat(
   parse_forces=True
 )
 
+"""
+The general extended xyz format. The column layout is determined by the
+`Properties` key of each header line so no fixed regex is used.
+"""
+_extxyz = XyzFormat(
+  name="extxyz",
+  energy_patt=None,
+  string_patt=None,
+  default_unit=1.0,
+  parse_forces=True
+)
+
 """
 The most simple xyz format.
 """
@@ -61,6 +77,62 @@ _xyz = XyzFormat(
 )
 
 
+# The regex pattern to extract key=value pairs from the extended xyz header.
+_extxyz_kv_patt = re.compile(r"(\w+)\s*=\s*(\"[^\"]*\"|'[^']*'|\S+)")
+
+
+def _parse_extxyz_header(line):
+  """
+  Parse the comment line of an extended xyz frame.
+
+  Args:
+    line: a `str` as the second line of a frame.
+
+  Returns:
+    header: a `dict` of the key-value pairs. Quotes are removed from values.
+
+  """
+  return {key: value.strip("\"'")
+          for key, value in _extxyz_kv_patt.findall(line)}
+
+
+def _parse_extxyz_properties(properties):
+  """
+  Parse the `Properties` string, e.g. 'species:S:1:pos:R:3:forces:R:3', to the
+  column slices of each property.
+
+  Args:
+    properties: a `str` as the value of the `Properties` key.
+
+  Returns:
+    columns: a `Dict[str, slice]` as the columns of each property.
+
+  """
+  fields = properties.split(":")
+  if len(fields) % 3 != 0:
+    raise ValueError("Invalid Properties: {}".format(properties))
+  columns = {}
+  start = 0
+  for i in range(0, len(fields), 3):
+    name, ncols = fields[i], int(fields[i + 2])
+    columns[name] = slice(start, start + ncols)
+    start += ncols
+  return columns
+
+
+def _get_extxyz_energy(header):
+  """
+  Return the energy from the parsed extended xyz header.
+  """
+  for key in ("energy", "Energy", "free_energy", "total_energy"):
+    if key in header:
+      return float(header[key])
+  for key, value in header.items():
+    if key.lower() == "energy":
+      return float(value)
+  raise ValueError("The energy is not found in the extxyz header!")
+
+
 def _load_auxiliary_dict(dbfile):
   """
 
@@ -91,6 +163,277 @@ def _save_auxiliary_dict(dbfile, auxdict):
     json.dump(auxdict, fp, indent=2)
 
 
+def get_chemical_formula(symbols):
+  """
+  Return the reduced chemical formula, e.g. 'C2H6O1', of the given symbols.
+  """
+  return "".join(["{}{}".format(symbol, n)
+                  for symbol, n in sorted(Counter(symbols).items())])
+
+
+class DatabaseStatistics(object):
+  """
+  The incrementally maintained statistics of a database: the energy range, the
+  maximum occurances of each type of atom, the distribution of the sizes of the
+  structures and the number of structures of each chemical formula.
+  """
+
+  def __init__(self):
+    """
+    Initialization method.
+    """
+    self.num_examples = 0
+    self.y_min = np.inf
+    self.y_max = -np.inf
+    self.max_occurs = Counter()
+    self.natoms_counter = Counter()
+    self.formula_counter = Counter()
+
+  def add(self, symbols, energy):
+    """
+    Update the statistics with a new structure.
+
+    Args:
+      symbols: a `List[str]` as the chemical symbols of the structure.
+      energy: a `float` as the total energy of the structure.
+
+    """
+    counter = Counter(symbols)
+    for symbol, n in counter.items():
+      self.max_occurs[symbol] = max(self.max_occurs[symbol], n)
+    self.natoms_counter[len(symbols)] += 1
+    self.formula_counter[get_chemical_formula(symbols)] += 1
+    if energy is not None:
+      self.y_min = min(self.y_min, energy)
+      self.y_max = max(self.y_max, energy)
+    self.num_examples += 1
+
+  def merge(self, other):
+    """
+    Merge the statistics of another (disjoint) part of the same database.
+
+    Args:
+      other: a `DatabaseStatistics`.
+
+    """
+    for symbol, n in other.max_occurs.items():
+      self.max_occurs[symbol] = max(self.max_occurs[symbol], n)
+    self.natoms_counter.update(other.natoms_counter)
+    self.formula_counter.update(other.formula_counter)
+    self.y_min = min(self.y_min, other.y_min)
+    self.y_max = max(self.y_max, other.y_max)
+    self.num_examples += other.num_examples
+
+  def as_dict(self):
+    """
+    Return the JSON-serializable auxiliary dict of the statistics.
+    """
+    return {
+      "num_examples": self.num_examples,
+      "max_occurs": dict(self.max_occurs),
+      "y_range": [self.y_min, self.y_max],
+      "natoms_counter": dict(self.natoms_counter),
+      "formula_counter": dict(self.formula_counter),
+    }
+
+  @classmethod
+  def from_dict(cls, auxdict):
+    """
+    Restore the statistics from an auxiliary dict.
+
+    Args:
+      auxdict: a `dict` created by `as_dict`.
+
+    Returns:
+      stats: a `DatabaseStatistics` or None if `auxdict` is incomplete.
+
+    """
+    keys = ("num_examples", "max_occurs", "y_range", "natoms_counter",
+            "formula_counter")
+    if not auxdict or any(key not in auxdict for key in keys):
+      return None
+    stats = cls()
+    stats.num_examples = int(auxdict["num_examples"])
+    stats.y_min, stats.y_max = auxdict["y_range"]
+    stats.max_occurs.update(auxdict["max_occurs"])
+    stats.natoms_counter.update(
+      {int(natoms): n for natoms, n in auxdict["natoms_counter"].items()})
+    stats.formula_counter.update(auxdict["formula_counter"])
+    return stats
+
+
+def _scan_statistics(args):
+  """
+  Compute the statistics of the rows `istart <= id < istop` of a database. This
+  function is executed by the worker processes of `Database.refresh_statistics`.
+
+  Args:
+    args: a tuple of (dbfile, istart, istop).
+
+  Returns:
+    stats: a `DatabaseStatistics`.
+
+  """
+  dbfile, istart, istop = args
+  stats = DatabaseStatistics()
+  db = connect(dbfile)
+  for row in db.select('id>={},id<{}'.format(istart, istop)):
+    stats.add(row.symbols, row.get('energy'))
+  return stats
+
+
+class StructureRecord(object):
+  """
+  A lightweight, array-backed representation of a single structure.
+
+  `ase.Atoms` carries a lot of per-object state (constraints, calculator, info
+  dict, ...) while the transformers only need the atomic numbers, positions,
+  cell and pbc. `StructureRecord` exposes the same accessors used by
+  `Transformer` and `MultiTransformer` (`get_chemical_symbols`,
+  `get_positions`, `get_cell`, `get_pbc`, `get_total_energy`, `get_forces`) so
+  it can be used wherever an `ase.Atoms` is accepted.
+  """
+
+  __slots__ = ("numbers", "positions", "cell", "pbc", "energy", "forces",
+               "_symbols")
+
+  def __init__(self, numbers, positions, cell=None, pbc=None, energy=None,
+               forces=None):
+    """
+    Initialization method.
+
+    Args:
+      numbers: an `int` array of shape `[N, ]` as the atomic numbers.
+      positions: a `float` array of shape `[N, 3]` as the atomic positions.
+      cell: a `float` array of shape `[3, 3]` as the unit cell. Defaults to
+        zeros.
+      pbc: a `bool` array of shape `[3, ]` as the periodic boundary
+        conditions. Defaults to all False.
+      energy: a `float` as the total energy or None.
+      forces: a `float` array of shape `[N, 3]` as the atomic forces or None.
+
+    """
+    self.numbers = np.asarray(numbers, dtype=int)
+    self.positions = np.asarray(positions, dtype=np.float64)
+    if cell is None:
+      self.cell = np.zeros((3, 3))
+    else:
+      self.cell = np.asarray(cell, dtype=np.float64)
+    if pbc is None:
+      self.pbc = np.zeros(3, dtype=bool)
+    else:
+      self.pbc = np.asarray(pbc, dtype=bool)
+    self.energy = energy
+    self.forces = forces
+    self._symbols = None
+
+  def __len__(self):
+    """
+    Return the number of atoms.
+    """
+    return len(self.numbers)
+
+  @classmethod
+  def from_row(cls, row):
+    """
+    Initialize a `StructureRecord` from a row of an `ase.db` database without
+    constructing the intermediate `ase.Atoms`.
+
+    Args:
+      row: an `ase.db.row.AtomsRow`.
+
+    Returns:
+      record: a `StructureRecord`.
+
+    """
+    return cls(numbers=row.numbers,
+               positions=row.positions,
+               cell=row.cell,
+               pbc=row.pbc,
+               energy=row.get('energy'),
+               forces=row.get('forces'))
+
+  @classmethod
+  def from_atoms(cls, atoms):
+    """
+    Initialize a `StructureRecord` from an `ase.Atoms` object.
+
+    Args:
+      atoms: an `ase.Atoms`.
+
+    Returns:
+      record: a `StructureRecord`.
+
+    """
+    if atoms.calc is not None:
+      energy = atoms.get_total_energy()
+      forces = atoms.get_forces()
+    else:
+      energy = None
+      forces = None
+    return cls(numbers=atoms.numbers,
+               positions=atoms.positions,
+               cell=atoms.cell,
+               pbc=atoms.pbc,
+               energy=energy,
+               forces=forces)
+
+  def get_chemical_symbols(self):
+    """
+    Return the chemical symbols. The list is cached after the first call.
+    """
+    if self._symbols is None:
+      self._symbols = [chemical_symbols[z] for z in self.numbers]
+    return self._symbols
+
+  def get_positions(self):
+    """
+    Return the atomic positions.
+    """
+    return self.positions
+
+  def get_cell(self):
+    """
+    Return the unit cell.
+    """
+    return self.cell
+
+  def get_pbc(self):
+    """
+    Return the periodic boundary conditions.
+    """
+    return self.pbc
+
+  def get_total_energy(self):
+    """
+    Return the total energy.
+    """
+    if self.energy is None:
+      raise ValueError("The energy of this record is not available!")
+    return self.energy
+
+  def get_forces(self):
+    """
+    Return the atomic forces.
+    """
+    if self.forces is None:
+      return np.zeros_like(self.positions)
+    return self.forces
+
+  def to_atoms(self):
+    """
+    Convert this record to an `ase.Atoms` with a `ProvidedCalculator`.
+    """
+    atoms = Atoms(numbers=self.numbers, positions=self.positions,
+                  cell=self.cell, pbc=self.pbc,
+                  calculator=ProvidedCalculator())
+    if self.energy is not None:
+      atoms.info['provided_energy'] = self.energy
+    if self.forces is not None:
+      atoms.info['provided_forces'] = self.forces
+    return atoms
+
+
 class ProvidedCalculator(Calculator):
   """
   A simple calculator which just returns the provided energy and forces.
@@ -134,7 +477,8 @@ def xyz_to_database(xyzfile, num_examples=None, xyz_format='xyz', verbose=True,
   Convert the xyz file to an `ase.db.core.Database`.
 
   Args:
-    xyzfile: a `str` as the file to parse.
+    xyzfile: a `str` as the file to parse. gzip, bz2 and xz compressed files
+      are decompressed on the fly.
     num_examples: a `int` as the maximum number of examples to parse. If None,
       all examples in the given file will be saved.
     xyz_format: a `str` representing the format of the given xyz file.
@@ -151,10 +495,13 @@ def xyz_to_database(xyzfile, num_examples=None, xyz_format='xyz', verbose=True,
   """
   if xyz_format.lower() == 'ase':
     formatter = _ase_xyz
+  elif xyz_format.lower() == 'extxyz':
+    formatter = _extxyz
   else:
     formatter = _xyz
+  extxyz = formatter.name == 'extxyz'
 
-  dbfile = "{}.db".format(splitext(xyzfile)[0])
+  dbfile = "{}.db".format(splitext(strip_compression_ext(xyzfile))[0])
   if isfile(dbfile):
     if restart:
       remove(dbfile)
@@ -169,17 +516,15 @@ def xyz_to_database(xyzfile, num_examples=None, xyz_format='xyz', verbose=True,
   natoms = 0
   stage = 0
   atoms = None
+  columns = None
   num_examples = num_examples or 0
-  natoms_counter = Counter()
-  y_min = np.inf
-  y_max = -np.inf
-  max_occurs = Counter()
+  stats = DatabaseStatistics()
 
   database = connect(name=dbfile)
   tic = time.time()
   if verbose:
     sys.stdout.write("Extract cartesian coordinates ...\n")
-  with open(xyzfile) as f:
+  with open_text(xyzfile) as f:
     for line in f:
       if num_examples and count == num_examples:
         break
@@ -192,14 +537,27 @@ def xyz_to_database(xyzfile, num_examples=None, xyz_format='xyz', verbose=True,
           atoms = Atoms(calculator=ProvidedCalculator())
           if parse_forces:
             atoms.info['provided_forces'] = np.zeros((natoms, 3))
-          natoms_counter[natoms] += 1
           stage += 1
       elif stage == 1:
+        if extxyz:
+          # The header is parsed only once per frame. The column layout of the
+          # following atom lines is determined by `Properties`.
+          header = _parse_extxyz_header(line)
+          columns = _parse_extxyz_properties(
+            header.get("Properties", "species:S:1:pos:R:3"))
+          energy = _get_extxyz_energy(header) * unit
+          if "Lattice" in header:
+            atoms.set_cell(
+              np.reshape([float(x) for x in header["Lattice"].split()], (3, 3)))
+            atoms.set_pbc(True)
+          if "pbc" in header:
+            atoms.set_pbc([x in ("T", "True") for x in header["pbc"].split()])
+          atoms.info['provided_energy'] = energy
+          stage += 1
+          continue
         m = formatter.energy_patt.search(line)
         if m:
-          if xyz_format.lower() == 'extxyz':
-            energy = float(m.group(3)) * unit
-          elif xyz_format.lower() == 'ase':
+          if xyz_format.lower() == 'ase':
             energy = float(m.group(2)) * unit
             atoms.set_cell(
               np.reshape([float(x) for x in m.group(1).split()], (3, 3)))
@@ -208,41 +566,47 @@ def xyz_to_database(xyzfile, num_examples=None, xyz_format='xyz', verbose=True,
           else:
             energy = float(m.group(1)) * unit
           atoms.info['provided_energy'] = energy
-          y_min = min(y_min, energy)
-          y_max = max(y_max, energy)
           stage += 1
       elif stage == 2:
-        m = formatter.string_patt.search(line)
-        if m:
+        if extxyz:
+          values = line.split()
+          if "species" in columns:
+            atom = Atom(symbol=values[columns["species"]][0])
+          else:
+            atom = Atom(int(values[columns["Z"]][0]))
+          atom.position = [float(v) for v in values[columns["pos"]]]
+          atoms.append(atom)
+          if "forces" in columns:
+            atoms.info['provided_forces'][ai, :] = [
+              float(v) * unit for v in values[columns["forces"]]]
+        else:
+          m = formatter.string_patt.search(line)
+          if not m:
+            continue
           atoms.append(Atom(symbol=m.group(1),
                             position=[float(v) for v in m.groups()[1:4]]))
           if parse_forces:
             atoms.info['provided_forces'][ai, :] = [float(v) * unit
                                                     for v in m.groups()[4:7]]
-          ai += 1
-          if ai == natoms:
-            atoms.calc.calculate()
-            database.write(atoms)
-            counter = Counter(atoms.get_chemical_symbols())
-            for symbol, n in counter.items():
-              max_occurs[symbol] = max(max_occurs[symbol], n)
-            ai = 0
-            stage = 0
-            count += 1
-            if verbose and count % 1000 == 0:
-              sys.stdout.write(
-                "\rProgress: {:7d}  /  {:7d} | Speed = {:.1f}".format(
-                  count, num_examples, count / (time.time() - tic)))
+        ai += 1
+        if ai == natoms:
+          atoms.calc.calculate()
+          database.write(atoms)
+          stats.add(atoms.get_chemical_symbols(),
+                    atoms.info['provided_energy'])
+          ai = 0
+          stage = 0
+          count += 1
+          if verbose and count % 1000 == 0:
+            sys.stdout.write(
+              "\rProgress: {:7d}  /  {:7d} | Speed = {:.1f}".format(
+                count, num_examples, count / (time.time() - tic)))
     if verbose:
       print("")
       print("Total time: %.3f s\n" % (time.time() - tic))
 
     # Dump the auxiliary dict.
-    auxdict = {
-      "max_occurs": dict(max_occurs),
-      "y_range": [y_min, y_max],
-      "natoms_counter": dict(natoms_counter)
-    }
+    auxdict = stats.as_dict()
     _save_auxiliary_dict(dbfile, auxdict)
 
     return database, auxdict
@@ -263,9 +627,8 @@ class Database:
 
     """
     self._database = db
-    self._energy_range = None
-    self._max_occurs = None
-    self._natoms_counter = None
+    self._stats = DatabaseStatistics.from_dict(auxiliary)
+    self._stats_checked = False
     self._auxiliary = auxiliary
     self._splitted = False
     self._id_list = {
@@ -353,60 +716,124 @@ class Database:
     """
     return self._id_list[ModeKeys.EVAL]
 
+  @property
+  def statistics(self):
+    """
+    Return the `DatabaseStatistics` of this database. The loaded statistics are
+    only compared with the size of the database on the first access because
+    `write` keeps them up to date.
+    """
+    if self._stats is None or (not self._stats_checked and
+                                self._stats.num_examples != len(self)):
+      self.refresh_statistics()
+    self._stats_checked = True
+    return self._stats
+
   @property
   def energy_range(self):
     """
     Return the energy range of this database.
     """
-    if not self._energy_range:
-      self._go_through()
-    return self._energy_range
+    stats = self.statistics
+    return stats.y_min, stats.y_max
 
   @property
   def max_occurs(self):
     """
     Return the maximum occur of each type of atom.
     """
-    if not self._max_occurs:
-      self._go_through()
-    return self._max_occurs
+    return dict(self.statistics.max_occurs)
+
+  @property
+  def formula_counter(self):
+    """
+    Return the number of structures of each chemical formula.
+    """
+    return dict(self.statistics.formula_counter)
 
   def get_atoms_size_distribution(self):
     """
     Return the distribution of the sizes of the `ase.Atoms` structures.
     """
-    if self._natoms_counter is None:
-      self._go_through()
-    return self._natoms_counter
-
-  def _go_through(self):
-    """
-    Go through all records of this database to determine the energy range,
-    max occurs of the chemical symbols and the distribution of the sizes of
-    the `ase.Atoms` structures.
-    """
-    try:
-      self._max_occurs = self._auxiliary['max_occurs']
-      self._energy_range = self._auxiliary['y_range']
-      self._natoms_counter = {}
-      for natoms, n in self._auxiliary['natoms_counter'].items():
-        self._natoms_counter[int(natoms)] = n
-      assert len(self._max_occurs) > 0
-      assert len(self._energy_range) == 2
-    except Exception:
-      counter = Counter()
-      y_min = np.inf
-      y_max = -np.inf
-      max_occurs = {}
-      for row in self._database.select('id<={}'.format(len(self))):
-        y_min = min(row.energy, y_min)
-        y_max = max(row.energy, y_max)
-        for atom, n in Counter(row.symbols).items():
-          max_occurs[atom] = max(max_occurs.get(atom, 0), n)
-        counter[row.natoms] += 1
-      self._max_occurs = max_occurs
-      self._energy_range = (y_min, y_max)
-      self._natoms_counter = counter
+    return dict(self.statistics.natoms_counter)
+
+  def save_statistics(self):
+    """
+    Persist the statistics to the auxiliary file of this database.
+    """
+    filename = getattr(self._database, 'filename', None)
+    if filename is None or self._stats is None:
+      return
+    self._auxiliary = self._stats.as_dict()
+    _save_auxiliary_dict(filename, self._auxiliary)
+
+  def refresh_statistics(self, num_workers=None, chunk_size=100000):
+    """
+    Go through all records of this database to re-compute the statistics. The
+    rows are scanned in parallel by chunks and the partial results are merged.
+    The new statistics will be persisted.
+
+    Args:
+      num_workers: an `int` as the number of worker processes. Defaults to the
+        number of CPUs.
+      chunk_size: an `int` as the number of rows scanned by each task.
+
+    """
+    filename = getattr(self._database, 'filename', None)
+    stats = DatabaseStatistics()
+    if len(self) > 0:
+      # The ids may be not contiguous if some rows were deleted.
+      last_id = next(self._database.select(sort='-id', limit=1)).id
+    else:
+      last_id = 0
+    tasks = [(filename, istart, min(istart + chunk_size, last_id + 1))
+             for istart in range(1, last_id + 1, chunk_size)]
+    num_workers = min(num_workers or cpu_count(), len(tasks))
+
+    if filename is None or num_workers <= 1:
+      for row in self._database.select():
+        stats.add(row.symbols, row.get('energy'))
+    else:
+      pool = Pool(processes=num_workers)
+      try:
+        for partial_stats in pool.imap(_scan_statistics, tasks):
+          stats.merge(partial_stats)
+      finally:
+        pool.close()
+        pool.join()
+
+    self._stats = stats
+    self.save_statistics()
+
+  def write(self, atoms, persist=False, **key_value_pairs):
+    """
+    Write a structure to this database and update the statistics.
+
+    Args:
+      atoms: an `ase.Atoms` or a `StructureRecord` to write.
+      persist: a `bool` indicating whether the updated statistics should be
+        saved immediately. Defaults to False so that bulk writes do not rewrite
+        the auxiliary file every time. Call `save_statistics` at the end.
+      key_value_pairs: additional key-value pairs for this row.
+
+    Returns:
+      id: an `int` as the id of the new row.
+
+    """
+    if isinstance(atoms, StructureRecord):
+      record = atoms
+      atoms = record.to_atoms()
+      atoms.calc.calculate()
+    elif atoms.calc is not None:
+      record = StructureRecord.from_atoms(atoms)
+    else:
+      record = StructureRecord(atoms.numbers, atoms.positions)
+    stats = self.statistics
+    aid = self._database.write(atoms, **key_value_pairs)
+    stats.add(record.get_chemical_symbols(), record.energy)
+    if persist:
+      self.save_statistics()
+    return aid
 
   def split(self, test_size=0.2, random_state=None):
     """
@@ -430,6 +857,15 @@ class Database:
     self._id_list[ModeKeys.TRAIN] = ids_for_training
     self._id_list[ModeKeys.EVAL] = ids_for_testing
 
+  def _get_ids(self, mode):
+    """
+    Return the ids of the examples for the given mode.
+    """
+    ids = self._id_list.get(mode)
+    if ids is None:
+      ids = list(range(1, len(self) + 1))
+    return ids
+
   def examples(self, mode=ModeKeys.TRAIN):
     """
     A set-like object providing a view on `ase.Atoms` of this database.
@@ -441,10 +877,25 @@ class Database:
       atoms: an `ase.Atoms` object.
 
     """
-    defaults = list(range(1, len(self) + 1))
-    for aid in self._id_list.get(mode, defaults):
+    for aid in self._get_ids(mode):
       yield self.get_atoms(self._database.get(id=aid))
 
+  def records(self, mode=ModeKeys.TRAIN):
+    """
+    A set-like object providing a view on `StructureRecord` of this database.
+    This is much cheaper than `examples` because no `ase.Atoms` or calculator
+    will be created.
+
+    Args:
+      mode: the purpose of the examples to fetch.
+
+    Yields:
+      record: a `StructureRecord` object.
+
+    """
+    for aid in self._get_ids(mode):
+      yield StructureRecord.from_row(self._database.get(id=aid))
+
   @classmethod
   def from_xyz(cls, xyzfile, num_examples, xyz_format='xyz', verbose=True,
                unit_to_ev=None, restart=False):
@@ -489,3 +940,271 @@ class Database:
     """
     with connect(filename) as db:
       return cls(db, auxiliary=_load_auxiliary_dict(filename))
+
+  @classmethod
+  def from_file(cls, filename, num_examples=None, xyz_format='xyz',
+                verbose=True, unit_to_ev=None, restart=False):
+    """
+    Initialize a `Database` from a file. The file type is determined by its
+    extension:
+
+      * '.db': an `ase.db` database.
+      * '.traj': an ASE trajectory file.
+      * '.npz': a columnar store. See `ColumnarFrames`.
+      * others: a (compressed) xyz file.
+
+    Args:
+      filename: a `str` as the file to load.
+      num_examples: a `int` as the maximum number of examples to use.
+      xyz_format: a `str` representing the format of a xyz file.
+      verbose: a `bool` indicating whether we should log the parsing progress.
+      unit_to_ev: a `float` as the unit for converting energies to eV.
+      restart: a `bool`. If True, the database of a xyz file will be re-built
+        even if already existed.
+
+    Returns:
+      db: a `Database`.
+
+    """
+    ext = splitext(filename)[1].lower()
+    if ext == '.db':
+      if num_examples or unit_to_ev:
+        raise ValueError("`num_examples` and `unit_to_ev` are not supported "
+                         "for ase databases.")
+      return cls.from_db(filename)
+    elif ext == '.traj':
+      return FrameDatabase(Trajectory(filename, 'r'), filename=filename,
+                           num_examples=num_examples, unit_to_ev=unit_to_ev)
+    elif ext == '.npz':
+      return FrameDatabase(ColumnarFrames(filename), filename=filename,
+                           num_examples=num_examples, unit_to_ev=unit_to_ev)
+    else:
+      return cls.from_xyz(filename, num_examples, xyz_format=xyz_format,
+                          verbose=verbose, unit_to_ev=unit_to_ev,
+                          restart=restart)
+
+
+class ColumnarFrames(object):
+  """
+  A random-access sequence of `StructureRecord` backed by a columnar store.
+
+  The store is a `.npz` file with these arrays (M frames, T atoms in total):
+
+    * `natoms`: an `int` array of shape `[M, ]`.
+    * `numbers`: an `int` array of shape `[T, ]`.
+    * `positions`: a `float` array of shape `[T, 3]`.
+    * `energy`: a `float` array of shape `[M, ]`.
+    * `forces`: an optional `float` array of shape `[T, 3]`.
+    * `cell`: an optional `float` array of shape `[M, 3, 3]`.
+    * `pbc`: an optional `bool` array of shape `[M, 3]`.
+
+  """
+
+  def __init__(self, filename):
+    """
+    Initialization method.
+
+    Args:
+      filename: a `str` as the `.npz` file to load.
+
+    """
+    store = np.load(filename)
+    self._natoms = np.asarray(store['natoms'], dtype=int)
+    self._offsets = np.concatenate(([0], np.cumsum(self._natoms)))
+    self._numbers = store['numbers']
+    self._positions = store['positions']
+    self._energy = store['energy']
+    self._forces = store['forces'] if 'forces' in store else None
+    self._cell = store['cell'] if 'cell' in store else None
+    self._pbc = store['pbc'] if 'pbc' in store else None
+
+  def __len__(self):
+    """
+    Return the number of frames.
+    """
+    return len(self._natoms)
+
+  def __getitem__(self, index):
+    """
+    Return the `StructureRecord` of the frame at `index` (zero-based).
+    """
+    istart, istop = self._offsets[index], self._offsets[index + 1]
+    if self._forces is not None:
+      forces = self._forces[istart: istop]
+    else:
+      forces = None
+    return StructureRecord(
+      numbers=self._numbers[istart: istop],
+      positions=self._positions[istart: istop],
+      cell=self._cell[index] if self._cell is not None else None,
+      pbc=self._pbc[index] if self._pbc is not None else None,
+      energy=float(self._energy[index]),
+      forces=forces)
+
+
+class FrameDatabase(Database):
+  """
+  A `Database` backed by a random-access sequence of frames, e.g. an ASE
+  trajectory or a `ColumnarFrames`, so that frames can be streamed into the
+  transformers without writing an intermediate xyz or db file.
+  """
+
+  def __init__(self, frames, filename=None, num_examples=None,
+               unit_to_ev=None):
+    """
+    Initialization method.
+
+    Args:
+      frames: a sequence of `ase.Atoms` or `StructureRecord`. `len()` and
+        zero-based indexing must be supported.
+      filename: a `str` as the source file. If given, the statistics will be
+        persisted to '{filename}.aux'.
+      num_examples: an `int` as the maximum number of frames to use.
+      unit_to_ev: a `float` as the unit for converting energies and forces to
+        eV. Defaults to None so that no conversion will be applied.
+
+    """
+    self._frames = frames
+    self._filename = filename
+    self._unit = unit_to_ev
+    if num_examples:
+      self._size = min(len(frames), num_examples)
+    else:
+      self._size = len(frames)
+    if filename is not None:
+      auxiliary = _load_auxiliary_dict(filename)
+    else:
+      auxiliary = None
+    # The saved statistics are stale if the frames were loaded with another
+    # unit or number of examples.
+    if auxiliary is not None and (
+        auxiliary.get("unit_to_ev") != self._get_unit() or
+        auxiliary.get("num_examples") != self._size):
+      auxiliary = None
+    Database.__init__(self, None, auxiliary=auxiliary)
+
+  def _get_unit(self):
+    """
+    Return the unit for converting energies and forces to eV.
+    """
+    return float(self._unit or 1.0)
+
+  def __len__(self):
+    """
+    Return the total number of examples of this database.
+    """
+    return self._size
+
+  def __getitem__(self, index):
+    """
+    x.__getitem__(y) <==> x[y]
+
+    Args:
+      index: an `int` or a list of `int` as the one-based id(s) to select.
+
+    Returns:
+      sel: an `ase.Atoms` or a list of `ase.Atoms`.
+
+    """
+    if isinstance(index, (int, np.integer)):
+      return self.get_record(int(index)).to_atoms()
+    elif isinstance(index, slice):
+      start = 1 if index.start is None else index.start
+      stop = self._size + 1 if index.stop is None else index.stop
+      step = index.step or 1
+      return [self[i] for i in range(start, stop, step)]
+    else:
+      return [self[int(i)] for i in index]
+
+  @property
+  def num_examples(self):
+    """
+    Return the total number of examples of this database.
+    """
+    return self._size
+
+  def get_record(self, aid):
+    """
+    Return the `StructureRecord` of the given one-based id. The frames are never
+    modified. The unit conversion is applied to a new record.
+    """
+    if aid < 1 or aid > self._size:
+      raise ValueError("The id should be in [1, {}]!".format(self._size))
+    frame = self._frames[aid - 1]
+    if isinstance(frame, StructureRecord):
+      record = frame
+    else:
+      record = StructureRecord.from_atoms(frame)
+    if record.energy is None:
+      raise ValueError(
+        "The frame {} of {} has no energy. Frames without a calculator can not "
+        "be used.".format(aid, self._filename or "the database"))
+    if not self._unit:
+      return record
+    if record.forces is not None:
+      forces = np.asarray(record.forces) * self._unit
+    else:
+      forces = None
+    return StructureRecord(numbers=record.numbers,
+                           positions=record.positions,
+                           cell=record.cell,
+                           pbc=record.pbc,
+                           energy=record.energy * self._unit,
+                           forces=forces)
+
+  def save_statistics(self):
+    """
+    Persist the statistics and the unit to '{filename}.aux'.
+    """
+    if self._filename is None or self._stats is None:
+      return
+    self._auxiliary = self._stats.as_dict()
+    self._auxiliary["unit_to_ev"] = self._get_unit()
+    _save_auxiliary_dict(self._filename, self._auxiliary)
+
+  def refresh_statistics(self, num_workers=None, chunk_size=100000):
+    """
+    Go through all frames to re-compute the statistics. Frames are scanned
+    serially because the underlying sequence may not be shared by processes.
+    """
+    stats = DatabaseStatistics()
+    for aid in range(1, self._size + 1):
+      record = self.get_record(aid)
+      stats.add(record.get_chemical_symbols(), record.energy)
+    self._stats = stats
+    self.save_statistics()
+
+  def write(self, atoms, persist=False, **key_value_pairs):
+    """
+    `FrameDatabase` is read-only.
+    """
+    raise IOError("{} is read-only!".format(
+      self._filename or "This FrameDatabase"))
+
+  def examples(self, mode=ModeKeys.TRAIN):
+    """
+    A set-like object providing a view on `ase.Atoms` of this database.
+
+    Args:
+      mode: the purpose of the examples to fetch.
+
+    Yields:
+      atoms: an `ase.Atoms` object.
+
+    """
+    for aid in self._get_ids(mode):
+      yield self.get_record(aid).to_atoms()
+
+  def records(self, mode=ModeKeys.TRAIN):
+    """
+    A set-like object providing a view on `StructureRecord` of this database.
+
+    Args:
+      mode: the purpose of the examples to fetch.
+
+    Yields:
+      record: a `StructureRecord` object.
+
+    """
+    for aid in self._get_ids(mode):
+      yield self.get_record(aid)
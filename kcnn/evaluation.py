@@ -9,8 +9,10 @@ import time
 import numpy as np
 import tensorflow as tf
 from logging import CRITICAL
+from contextlib import contextmanager
 from datetime import datetime
-from kcnn import kcnn_from_dataset
+from kcnn import kcnn_from_dataset, get_session_config
+from pipeline import get_dataset_size
 from constants import VARIABLE_MOVING_AVERAGE_DECAY
 from utils import set_logging_configs
 from sklearn.metrics import r2_score, mean_squared_error, mean_absolute_error
@@ -54,8 +56,20 @@ def get_eval_dir():
   return join(FLAGS.checkpoint_dir, "eval")
 
 
+@contextmanager
+def _get_session(sess=None):
+  """
+  Yield the given session or a new session which will be closed on exit.
+  """
+  if sess is not None:
+    yield sess
+  else:
+    with tf.Session(config=get_session_config()) as sess:
+      yield sess
+
+
 def eval_once(saver, summary_writer, y_true_op, y_nn_op, f_true_op, f_nn_op,
-              n_atom_op, summary_op, eval_training_data=False):
+              n_atom_op, summary_op, eval_training_data=False, sess=None):
   """
   Run Eval once.
 
@@ -71,9 +85,12 @@ def eval_once(saver, summary_writer, y_true_op, y_nn_op, f_true_op, f_nn_op,
     summary_op: Summary op.
     eval_training_data: a `bool` indicating whether the dataset used is the
       training dataset or not.
+    sess: a `tf.Session` to run the evaluation. If None, a new session will be
+      created and closed afterwards. Reusing a session keeps the cached
+      examples of the input pipeline alive across evaluations.
 
   """
-  with tf.Session() as sess:
+  with _get_session(sess) as sess:
     ckpt = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
     if ckpt and ckpt.model_checkpoint_path:
       # Assuming model_checkpoint_path looks something like:
@@ -134,21 +151,35 @@ def eval_once(saver, summary_writer, y_true_op, y_nn_op, f_true_op, f_nn_op,
 
       step = 0
       tic = time.time()
+      summary_str = None
 
       while step < num_iter and not coord.should_stop():
 
         istart = step * FLAGS.batch_size
         istop = min(istart + FLAGS.batch_size, num_evals)
 
-        y_true_, y_pred_, n_atom_ = sess.run([y_true_op, y_nn_op, n_atom_op])
-        y_true[istart: istop] = -y_true_
-        y_pred[istart: istop] = -y_pred_
-        n_atom[istart: istop] = n_atom_
+        # All tensors are fetched by one run so that every evaluation reads
+        # exactly `num_iter` batches. The summaries are fetched with the last
+        # batch.
+        fetches = [y_true_op, y_nn_op, n_atom_op]
+        if atomic_forces:
+          fetches += [f_true_op, f_nn_op]
+        with_summary = (step == num_iter - 1 and not FLAGS.run_once and
+                        summary_op is not None)
+        if with_summary:
+          fetches.append(summary_op)
+        values = sess.run(fetches)
+
+        y_true[istart: istop] = -values[0]
+        y_pred[istart: istop] = -values[1]
+        n_atom[istart: istop] = values[2]
 
         if atomic_forces:
-          f_true_, f_pred_ = sess.run([f_true_op, f_nn_op])
-          f_true[istart: istop, :] = f_true_
-          f_pred[istart: istop, :] = f_pred_
+          f_true[istart: istop, :] = values[3]
+          f_pred[istart: istop, :] = values[4]
+
+        if with_summary:
+          summary_str = values[-1]
 
         step += 1
 
@@ -238,7 +269,8 @@ def eval_once(saver, summary_writer, y_true_op, y_nn_op, f_true_op, f_nn_op,
 
       else:
         summary = tf.Summary()
-        summary.ParseFromString(sess.run(summary_op))
+        if summary_str is not None:
+          summary.ParseFromString(summary_str)
         summary.value.add(tag='MAE (eV) @ 1', simple_value=precision)
         summary.value.add(tag='R2 Score @ 1', simple_value=score)
         summary.value.add(tag='MAX (eV) @ 1', simple_value=emax)
@@ -263,12 +295,28 @@ def evaluate(eval_dir):
     is_eval=True,
   )
 
+  # Keep one session alive if the decoded examples are cached so that only the
+  # first evaluation reads the tfrecords. Only the first `num_evals` examples
+  # are cached and each evaluation reads exactly one epoch of them, so every
+  # checkpoint is scored on the same examples.
+  if FLAGS.cache and not FLAGS.run_once:
+    dataset_size = get_dataset_size(
+      FLAGS.dataset, for_training=FLAGS.eval_training_data)
+    if FLAGS.num_evals > dataset_size:
+      tf.logging.warning(
+        "`num_evals` is reduced to the dataset size {}.".format(dataset_size))
+      FLAGS.num_evals = dataset_size
+    num_examples = FLAGS.num_evals
+  else:
+    num_examples = None
+
   with tf.Graph().as_default() as graph:
 
     # Inference the KCNN model for evaluation
     y_calc, y_true, _, f_calc, f_true, n_atom = kcnn_from_dataset(
       FLAGS.dataset,
       for_training=FLAGS.eval_training_data,
+      num_examples=num_examples,
       verbose=False,
     )
 
@@ -294,24 +342,33 @@ def evaluate(eval_dir):
       tf.gfile.MakeDirs(summary_dir)
     summary_writer = tf.summary.FileWriter(summary_dir, graph)
 
+    if num_examples is not None:
+      sess = tf.Session(config=get_session_config())
+    else:
+      sess = None
+
     # Run the evalutions
     evaluated_steps = []
 
-    while True:
-      eval_at_step = eval_once(
-        saver, summary_writer, y_true, y_calc, f_true, f_calc, n_atom,
-        summary_op, eval_training_data=FLAGS.eval_training_data
-      )
-      if len(evaluated_steps) > 0 and evaluated_steps[-1] != eval_at_step:
-        evaluated_steps.clear()
-      evaluated_steps.append(eval_at_step)
-      if len(evaluated_steps) == FLAGS.stop_after_repeats:
-        tf.logging.info("Automatically stop the evaluation after "
-                        "{} repeats.".format(len(evaluated_steps)))
-        break
-      if FLAGS.run_once:
-        break
-      time.sleep(FLAGS.eval_interval_secs)
+    try:
+      while True:
+        eval_at_step = eval_once(
+          saver, summary_writer, y_true, y_calc, f_true, f_calc, n_atom,
+          summary_op, eval_training_data=FLAGS.eval_training_data, sess=sess
+        )
+        if len(evaluated_steps) > 0 and evaluated_steps[-1] != eval_at_step:
+          evaluated_steps.clear()
+        evaluated_steps.append(eval_at_step)
+        if len(evaluated_steps) == FLAGS.stop_after_repeats:
+          tf.logging.info("Automatically stop the evaluation after "
+                          "{} repeats.".format(len(evaluated_steps)))
+          break
+        if FLAGS.run_once:
+          break
+        time.sleep(FLAGS.eval_interval_secs)
+    finally:
+      if sess is not None:
+        sess.close()
 
 
 def main(_):
@@ -6,13 +6,15 @@ from __future__ import print_function, absolute_import
 
 import numpy as np
 import tensorflow as tf
-from tensorflow.contrib.framework import arg_scope
+from tensorflow.contrib.framework import arg_scope, model_variable
 from tensorflow.contrib.layers import batch_norm, layer_norm
 from tensorflow.contrib.layers import conv2d, flatten
 from tensorflow.contrib.layers.python.layers import initializers
 from tensorflow.python.ops import init_ops
 from constants import KcnnGraphKeys, SEED, GHOST
 from utils import lrelu, get_atoms_from_kbody_term
+from transformer import Transformer
+from transformer import exponential_norm, morse_norm, inverse_norm
 
 __author__ = 'Xin Chen'
 __email__ = 'Bismarrck@me.com'
@@ -117,6 +119,180 @@ def _inference_kbody_cnn(inputs, kbody_term, is_training, verbose=True,
     return outputs
 
 
+def _get_fused_indices(split_dims):
+  """
+  Return the static indices for gathering the rows of all k-body terms into a
+  zero-padded grid of shape `[num_terms, max(split_dims)]` and for gathering
+  them back.
+
+  Args:
+    split_dims: a `List[int]` as the dims of the k-body terms.
+
+  Returns:
+    grid: an `int32` array of shape `[num_terms, max(split_dims)]`. The padded
+      entries point to the extra zero row `sum(split_dims)`.
+    inverse: an `int32` array of shape `[sum(split_dims)]` as the positions of
+      the rows in the flattened grid.
+
+  """
+  total_dim = int(sum(split_dims))
+  max_dim = int(max(split_dims))
+  grid = np.full((len(split_dims), max_dim), total_dim, dtype=np.int32)
+  inverse = np.zeros(total_dim, dtype=np.int32)
+  offset = 0
+  for i, dim in enumerate(split_dims):
+    dim = int(dim)
+    grid[i, :dim] = np.arange(offset, offset + dim)
+    inverse[offset: offset + dim] = i * max_dim + np.arange(dim)
+    offset += dim
+  return grid, inverse
+
+
+def _inference_fused_kbody_cnn(inputs, split_dims, kbody_terms, num_kernels,
+                               trainables, use_bias=True, activation_fn=lrelu,
+                               weights_initializer=None, reuse=False,
+                               verbose=True):
+  """
+  Infer the networks of all k-body terms at once. The rows of the k-body terms
+  are gathered into a zero-padded grid and each layer of all networks is
+  evaluated by a single batched matmul over the stacked weights. The variables
+  are the same as those created by `_inference_kbody_cnn`.
+
+  Args:
+    inputs: a `[-1, 1, D, C(k, 2)]` Tensor as the inputs.
+    split_dims: a `List[int]` as the static dims of the k-body terms.
+    kbody_terms: a `List[str]` as the names of the k-body terms.
+    num_kernels: a `List[int]` as the number of kernels.
+    trainables: a `List[bool]` indicating whether the network of each k-body
+      term is trainable or not.
+    use_bias: a `bool` indicating whether the hidden layers have biases.
+    activation_fn: a `Callable` as the activation function for each layer.
+    weights_initializer: a `Callable` as the function to intialize weights.
+    reuse: a `bool` indicating whether we should reuse the variables or not.
+    verbose: a `bool`. If Ture, the shapes of the layers will be printed.
+
+  Returns:
+    contribs: a Tensor of shape `[-1, 1, D, 1]` as the ungated energy contribs
+      of all k-body terms.
+
+  """
+  dtype = tf.float32
+  weights_initializer = weights_initializer or initializers.xavier_initializer(
+    seed=SEED, dtype=dtype)
+  biases_initializer = init_ops.zeros_initializer()
+  collections = [KcnnGraphKeys.FORCES_VARIABLES,
+                 KcnnGraphKeys.ENERGY_VARIABLES]
+  ck2 = inputs.get_shape().as_list()[-1]
+  num_terms = len(kbody_terms)
+
+  def _variable(name, shape, initializer, trainable):
+    return model_variable(name, shape=shape, dtype=dtype,
+                          initializer=initializer, trainable=trainable,
+                          collections=collections)
+
+  # Create (or reuse) the variables with the layout of `conv2d`.
+  layers = []
+  for i, kbody_term in enumerate(kbody_terms):
+    symbols = get_atoms_from_kbody_term(kbody_term)
+    k = len(symbols) - symbols.count(GHOST)
+    num_in = 1 if k == 2 else ck2
+    term_layers = []
+    with tf.variable_scope(kbody_term, reuse=reuse):
+      for j, num_out in enumerate(num_kernels):
+        with tf.variable_scope("Hidden{:d}/1x1Conv{:d}".format(j + 1, j + 1)):
+          kernel = _variable("weights", [1, 1, num_in, num_out],
+                             weights_initializer, trainables[i])
+          kernel = tf.reshape(kernel, [num_in, num_out])
+          # Only the first column of the 2-body inputs is used. Padding zero
+          # rows to the kernel is equivalent.
+          if num_in < ck2 and j == 0:
+            kernel = tf.pad(kernel, [[0, ck2 - num_in], [0, 0]])
+          if use_bias:
+            bias = _variable("biases", [num_out], biases_initializer,
+                             trainables[i])
+          else:
+            bias = None
+        term_layers.append((kernel, bias))
+        num_in = num_out
+      with tf.variable_scope("k-Body"):
+        kernel = _variable("weights", [1, 1, num_in, 1], weights_initializer,
+                           trainables[i])
+        term_layers.append((tf.reshape(kernel, [num_in, 1]), None))
+    layers.append(term_layers)
+
+  if verbose:
+    tf.logging.info("Infer all k-body terms of `KCNN` with the fused networks.")
+
+  with tf.name_scope("Fused"):
+    grid, inverse = _get_fused_indices(split_dims)
+    max_dim = grid.shape[1]
+
+    # Gather the rows into the grid of shape `[num_terms, -1, C(k, 2)]`.
+    with tf.name_scope("Gather"):
+      x = tf.squeeze(inputs, axis=1)
+      batch_size = tf.shape(x)[0]
+      x = tf.pad(x, [[0, 0], [0, 1], [0, 0]])
+      x = tf.gather(x, grid, axis=1)
+      x = tf.transpose(x, [1, 0, 2, 3])
+      x = tf.reshape(x, [num_terms, -1, ck2])
+
+    for j in range(len(num_kernels) + 1):
+      with tf.name_scope("Layer{:d}".format(j + 1)):
+        kernel = tf.stack([term_layers[j][0] for term_layers in layers])
+        x = tf.matmul(x, kernel)
+        if j < len(num_kernels):
+          if use_bias:
+            bias = tf.stack([term_layers[j][1] for term_layers in layers])
+            x = tf.add(x, tf.expand_dims(bias, axis=1))
+          x = activation_fn(x)
+        if verbose:
+          print_activations(x)
+
+    # Gather the outputs back to the original row order.
+    with tf.name_scope("Scatter"):
+      x = tf.reshape(x, tf.stack([num_terms, batch_size, max_dim]))
+      x = tf.transpose(x, [1, 0, 2])
+      x = tf.reshape(x, tf.stack([batch_size, num_terms * max_dim]))
+      x = tf.gather(x, inverse, axis=1)
+      contribs = tf.reshape(x, [-1, 1, len(inverse), 1])
+
+    if verbose:
+      print_activations(contribs)
+      tf.logging.info("")
+    return contribs
+
+
+def _pack_rows(inputs, weights):
+  """
+  Gather the rows with nonzero weights of a k-body term into a packed batch.
+
+  Args:
+    inputs: a `[-1, 1, D, C]` Tensor as the inputs of a k-body term.
+    weights: a `[-1, 1, D, 1]` Tensor as the binary weights of the rows.
+
+  Returns:
+    packed: a `[1, 1, -1, C]` Tensor as the rows with nonzero weights.
+    scatter: a `Callable` which scatters the `[1, 1, -1, 1]` outputs of the
+      packed rows back to a `[-1, 1, D, 1]` Tensor. The other rows are zeros.
+
+  """
+  with tf.name_scope("Pack"):
+    shape = tf.shape(inputs)
+    num_channels = inputs.get_shape().as_list()[-1]
+    mask = tf.greater(tf.reshape(weights, [-1]), 0.0)
+    indices = tf.to_int32(tf.reshape(tf.where(mask), [-1]))
+    rows = tf.reshape(inputs, [-1, num_channels])
+    packed = tf.reshape(tf.gather(rows, indices), [1, 1, -1, num_channels])
+
+  def _scatter(outputs):
+    with tf.name_scope("Scatter"):
+      outputs = tf.unsorted_segment_sum(
+        tf.reshape(outputs, [-1]), indices, shape[0] * shape[2])
+      return tf.reshape(outputs, tf.stack([shape[0], 1, shape[2], 1]))
+
+  return packed, _scatter
+
+
 def _inference_1body_nn(occurs, num_atom_types, initial_one_body_weights=None,
                         reuse=False, trainable=True):
   """
@@ -161,7 +337,53 @@ def _inference_1body_nn(occurs, num_atom_types, initial_one_body_weights=None,
   )
 
 
-def inference_forces(y_total, inputs, coefficients, indexing, summary=True):
+def _assemble_forces_by_segment_sum(dydz, coefficients, indexing):
+  """
+  Assemble the forces with `tf.unsorted_segment_sum`. Only the nonzero entries
+  of `indexing` are gathered and neither the tiled `dydz` nor the
+  `[batch_size, num_f, num_entries]` intermediates are materialized.
+
+  Args:
+    dydz: a `float32` Tensor of shape `[-1, D, C(k, 2)]` as dE / dz.
+    coefficients: a `float32` Tensor of shape `[-1, D, 6 * C(k, 2)]` as the
+      auxiliary coefficients.
+    indexing: an `int32` Tensor of shape `[-1, num_f, num_entries]`. The values
+      are the one-based indices into the flattened `coefficients` of each
+      example. Zeros are paddings.
+
+  Returns:
+    forces: a `float32` Tensor of shape `[-1, num_f]`.
+
+  """
+  ck2 = dydz.get_shape().as_list()[-1]
+
+  with tf.name_scope("indices"):
+    shape = tf.shape(indexing, name="shape")
+    batch_size, num_f = shape[0], shape[1]
+    num_rows = tf.shape(dydz)[1]
+
+    # The (example, component, entry) indices of all nonzero entries.
+    where = tf.to_int32(tf.where(tf.greater(indexing, 0)), name="where")
+    b, f = where[:, 0], where[:, 1]
+    p = tf.gather_nd(indexing, where) - 1
+
+    # `p` indexes the `6 * C(k, 2)` coefficients of each row. The matched entry
+    # of the tiled `dydz` is `p % C(k, 2)` of the same row.
+    row = tf.floordiv(p, 6 * ck2)
+    col = tf.floormod(p, ck2)
+    z_indices = b * num_rows * ck2 + row * ck2 + col
+    c_indices = b * num_rows * 6 * ck2 + p
+    segment_ids = b * num_f + f
+
+  g = tf.multiply(tf.gather(tf.reshape(dydz, [-1]), z_indices),
+                  tf.gather(tf.reshape(coefficients, [-1]), c_indices),
+                  name="g")
+  g = tf.unsorted_segment_sum(g, segment_ids, batch_size * num_f, name="sum")
+  return tf.reshape(g, tf.stack([batch_size, num_f]), name="reshape")
+
+
+def inference_forces(y_total, inputs, coefficients, indexing, summary=True,
+                     segment_sum=False):
   """
   Inference the kCON forces.
 
@@ -173,6 +395,9 @@ def inference_forces(y_total, inputs, coefficients, indexing, summary=True):
     indexing: a 3D Tensor as the indexing matrix for force compoenents.
     summary: a `bool` indicating whether we add summaries of some internal
       tensors or not.
+    segment_sum: a `bool`. If True, the forces will be assembled by
+      `_assemble_forces_by_segment_sum` which uses much less memory for large
+      structures.
 
   Returns:
     forces: a `float32` Tensor of shape `[-1, num_force_components]` as the
@@ -194,6 +419,10 @@ def inference_forces(y_total, inputs, coefficients, indexing, summary=True):
     # Squeeze the `dydz`. Now its shape will be `[-1, D, C(k, 2)]`
     dydz = tf.squeeze(dydz, axis=1, name="squeezed")
 
+    if segment_sum:
+      g = _assemble_forces_by_segment_sum(dydz, coefficients, indexing)
+      return tf.identity(g, "forces")
+
     # Tile the derivatives because each entry of `z` contributes to six force
     # components.
     tiled = tf.tile(dydz, (1, 1, 6), "tiled")
@@ -256,6 +485,134 @@ def inference_forces(y_total, inputs, coefficients, indexing, summary=True):
   return forces
 
 
+def _normalize_distances(r, units, norm='exp', norm_order=1):
+  """
+  The graph versions of the normalizing functions of `transformer` which
+  support predicting forces.
+  """
+  if norm == 'exp':
+    if int(norm_order) == 0:
+      return tf.exp(-r)
+    return tf.exp(-tf.pow(r / units, int(norm_order)))
+  elif norm == 'morse':
+    alpha = -1.0 * float(norm_order)
+    return tf.square(1.0 - tf.exp(alpha * (r - units))) - np.exp(-1.0)
+  elif norm == 'inv':
+    return 1.0 / r
+  else:
+    raise ValueError("Unsupported normalizing function: {}".format(norm))
+
+
+def _conditionally_sort(features, kbody_terms, split_dims):
+  """
+  Sort the columns of the duplicated bonds of each k-body term in ascending
+  order. This is the graph version of `Transformer._conditionally_sort`.
+  """
+  indices = Transformer._get_conditional_sorting_indices(kbody_terms)
+  if not indices:
+    return features
+
+  with tf.name_scope("Sort"):
+    blocks = tf.split(features, split_dims, axis=1)
+    for i, kbody_term in enumerate(kbody_terms):
+      if kbody_term not in indices:
+        continue
+      columns = tf.unstack(blocks[i], axis=2)
+      for ix in indices[kbody_term]:
+        values = tf.stack([columns[j] for j in ix], axis=2)
+        values = -tf.nn.top_k(-values, k=len(ix), sorted=True).values
+        for j, column in zip(ix, tf.unstack(values, axis=2)):
+          columns[j] = column
+      blocks[i] = tf.stack(columns, axis=2)
+    return tf.concat(blocks, axis=1, name="sorted")
+
+
+def inference_features(positions, stoichiometry, pairs, units, kbody_terms,
+                       split_dims, norm='exp', norm_order=1):
+  """
+  Compute the input feature matrix from the atomic positions. This is the graph
+  version of `Transformer.transform` so that the forces can be computed by
+  `inference_forces_from_positions`.
+
+  Args:
+    positions: a `float32` Tensor of shape `[-1, N, 3]` as the zero-padded
+      atomic positions.
+    stoichiometry: an `int64` Tensor of shape `[-1, ]` as the index of the
+      stoichiometry of each example.
+    pairs: an `int32` array of shape `[num_stoichiometries, D, C(k, 2), 2]` as
+      the pair tables. See `Transformer.get_position_indices`.
+    units: a `float32` array of shape `[num_stoichiometries, D, C(k, 2)]` as the
+      covalent radii of the pairs.
+    kbody_terms: a `List[str]` as the names of the k-body terms.
+    split_dims: a `List[int]` as the dims of the k-body terms.
+    norm: a `str` as the normalizing function, 'exp', 'morse' or 'inv'.
+    norm_order: an `int` or a `float` as the order of the normalizing function.
+
+  Returns:
+    features: a `float32` Tensor of shape `[-1, 1, D, C(k, 2)]` as the input
+      feature matrix.
+
+  """
+  norm = norm.lower()
+  ghost_fn = {'exp': exponential_norm, 'morse': morse_norm, 'inv': inverse_norm}
+  if norm not in ghost_fn:
+    raise ValueError("Unsupported normalizing function: {}".format(norm))
+  # The distances of the atom-ghost pairs are infinity.
+  ghost = float(ghost_fn[norm](np.inf, unit=1.0, order=norm_order))
+
+  with tf.name_scope("Features"):
+    pairs = tf.gather(tf.constant(pairs, dtype=tf.int32, name="pairs"),
+                      stoichiometry, name="gather_pairs")
+    units = tf.gather(tf.constant(units, dtype=tf.float32, name="units"),
+                      stoichiometry, name="gather_units")
+
+    # Gather the positions of the pairs from the flattened positions.
+    shape = tf.shape(positions, name="shape")
+    offsets = tf.reshape(tf.range(shape[0]) * shape[1], [-1, 1, 1, 1])
+    indices = tf.add(tf.maximum(pairs, 0), offsets, name="indices")
+    xyz = tf.gather(tf.reshape(positions, [-1, 3]), indices, name="xyz")
+    delta = tf.subtract(xyz[:, :, :, 0], xyz[:, :, :, 1], name="delta")
+
+    # The masked entries use unit distances so that `sqrt` and its gradients
+    # are always finite.
+    code = pairs[:, :, :, 0]
+    valid = tf.greater_equal(code, 0, name="valid")
+    r = tf.sqrt(tf.where(valid,
+                         tf.reduce_sum(tf.square(delta), axis=-1),
+                         tf.ones_like(units)), name="r")
+    z = _normalize_distances(r, units, norm=norm, norm_order=norm_order)
+    fill = tf.where(tf.equal(code, -2), tf.ones_like(z) * ghost,
+                    tf.zeros_like(z))
+    z = tf.where(valid, z, fill, name="z")
+
+    z = _conditionally_sort(z, kbody_terms, [int(x) for x in split_dims])
+    return tf.expand_dims(z, axis=1, name="features")
+
+
+def inference_forces_from_positions(y_total, positions, summary=True):
+  """
+  Inference the kCON forces as the derivatives of the outputs w.r.t. the atomic
+  positions from which the inputs were computed by `inference_features`.
+
+  Args:
+    y_total: a Tensor of shape `[-1, ]` as the outputs of the model, which are
+      the negative total energies.
+    positions: a `float32` Tensor of shape `[-1, N, 3]` as the atomic positions.
+    summary: a `bool` indicating whether we add summaries of some internal
+      tensors or not.
+
+  Returns:
+    forces: a `float32` Tensor of shape `[-1, 3 * N]` as the neural network
+      forces.
+
+  """
+  with tf.name_scope("Forces"):
+    dydr = tf.gradients([y_total], [positions], name="dydr")[0]
+    if summary:
+      tf.summary.histogram(dydr.op.name + "/hist", dydr)
+    return tf.identity(flatten(dydr), name="forces")
+
+
 def _split_inputs(inputs, split_dims):
   """
   Split the inputs into different parts. Each part represents a k-body atomic
@@ -271,7 +628,8 @@ def inference_energy(inputs, occurs, weights, split_dims, num_atom_types,
                      num_kernels=None, activation_fn=lrelu,
                      normalizer='bias', weights_initializer=None,
                      one_body_weights=None, trainable_one_body=True,
-                     trainable_k_max=3, summary=True):
+                     trainable_k_max=3, summary=True, fused=False,
+                     sparse=False, prune=False):
   """
   Inference the kCON energy model.
 
@@ -303,6 +661,17 @@ def inference_energy(inputs, occurs, weights, split_dims, num_atom_types,
       be trained.
     summary: a `bool` indicating whether we should add summaries for
       tensors or not.
+    fused: a `bool`. If True, the networks of all k-body terms will be evaluated
+      by batched matmuls. The variables are unchanged. This requires static
+      `split_dims` and the 'bias' normalizer (or None); otherwise the per-term
+      networks will be used.
+    sparse: a `bool`. If True, only the rows with nonzero `weights` (e.g. the
+      rows kept by `Transformer.compress`) will be fed to the k-body networks
+      and their contribs will be scattered back with segment sums. This
+      requires the 'bias' normalizer (or None) and overrides `fused`.
+    prune: a `bool`. If True, the networks of the k-body terms with
+      `k > trainable_k_max` will not be built and their contribs will be zeros.
+      Otherwise these networks are evaluated and multiplied by a zero gate.
 
   Returns:
     y_total: a `float32` Tensor of shape `[-1, ]` as the total energies.
@@ -313,16 +682,94 @@ def inference_energy(inputs, occurs, weights, split_dims, num_atom_types,
 
   """
 
+  # The statistics of the batch normalization and the layer normalization would
+  # change if the zero-weight rows were skipped.
+  if sparse and normalizer not in ('bias', None):
+    tf.logging.warning(
+      "The sparse execution requires the 'bias' normalizer. All rows will be "
+      "evaluated.")
+    sparse = False
+  if sparse and fused:
+    tf.logging.warning("The fused networks are disabled by `sparse`.")
+    fused = False
+
+  # The batch normalization and the layer normalization are computed per k-body
+  # term so they can not be fused.
+  if fused and (isinstance(split_dims, tf.Tensor) or
+                normalizer not in ('bias', None)):
+    tf.logging.warning(
+      "The fused networks require static `split_dims` and the 'bias' "
+      "normalizer. The per-term networks will be used.")
+    fused = False
+
+  # Only the k-body terms with `k <= trainable_k_max` give energy contribs.
+  gates = []
+  for kbody_term in kbody_terms:
+    symbols = get_atoms_from_kbody_term(kbody_term)
+    gates.append(len(symbols) - symbols.count(GHOST) <= trainable_k_max)
+  prune = prune and not all(gates)
+  if prune and fused and not any(gates):
+    fused = False
+
   with tf.name_scope("Energy"):
 
     # Split the input feature matrix into several parts. Each part represents a
     # certain atomic interaction. The number of parts is equal to the number of
     # k-body terms.
-    splited_inputs = _split_inputs(inputs, split_dims)
+    if fused and not prune:
+      splited_inputs = []
+    else:
+      splited_inputs = _split_inputs(inputs, split_dims)
+    if sparse:
+      splited_weights = _split_inputs(weights, split_dims)
 
     # Inference the convolution network for each k-body interaction
     y_contribs = []
+
+    if fused:
+      dims = [int(dim) for dim in split_dims]
+      active = [i for i in range(len(kbody_terms)) if gates[i]]
+      if prune:
+        # Only the rows of the active terms are fed to the fused networks.
+        fused_inputs = tf.concat([splited_inputs[i] for i in active], axis=2,
+                                 name="active_inputs")
+      else:
+        fused_inputs = inputs
+        active = list(range(len(kbody_terms)))
+      contribs = _inference_fused_kbody_cnn(
+        fused_inputs,
+        split_dims=[dims[i] for i in active],
+        kbody_terms=[kbody_terms[i] for i in active],
+        num_kernels=num_kernels or (40, 50, 60, 40),
+        trainables=[gates[i] for i in active],
+        use_bias=normalizer == 'bias',
+        activation_fn=activation_fn,
+        weights_initializer=weights_initializer,
+        reuse=reuse,
+        verbose=verbose)
+
+      if prune:
+        active_contribs = dict(zip(
+          active, tf.split(contribs, [dims[i] for i in active], axis=2)))
+        for i, conv in enumerate(splited_inputs):
+          if i in active_contribs:
+            y_contribs.append(active_contribs[i])
+          else:
+            y_contribs.append(tf.zeros_like(conv[..., 0:1], name="y_pruned"))
+      else:
+        # Non-trainable CNNs should not give energy contributions.
+        gate = np.repeat(np.asarray(gates, dtype=np.float32), dims)
+        contribs = tf.multiply(
+          contribs, gate.reshape((1, 1, -1, 1)), name="raw_contribs")
+      splited_inputs = []
+
     for i, conv in enumerate(splited_inputs):
+
+      # The network of a pruned term is never built. Its contribs are zeros.
+      if prune and not gates[i]:
+        y_contribs.append(tf.zeros_like(conv[..., 0:1], name="y_pruned"))
+        continue
+
       with tf.variable_scope(kbody_terms[i]):
 
         # Get the number of GHOST atoms in this k-body term so that we can
@@ -335,6 +782,10 @@ def inference_energy(inputs, occurs, weights, split_dims, num_atom_types,
         if k == 2:
           conv = conv[..., 0:1]
 
+        # Only evaluate the rows with nonzero weights.
+        if sparse:
+          conv, scatter = _pack_rows(conv, splited_weights[i])
+
         # A gate tensor should be added so that non-trainable CNNs will not give
         # energy contributions.
         if trainable:
@@ -355,12 +806,15 @@ def inference_energy(inputs, occurs, weights, split_dims, num_atom_types,
           trainable=trainable,
           verbose=verbose
         )
+        if sparse:
+          y_contrib = scatter(y_contrib)
         y_gated = tf.multiply(y_contrib, gate, name='y_gated')
         y_contribs.append(y_gated)
 
     # Concat the k-body contribs from all k-body terms. The new tensor has the
     # shape of `[-1, 1, D, 1]`.
-    contribs = tf.concat(y_contribs, axis=2, name="raw_contribs")
+    if y_contribs:
+      contribs = tf.concat(y_contribs, axis=2, name="raw_contribs")
 
     # Obtain the weighted k-body contribs.
     # In general we hope zero inputs lead to zero contribs. But the convolution
@@ -4,6 +4,7 @@ This script is used to infer the neural network.
 """
 from __future__ import print_function, absolute_import
 
+from contextlib import contextmanager
 from functools import partial
 
 import numpy as np
@@ -15,6 +16,7 @@ from constants import SEED
 from constants import VARIABLE_MOVING_AVERAGE_DECAY, LOSS_MOVING_AVERAGE_DECAY
 from summary_utils import add_total_norm_summaries, add_variable_summaries
 from inference import inference_energy, inference_forces
+from inference import inference_features, inference_forces_from_positions
 from utils import lrelu, selu, reduce_l2_norm
 from utils import selu_initializer, msra_initializer
 from amsgrad import AmsGrad
@@ -40,6 +42,30 @@ tf.app.flags.DEFINE_boolean('fixed_one_body', False,
                             """Make the one-body weights fixed.""")
 tf.app.flags.DEFINE_integer("trainable_k_max", 3,
                             """Set the trainable k_max.""")
+tf.app.flags.DEFINE_boolean('fused_kbody', False,
+                            """Evaluate the networks of all k-body terms with 
+                            batched matmuls instead of separate conv layers. 
+                            The variables and checkpoints are unchanged. Only 
+                            the 'bias' normalizer is supported.""")
+tf.app.flags.DEFINE_boolean('sparse_kbody', False,
+                            """Only feed the rows with nonzero binary weights 
+                            (e.g. the rows kept by the cutoff compression) to 
+                            the k-body networks. Only the 'bias' normalizer is 
+                            supported.""")
+tf.app.flags.DEFINE_boolean('prune_gated_kbody', False,
+                            """Do not build the networks of the k-body terms 
+                            with k > `trainable_k_max`. Their contribs are 
+                            zeros and their variables are not created, so the 
+                            checkpoints can only be restored with the same 
+                            `trainable_k_max` or by `restore_weights_from`.""")
+tf.app.flags.DEFINE_boolean('segment_sum_forces', False,
+                            """Assemble the forces with segment sums over the 
+                            nonzero entries of `indexing` instead of gathering 
+                            the dense index tensor.""")
+tf.app.flags.DEFINE_string('xla_jit', 'none',
+                           """Enable the XLA JIT compilation: 'none', 'global' 
+                           (all ops of the session) or 'scope' (only the ops of 
+                           the kCON model, including their gradients).""")
 tf.app.flags.DEFINE_string('activation_fn', "lrelu",
                            """Set the activation function for conv layers.""")
 tf.app.flags.DEFINE_float('alpha', 0.01,
@@ -162,6 +188,40 @@ def get_optimizer(learning_rate):
       "Supported SGD optimizers: adam, nadam, adadelta, rmsprop, amsgrad")
 
 
+def get_session_config(**kwargs):
+  """
+  Return the `tf.ConfigProto` for creating sessions. The global XLA JIT level
+  is set if `xla_jit` is 'global'.
+
+  Args:
+    kwargs: additional key-value arguments for `tf.ConfigProto`.
+
+  Returns:
+    config: a `tf.ConfigProto`.
+
+  """
+  if FLAGS.xla_jit not in ('none', 'global', 'scope'):
+    raise ValueError("Unsupported xla_jit: {}".format(FLAGS.xla_jit))
+  config = tf.ConfigProto(**kwargs)
+  if FLAGS.xla_jit == 'global':
+    config.graph_options.optimizer_options.global_jit_level = \
+      tf.OptimizerOptions.ON_1
+  return config
+
+
+@contextmanager
+def _jit_scope():
+  """
+  Compile the ops created within this context with XLA if `xla_jit` is
+  'scope'. The gradients of these ops will also be compiled.
+  """
+  if FLAGS.xla_jit == 'scope':
+    with tf.contrib.compiler.jit.experimental_jit_scope():
+      yield
+  else:
+    yield
+
+
 def get_activation_fn(name='lrelu'):
   """
   Return a callable activation function.
@@ -208,7 +268,7 @@ class BatchIndex:
 def kcnn(inputs, occurs, weights, split_dims=(), num_atom_types=None,
          kbody_terms=(), is_training=True, reuse=False, num_kernels=None,
          verbose=True, one_body_weights=None, atomic_forces=False,
-         coefficients=None, indexing=None, add_summary=True):
+         coefficients=None, indexing=None, add_summary=True, positions=None):
   """
   Inference the model of `KCNN`.
 
@@ -237,6 +297,10 @@ def kcnn(inputs, occurs, weights, split_dims=(), num_atom_types=None,
     indexing: a 3D Tensor as the indexing matrix for force compoenents.
     add_summary: a `bool` indicating whether we should add summaries for
       tensors or not.
+    positions: a `float32` Tensor of shape `[-1, N, 3]` as the atomic positions
+      from which `inputs` were computed by `inference_features`. If given, the
+      forces will be the derivatives w.r.t. the positions and `coefficients`
+      and `indexing` are not needed.
 
   Returns:
     y_calc: a tensor of shape `(-1, )` as the predicted total energy.
@@ -274,7 +338,7 @@ def kcnn(inputs, occurs, weights, split_dims=(), num_atom_types=None,
       one_body_weights = np.ones(
         num_atom_types, dtype=np.float32) * one_body_weights[0]
 
-  with tf.variable_scope("kCON"):
+  with _jit_scope(), tf.variable_scope("kCON"):
     y_calc, _ = inference_energy(
       inputs,
       occurs,
@@ -293,15 +357,22 @@ def kcnn(inputs, occurs, weights, split_dims=(), num_atom_types=None,
       trainable_one_body=trainable,
       trainable_k_max=trainable_k_max,
       summary=add_summary,
+      fused=FLAGS.fused_kbody,
+      sparse=FLAGS.sparse_kbody,
+      prune=FLAGS.prune_gated_kbody,
     )
 
-    if atomic_forces:
+    if atomic_forces and positions is not None:
+      f_calc = inference_forces_from_positions(
+        y_total=y_calc, positions=positions, summary=add_summary)
+    elif atomic_forces:
       f_calc = inference_forces(
         y_total=y_calc,
         inputs=inputs,
         coefficients=coefficients,
         indexing=indexing,
-        summary=add_summary
+        summary=add_summary,
+        segment_sum=FLAGS.segment_sum_forces
       )
     else:
       f_calc = None
@@ -332,7 +403,9 @@ def extract_configs(configs, for_training=True):
   num_atom_types = configs["num_atom_types"]
   kbody_terms = [term.replace(",", "") for term in configs["kbody_terms"]]
   num_kernels = [int(units) for units in FLAGS.conv_sizes.split(",")]
-  atomic_forces = configs.get("atomic_forces_enabled", False)
+  # Force datasets can also be used for energy-only training. In this case the
+  # force-path fields are not read at all.
+  atomic_forces = configs.get("atomic_forces_enabled", False) and FLAGS.forces
 
   # The last weight corresponds to the average contribs from k_max-body terms.
   weights = np.array(configs["initial_one_body_weights"], dtype=np.float32)
@@ -350,7 +423,7 @@ def extract_configs(configs, for_training=True):
 
 
 def kcnn_from_dataset(dataset_name, for_training=True, num_epochs=None,
-                      **kwargs):
+                      num_examples=None, **kwargs):
   """
   Inference a kCON model for the given dataset.
 
@@ -359,6 +432,8 @@ def kcnn_from_dataset(dataset_name, for_training=True, num_epochs=None,
     for_training: a `bool` indicating whether this inference is for training or
       evaluation.
     num_epochs: an `int` as the maximum number of epochs to run.
+    num_examples: an `int`. If set, only the first `num_examples` examples are
+      read and every epoch of them is batched in the same way.
     kwargs: additional key-value parameters.
 
   Returns:
@@ -379,6 +454,9 @@ def kcnn_from_dataset(dataset_name, for_training=True, num_epochs=None,
     shuffle=for_training,
     num_epochs=num_epochs,
     batch_size=FLAGS.batch_size,
+    k_max=FLAGS.trainable_k_max,
+    saveable=for_training,
+    num_examples=num_examples,
   )
   configs = pipeline.get_configs(
     for_training=for_training, dataset_name=dataset_name
@@ -389,12 +467,41 @@ def kcnn_from_dataset(dataset_name, for_training=True, num_epochs=None,
       params[key] = val
     else:
       tf.logging.warning("Unrecognized key={}".format(key))
+  # The inputs of a size-bucketed batch are trimmed so they must be split with
+  # the dims of this batch.
+  if isinstance(batch, pipeline.BucketedExample):
+    params["split_dims"] = batch.split_dims
   y_true = batch[BatchIndex.y_true]
   y_weight = batch[BatchIndex.loss_weight]
   f_calc = None
   f_true = None
 
-  if not params["atomic_forces"]:
+  # In the positions layout the input features are computed in the graph.
+  if isinstance(batch, pipeline.PositionsExample):
+    pairs, units = pipeline.get_position_tables(
+      dataset_name, for_training=for_training)
+    inputs = inference_features(batch.positions,
+                                batch.stoichiometry,
+                                pairs=pairs,
+                                units=units,
+                                kbody_terms=params["kbody_terms"],
+                                split_dims=params["split_dims"],
+                                norm=configs.get("norm", "exp"),
+                                norm_order=configs.get("norm_order", 1))
+    if params["atomic_forces"]:
+      f_true = batch.forces
+      positions = batch.positions
+    else:
+      positions = None
+    y_calc, f_calc, n_atom = kcnn(
+      inputs,
+      batch.occurs,
+      batch.weights,
+      positions=positions,
+      **params
+    )
+
+  elif not params["atomic_forces"]:
     y_calc, _, n_atom = kcnn(
       batch[BatchIndex.inputs],
       batch[BatchIndex.occurs],
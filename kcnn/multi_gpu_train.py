@@ -14,11 +14,12 @@ import pipeline
 from datetime import datetime
 from os.path import join
 from os import getpid
-from constants import LOSS_MOVING_AVERAGE_DECAY
+from constants import LOSS_MOVING_AVERAGE_DECAY, GHOST
 from kcnn import extract_configs, BatchIndex
 from kcnn import kcnn as inference
 from save_model import save_model
 from utils import set_logging_configs, save_training_flags, get_k_from_var
+from utils import get_atoms_from_kbody_term
 from summary_utils import add_total_norm_summaries
 
 __author__ = 'Xin Chen'
@@ -232,6 +233,20 @@ def get_splits(batch, num_splits):
   return tensors_splits
 
 
+def _get_checkpoint_k_max(reader):
+  """
+  Return the maximum `k` of the k-body networks saved in a checkpoint or -1 if
+  there are none.
+  """
+  k_max = -1
+  for name in reader.get_variable_to_shape_map():
+    elements = name.split("/")
+    if len(elements) >= 4 and elements[0] == 'kCON':
+      symbols = get_atoms_from_kbody_term(elements[1])
+      k_max = max(k_max, len(symbols) - symbols.count(GHOST))
+  return k_max
+
+
 def restore_previous_checkpoint(sess, global_step):
   """
   Restore the moving averaged variables from a previous checkpoint.
@@ -248,11 +263,25 @@ def restore_previous_checkpoint(sess, global_step):
   # Only restore weights (trainable variabls) from a previous checkpoint to
   # start a new training.
   if FLAGS.restore_weights_from:
+    # The networks of the pruned k-body terms of the previous training (see
+    # `prune_gated_kbody`) have no variables, so they are initialized anew.
+    # Other missing variables are still errors.
+    reader = tf.train.NewCheckpointReader(FLAGS.restore_weights_from)
+    k_max = _get_checkpoint_k_max(reader)
+    if k_max < 0:
+      raise ValueError("No k-body networks were found in the checkpoint "
+                       "{}".format(FLAGS.restore_weights_from))
     variables_to_restore = {}
     for var in tf.trainable_variables():
-      if FLAGS.restore_2body_only and get_k_from_var(var) != 2:
+      k = get_k_from_var(var)
+      if FLAGS.restore_2body_only and k != 2:
+        continue
+      name = variable_averages.average_name(var)
+      if k > k_max and not reader.has_tensor(name):
+        tf.logging.info("Initialize the {}-body variable {} anew.".format(
+          k, var.op.name))
         continue
-      variables_to_restore[variable_averages.average_name(var)] = var
+      variables_to_restore[name] = var
   else:
     variables_to_restore = variable_averages.variables_to_restore()
   loader = tf.train.Saver(var_list=variables_to_restore)
@@ -268,6 +297,12 @@ def restore_previous_checkpoint(sess, global_step):
     if ckpt and ckpt.model_checkpoint_path:
       loader.restore(sess, ckpt.model_checkpoint_path)
       start_step = sess.run(global_step)
+
+      # Resume the input stream where the previous training stopped.
+      saveables = pipeline.get_input_saveables(ckpt.model_checkpoint_path)
+      if saveables:
+        tf.train.Saver(var_list=saveables).restore(
+          sess, ckpt.model_checkpoint_path)
       model_step = int(ckpt.model_checkpoint_path.split('/')[-1].split('-')[-1])
       if start_step != model_step:
         tf.logging.warning("The model step {:d} is not equal to the "
@@ -305,9 +340,16 @@ def train_with_multiple_gpus():
                                 shuffle=True,
                                 dataset_name=FLAGS.dataset,
                                 num_epochs=FLAGS.num_epochs,
-                                batch_size=total_batch_size)
+                                batch_size=total_batch_size,
+                                k_max=FLAGS.trainable_k_max,
+                                saveable=True)
     configs = pipeline.get_configs(for_training=True)
     params = extract_configs(configs, for_training=True)
+    if isinstance(batch, pipeline.BucketedExample):
+      params["split_dims"] = batch.split_dims
+    elif isinstance(batch, pipeline.PositionsExample):
+      raise ValueError("Datasets in the positions layout are only supported by "
+                       "`train.py` now.")
 
     # Split the batch for each tower
     tensors_splits = get_splits(batch, num_splits=FLAGS.num_gpus)
@@ -388,7 +430,9 @@ def train_with_multiple_gpus():
     save_training_flags(FLAGS.train_dir, FLAGS.flag_values_dict())
 
     # Create a saver.
-    saver = tf.train.Saver(tf.global_variables(), max_to_keep=FLAGS.max_to_keep)
+    saver = tf.train.Saver(tf.global_variables() +
+                           pipeline.get_input_saveables(),
+                           max_to_keep=FLAGS.max_to_keep)
 
     # Build the summary operation from the last tower summaries.
     summary_op = tf.summary.merge(summaries + non_tower_summaries)
@@ -399,7 +443,7 @@ def train_with_multiple_gpus():
     # Start running operations on the Graph. allow_soft_placement must be set to
     # True to build towers on GPU, as some of the ops do not have GPU
     # implementations.
-    sess = tf.Session(config=tf.ConfigProto(
+    sess = tf.Session(config=kcnn.get_session_config(
       allow_soft_placement=True,
       log_device_placement=FLAGS.log_device_placement))
     sess.run(init)
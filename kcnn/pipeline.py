@@ -6,12 +6,20 @@ This script is used to building training and validation datasets.
 from __future__ import print_function, absolute_import
 
 import json
+import numpy as np
 import tensorflow as tf
 from collections import namedtuple
 from functools import partial
+from multiprocessing import cpu_count
 from os import makedirs
-from os.path import join, isdir
-from constants import SEED
+from os.path import join, isdir, dirname, isfile
+from sklearn.model_selection import train_test_split, KFold
+from constants import SEED, GHOST, KcnnGraphKeys
+from store import ENERGY_FIELDS, FORCES_FIELDS, POSITIONS_FIELDS
+from store import get_store_dir, open_store, get_pairs_filename
+from store import get_forces_filename, get_term_field, get_term_filename
+from utils import get_atoms_from_kbody_term, get_kbody_widths
+from transformer import OneBodyCalculator
 
 __author__ = 'Xin Chen'
 __email__ = 'Bismarrck@me.com'
@@ -29,11 +37,67 @@ tf.app.flags.DEFINE_boolean('include_all_k', True,
                             """Include all k-body terms from k = 1 to k_max.""")
 tf.app.flags.DEFINE_boolean('forces', False,
                             """Set this to True to enable atomic forces.""")
-tf.app.flags.DEFINE_integer('num_parallel_calls', 64,
-                            """The number elements to process in parallel.""")
+tf.app.flags.DEFINE_integer('shuffle_buffer_size', 1000,
+                            """The number of serialized examples buffered for 
+                            shuffling. This is independent of the dataset 
+                            size.""")
+tf.app.flags.DEFINE_integer('shard_cycle_length', 4,
+                            """The number of shards to read concurrently when 
+                            shuffling a sharded dataset.""")
+tf.app.flags.DEFINE_boolean('cache', False,
+                            """Cache the decoded examples so that only the 
+                            first epoch reads and decodes the tfrecords.""")
+tf.app.flags.DEFINE_integer('cache_budget_mb', 4096,
+                            """The maximum size (MB) of the decoded examples to 
+                            keep in memory.""")
+tf.app.flags.DEFINE_string('cache_dir', None,
+                           """The dir for spilling the decoded examples to a 
+                           local cache file if they exceed the budget. If not 
+                           set, such datasets will not be cached.""")
+tf.app.flags.DEFINE_boolean('bucket_by_size', False,
+                            """Group examples of similar sizes into the same 
+                            batch and pad each batch only to its own maximum 
+                            number of rows per k-body term. Only energy 
+                            training is supported.""")
+tf.app.flags.DEFINE_integer('num_buckets', 8,
+                            """The number of size buckets.""")
+tf.app.flags.DEFINE_integer('num_parallel_calls', 0,
+                            """The number of batches to decode in parallel. 
+                            Set this to 0 to let TensorFlow autotune it.""")
+tf.app.flags.DEFINE_float('view_test_size', 0.2,
+                          """The proportion of the test view of an indexed 
+                          store.""")
+tf.app.flags.DEFINE_integer('num_folds', 0,
+                            """The number of cross-validation folds of an 
+                            indexed store. If larger than 1, the test view will 
+                            be the fold `fold` and `view_test_size` will be 
+                            ignored.""")
+tf.app.flags.DEFINE_integer('fold', 0,
+                            """The index of the test fold of an indexed 
+                            store.""")
+tf.app.flags.DEFINE_boolean('save_input_state', False,
+                            """Save the state of the training input iterator 
+                            (epoch, shard, offset, shuffle buffer and seed) in 
+                            checkpoints so that a restarted training resumes 
+                            the data stream where it stopped. The buffered 
+                            records are saved too, so each checkpoint grows by 
+                            about `shuffle_buffer_size` records.""")
 
 FLAGS = tf.app.flags.FLAGS
 
+# `AUTOTUNE` lets tf.data choose the parallelism and the prefetch buffer size
+# dynamically. It is not available in old versions of TensorFlow.
+try:
+  _AUTOTUNE = tf.data.experimental.AUTOTUNE
+  _unbatch = tf.data.experimental.unbatch
+  _group_by_window = tf.data.experimental.group_by_window
+  _make_saveable = tf.data.experimental.make_saveable_from_iterator
+except AttributeError:
+  _AUTOTUNE = getattr(tf.contrib.data, 'AUTOTUNE', None)
+  _unbatch = tf.contrib.data.unbatch
+  _group_by_window = tf.contrib.data.group_by_window
+  _make_saveable = getattr(tf.contrib.data, 'make_saveable_from_iterator', None)
+
 
 def get_filenames(train=True, dataset_name=None):
   """
@@ -65,6 +129,66 @@ def get_filenames(train=True, dataset_name=None):
     return records['test']
 
 
+def get_indexed_filenames(dataset_name=None):
+  """
+  Return the data file and the config file of the indexed store of a dataset.
+  An indexed store contains all examples and the train, test and fold views are
+  selected by `get_view_indices`.
+  """
+  name = dataset_name or FLAGS.dataset
+  return (join(FLAGS.binary_dir, "{}-all.tfrecords".format(name)),
+          join(FLAGS.binary_dir, "{}-all.json".format(name)))
+
+
+def get_view_indices(num_examples, for_training=True):
+  """
+  Return the row indices of a view of an indexed store.
+
+  Args:
+    num_examples: an `int` as the total number of examples of the store.
+    for_training: a `bool` selecting between the training (True) and validation
+      (False) view.
+
+  Returns:
+    indices: a sorted `int64` array as the row indices of the view.
+
+  """
+  indices = np.arange(num_examples, dtype=np.int64)
+  if FLAGS.num_folds > 1:
+    if not 0 <= FLAGS.fold < FLAGS.num_folds:
+      raise ValueError("`fold` should be in [0, {}).".format(FLAGS.num_folds))
+    kfold = KFold(n_splits=FLAGS.num_folds, shuffle=True, random_state=SEED)
+    train, test = list(kfold.split(indices))[FLAGS.fold]
+  else:
+    train, test = train_test_split(
+      indices,
+      test_size=min(max(FLAGS.view_test_size, 0.0), 1.0),
+      random_state=SEED)
+  return np.sort(train if for_training else test)
+
+
+def get_view_one_body_weights(store_dir, configs, indices):
+  """
+  Fit the one-body weights of a view from the cached stoichiometry counts.
+
+  Args:
+    store_dir: a `str` as the dir of the indexed store.
+    configs: a `dict` as the configs of the indexed store.
+    indices: a 1D `int64` array as the row indices of the view.
+
+  Returns:
+    weights: a `List[float]` as the initial one-body weights.
+
+  """
+  arrays = open_store(store_dir, ("counts", "energy"))
+  counts = np.asarray(arrays["counts"][indices])
+  # The energies are saved as the negative total energies.
+  energies = -np.asarray(arrays["energy"][indices], dtype=np.float64).ravel()
+  calculator = OneBodyCalculator.from_counts(
+    configs["atom_types"], counts, energies, **configs["one_body_kwargs"])
+  return [float(x) for x in calculator.compute()]
+
+
 """
 These namedtuples are just used to manage the decoded example.
 """
@@ -87,6 +211,194 @@ ForcesExample = namedtuple("ForcesExample", (
   "indexing"
 ))
 
+BucketedExample = namedtuple("BucketedExample", (
+  "features",
+  "energy",
+  "occurs",
+  "weights",
+  "y_weight",
+  "split_dims",
+))
+
+PositionsExample = namedtuple("PositionsExample", (
+  "positions",
+  "energy",
+  "occurs",
+  "weights",
+  "y_weight",
+  "forces",
+  "stoichiometry",
+))
+
+
+def _get_sizes_feature(split_dims):
+  """
+  Return the feature spec of the real row counts of the k-body terms. Datasets
+  built without these counts are treated as fully occupied.
+  """
+  return tf.FixedLenFeature([len(split_dims)], tf.int64,
+                            default_value=[int(x) for x in split_dims])
+
+
+def _get_forces_feature_spec():
+  """
+  Return the feature spec of the force-path fields.
+  """
+  return {
+    'coef': tf.FixedLenFeature([], tf.string),
+    'indexing': tf.FixedLenFeature([], tf.string),
+    'forces': tf.FixedLenFeature([], tf.string)
+  }
+
+
+def _get_positions_feature_spec():
+  """
+  Return the feature spec of the examples in the positions layout.
+  """
+  return {
+    'positions': tf.FixedLenFeature([], tf.string),
+    'stoichiometry': tf.FixedLenFeature([], tf.string),
+    'energy': tf.FixedLenFeature([], tf.string),
+    'occurs': tf.FixedLenFeature([], tf.string),
+    'weights': tf.FixedLenFeature([], tf.string),
+    'loss_weight': tf.FixedLenFeature([], tf.float32),
+    'forces': tf.FixedLenFeature([], tf.string)
+  }
+
+
+def _get_feature_spec(atomic_forces=False, split_dims=None, columnar=False):
+  """
+  Return the feature spec for parsing the serialized examples. The real row
+  counts of the k-body terms will also be parsed if `split_dims` is given. The
+  features are excluded if `columnar` is True because they are saved in the
+  streams of the k-body terms.
+  """
+  # Defaults are not specified since all keys are required.
+  spec = {
+    'features': tf.FixedLenFeature([], tf.string),
+    'energy': tf.FixedLenFeature([], tf.string),
+    'occurs': tf.FixedLenFeature([], tf.string),
+    'weights': tf.FixedLenFeature([], tf.string),
+    'loss_weight': tf.FixedLenFeature([], tf.float32)
+  }
+  if atomic_forces:
+    spec.update(_get_forces_feature_spec())
+  if split_dims is not None:
+    spec['sizes'] = _get_sizes_feature(split_dims)
+  if columnar:
+    del spec['features']
+  return spec
+
+
+def get_active_terms(kbody_terms, k_max=None):
+  """
+  Return the indices of the k-body terms which will be evaluated by the model.
+
+  Args:
+    kbody_terms: a `List[str]` as the k-body terms of a dataset.
+    k_max: an `int`. Only the k-body terms with k <= k_max are active. If None,
+      all terms are active.
+
+  Returns:
+    indices: a `List[int]` as the indices of the active terms.
+
+  """
+  indices = []
+  for i, kbody_term in enumerate(kbody_terms):
+    symbols = get_atoms_from_kbody_term(kbody_term.replace(",", ""))
+    k = len(symbols) - symbols.count(GHOST)
+    if k_max is None or k <= k_max:
+      indices.append(i)
+  return indices
+
+
+def _pad_native_block(block, width, ck2, num_groups=1):
+  """
+  Pad the columns of a block of the native mixed-k layout with zeros so that
+  each of its `num_groups` column groups has `ck2` columns.
+
+  Args:
+    block: a `float32` Tensor of shape `[-1, dim, num_groups * width]`.
+    width: an `int` as the native width of the k-body term.
+    ck2: an `int` as the value of C(k_max, 2).
+    num_groups: an `int` as the number of column groups.
+
+  Returns:
+    block: a `float32` Tensor of shape `[-1, dim, num_groups * ck2]`.
+
+  """
+  if width == ck2:
+    return block
+  dim = block.get_shape().as_list()[1]
+  block = tf.reshape(block, [-1, dim, num_groups, width])
+  block = tf.pad(block, [[0, 0], [0, 0], [0, 0], [0, ck2 - width]])
+  return tf.reshape(block, [-1, dim, num_groups * ck2])
+
+
+def unpack_native(tensor, kbody_dims, widths, ck2, num_groups=1):
+  """
+  Unpack a batched field saved in the native mixed-k layout (see
+  `transformer.pack_native`) to the dense fixed-length layout. The native layout
+  is only a storage format: the models and the force `indexing` always work on
+  the dense layout.
+
+  Args:
+    tensor: a `float32` Tensor of shape
+      `[-1, sum(kbody_dims * widths) * num_groups]`.
+    kbody_dims: a `List[int]` as the row counts of all k-body terms.
+    widths: a `List[int]` as the native widths of all k-body terms.
+    ck2: an `int` as the value of C(k_max, 2).
+    num_groups: an `int` as the number of column groups. This should be 1 for
+      the features and 6 for the coefficients matrix.
+
+  Returns:
+    dense: a `float32` Tensor of shape `[-1, sum(kbody_dims), num_groups * ck2]`.
+
+  """
+  with tf.name_scope("Unpack"):
+    sizes = [dim * width * num_groups for dim, width in zip(kbody_dims, widths)]
+    tensor.set_shape([None, sum(sizes)])
+    blocks = tf.split(tensor, sizes, axis=1)
+    columns = []
+    for i, block in enumerate(blocks):
+      block = tf.reshape(block, [-1, kbody_dims[i], num_groups * widths[i]])
+      columns.append(_pad_native_block(block, widths[i], ck2, num_groups))
+    return tf.concat(columns, axis=1)
+
+
+def assemble_features(blocks, kbody_dims, ck2, batch_size, widths=None):
+  """
+  Assemble the batched feature matrix from the blocks of the k-body terms. The
+  blocks of the inactive terms are filled with zeros. Their networks are gated
+  off so the energies and the gradients are not affected.
+
+  Args:
+    blocks: a `Dict[int, tf.Tensor]` as the feature blocks of the active terms.
+      Each block should be a `float32` Tensor of shape `[-1, kbody_dims[i],
+      ck2]` or `[-1, kbody_dims[i], widths[i]]` if `widths` is given.
+    kbody_dims: a `List[int]` as the row counts of all k-body terms.
+    ck2: an `int` as the value of C(k,2).
+    batch_size: a 0D `int32` Tensor as the batch size.
+    widths: a `List[int]` as the native widths of all k-body terms or None.
+
+  Returns:
+    features: a `float32` Tensor of shape `[-1, 1, sum(kbody_dims), ck2]`.
+
+  """
+  with tf.name_scope("Assemble"):
+    columns = []
+    for i, dim in enumerate(kbody_dims):
+      if i in blocks and widths is not None:
+        columns.append(_pad_native_block(blocks[i], widths[i], ck2))
+      elif i in blocks:
+        columns.append(blocks[i])
+      else:
+        columns.append(tf.zeros(tf.stack([batch_size, dim, ck2]),
+                                dtype=tf.float32))
+    features = tf.concat(columns, axis=1)
+    features.set_shape([None, sum(kbody_dims), ck2])
+    return tf.expand_dims(features, axis=1)
+
 
 def decode_protobuf(example_proto, cnk=None, ck2=None, num_atom_types=None,
                     atomic_forces=False, num_f_components=None,
@@ -111,30 +423,9 @@ def decode_protobuf(example_proto, cnk=None, ck2=None, num_atom_types=None,
     example: a decoded `TFExample` from the TFRecord file.
 
   """
-  if not atomic_forces:
-    example = tf.parse_single_example(
-      example_proto,
-      # Defaults are not specified since both keys are required.
-      features={
-        'features': tf.FixedLenFeature([], tf.string),
-        'energy': tf.FixedLenFeature([], tf.string),
-        'occurs': tf.FixedLenFeature([], tf.string),
-        'weights': tf.FixedLenFeature([], tf.string),
-        'loss_weight': tf.FixedLenFeature([], tf.float32)
-      })
-  else:
-    example = tf.parse_single_example(
-      example_proto,
-      features={
-        'features': tf.FixedLenFeature([], tf.string),
-        'energy': tf.FixedLenFeature([], tf.string),
-        'occurs': tf.FixedLenFeature([], tf.string),
-        'weights': tf.FixedLenFeature([], tf.string),
-        'loss_weight': tf.FixedLenFeature([], tf.float32),
-        'coef': tf.FixedLenFeature([], tf.string),
-        'indexing': tf.FixedLenFeature([], tf.string),
-        'forces': tf.FixedLenFeature([], tf.string)
-      })
+  example = tf.parse_single_example(
+    example_proto, features=_get_feature_spec(atomic_forces))
+  if atomic_forces:
     assert num_f_components > 0 and num_entries > 0
 
   features = tf.decode_raw(example['features'], tf.float32)
@@ -184,6 +475,390 @@ def decode_protobuf(example_proto, cnk=None, ck2=None, num_atom_types=None,
                          y_weight=y_weight)
 
 
+def decode_protobuf_batch(batch_proto, cnk=None, ck2=None, num_atom_types=None,
+                          atomic_forces=False, num_f_components=None,
+                          num_entries=None, split_dims=None,
+                          forces_proto=None, term_protos=None, kbody_dims=None,
+                          widths=None):
+  """
+  Decode a batch of protobufs into a tuple of batched tensors. This is the
+  vectorized version of `decode_protobuf`: all examples are parsed by a single
+  `tf.parse_example` and each field is decoded by a single `tf.decode_raw`, so
+  the number of ops is independent of the batch size.
+
+  Args:
+    batch_proto: a 1D string Tensor of serialized Examples.
+    cnk: an `int` as the value of C(N,k).
+    ck2: an `int` as the value of C(k,2).
+    num_atom_types: an `int` as the number of atom types.
+    atomic_forces: a `bool` indicating whether atomic forces should be included
+      or not.
+    num_f_components: an `int` as the maximum number of force components. This
+      must be set if `atomic_forces` is True.
+    num_entries: an `int` as the number of entries per each force component.
+      This must be set if `atomic_forces` is True.
+    split_dims: a `List[int]` as the dims of the k-body terms. If given, a
+      `BucketedExample` will be returned and its `split_dims` will be the real
+      row counts of shape `[-1, len(split_dims)]`. Only energy examples are
+      supported.
+    forces_proto: a 1D string Tensor of the serialized force-path fields if they
+      are saved in a separate stream. This must be aligned with `batch_proto`.
+    term_protos: a `Dict[int, tf.Tensor]` as the serialized features of the
+      active k-body terms in the columnar layout. The features of the other
+      terms will be zeros. This must be aligned with `batch_proto`.
+    kbody_dims: a `List[int]` as the row counts of all k-body terms. This must
+      be set if `term_protos` or `widths` is given.
+    widths: a `List[int]` as the native widths of all k-body terms if the
+      features and the coefficients are saved in the native mixed-k layout.
+      They will be unpacked to the dense layout.
+
+  Returns:
+    example: a decoded `EnergyExample`, `ForcesExample` or `BucketedExample`
+      whose tensors have the same shapes as the batched outputs of
+      `decode_protobuf`.
+
+  """
+  columnar = term_protos is not None
+  if forces_proto is not None:
+    example = tf.parse_example(
+      batch_proto, features=_get_feature_spec(False, split_dims, columnar))
+    example.update(tf.parse_example(
+      forces_proto, features=_get_forces_feature_spec()))
+  else:
+    example = tf.parse_example(
+      batch_proto,
+      features=_get_feature_spec(atomic_forces, split_dims, columnar))
+  if atomic_forces:
+    assert num_f_components > 0 and num_entries > 0
+    assert split_dims is None
+
+  energy = tf.decode_raw(example['energy'], tf.float64)
+  energy.set_shape([None, 1])
+  energy = tf.reshape(energy, [-1])
+
+  if columnar:
+    blocks = {}
+    for i, term_proto in term_protos.items():
+      block = tf.parse_example(
+        term_proto,
+        features={'features': tf.FixedLenFeature([], tf.string)})['features']
+      block = tf.decode_raw(block, tf.float32)
+      width = ck2 if widths is None else widths[i]
+      block.set_shape([None, kbody_dims[i] * width])
+      blocks[i] = tf.reshape(block, [-1, kbody_dims[i], width])
+    features = assemble_features(
+      blocks, kbody_dims, ck2, batch_size=tf.shape(energy)[0], widths=widths)
+  elif widths is not None:
+    features = tf.decode_raw(example['features'], tf.float32)
+    features = tf.expand_dims(
+      unpack_native(features, kbody_dims, widths, ck2), axis=1)
+  else:
+    features = tf.decode_raw(example['features'], tf.float32)
+    features.set_shape([None, cnk * ck2])
+    features = tf.reshape(features, [-1, 1, cnk, ck2])
+
+  occurs = tf.decode_raw(example['occurs'], tf.float32)
+  occurs.set_shape([None, num_atom_types])
+  occurs = tf.reshape(occurs, [-1, 1, 1, num_atom_types])
+
+  weights = tf.decode_raw(example['weights'], tf.float32)
+  weights.set_shape([None, cnk])
+  weights = tf.reshape(weights, [-1, 1, cnk, 1])
+
+  y_weight = tf.cast(example['loss_weight'], tf.float32)
+
+  if atomic_forces:
+    coef = tf.decode_raw(example['coef'], tf.float32)
+    if widths is not None:
+      coef = unpack_native(coef, kbody_dims, widths, ck2, num_groups=6)
+    else:
+      coef.set_shape([None, cnk * ck2 * 6])
+      coef = tf.reshape(coef, [-1, cnk, ck2 * 6])
+
+    indexing = tf.decode_raw(example['indexing'], tf.int32)
+    indexing.set_shape([None, num_f_components * num_entries])
+    indexing = tf.reshape(indexing, [-1, num_f_components, num_entries])
+
+    forces = tf.decode_raw(example['forces'], tf.float64)
+    forces.set_shape([None, num_f_components])
+
+    return ForcesExample(features=features,
+                         energy=energy,
+                         occurs=occurs,
+                         weights=weights,
+                         y_weight=y_weight,
+                         forces=forces,
+                         coef=coef,
+                         indexing=indexing)
+
+  elif split_dims is not None:
+    return BucketedExample(features=features,
+                           energy=energy,
+                           occurs=occurs,
+                           weights=weights,
+                           y_weight=y_weight,
+                           split_dims=example['sizes'])
+
+  else:
+    return EnergyExample(features=features,
+                         energy=energy,
+                         occurs=occurs,
+                         weights=weights,
+                         y_weight=y_weight)
+
+
+def decode_positions_batch(batch_proto, cnk=None, num_atom_types=None,
+                           num_f_components=None):
+  """
+  Decode a batch of protobufs in the positions layout.
+
+  Args:
+    batch_proto: a 1D string Tensor of serialized Examples.
+    cnk: an `int` as the value of C(N,k).
+    num_atom_types: an `int` as the number of atom types.
+    num_f_components: an `int` as the maximum number of force components.
+
+  Returns:
+    example: a decoded `PositionsExample`.
+
+  """
+  example = tf.parse_example(
+    batch_proto, features=_get_positions_feature_spec())
+
+  positions = tf.decode_raw(example['positions'], tf.float64)
+  positions.set_shape([None, num_f_components])
+  positions = tf.reshape(
+    tf.cast(positions, tf.float32), [-1, num_f_components // 3, 3])
+
+  stoichiometry = tf.decode_raw(example['stoichiometry'], tf.int64)
+  stoichiometry.set_shape([None, 1])
+
+  energy = tf.decode_raw(example['energy'], tf.float64)
+  energy.set_shape([None, 1])
+
+  occurs = tf.decode_raw(example['occurs'], tf.float32)
+  occurs.set_shape([None, num_atom_types])
+
+  weights = tf.decode_raw(example['weights'], tf.float32)
+  weights.set_shape([None, cnk])
+
+  forces = tf.decode_raw(example['forces'], tf.float64)
+  forces.set_shape([None, num_f_components])
+
+  return PositionsExample(
+    positions=positions,
+    energy=tf.reshape(energy, [-1]),
+    occurs=tf.reshape(occurs, [-1, 1, 1, num_atom_types]),
+    weights=tf.reshape(weights, [-1, 1, cnk, 1]),
+    y_weight=tf.cast(example['loss_weight'], tf.float32),
+    forces=forces,
+    stoichiometry=tf.reshape(stoichiometry, [-1]))
+
+
+def get_store_decode_fn(arrays, cnk=None, ck2=None, num_atom_types=None,
+                        atomic_forces=False, num_f_components=None,
+                        num_entries=None, split_dims=None, kbody_dims=None,
+                        positions=False, widths=None):
+  """
+  Return a function which slices a batch from the memory-mapped arrays of a
+  NumPy feature store given a 1D `int64` Tensor of example indices. The
+  returned tensors have the same shapes as the outputs of
+  `decode_protobuf_batch` or `decode_positions_batch`.
+
+  In the columnar layout only the term fields found in `arrays` are sliced and
+  the features of the other terms will be zeros.
+
+  Args:
+    arrays: a `dict` of memory-mapped arrays returned by `store.open_store`.
+    cnk: an `int` as the value of C(N,k).
+    ck2: an `int` as the value of C(k,2).
+    num_atom_types: an `int` as the number of atom types.
+    atomic_forces: a `bool` indicating whether atomic forces should be included
+      or not.
+    num_f_components: an `int` as the maximum number of force components.
+    num_entries: an `int` as the number of entries per each force component.
+    split_dims: a `List[int]` as the dims of the k-body terms. If given, a
+      `BucketedExample` will be returned.
+    kbody_dims: a `List[int]` as the row counts of all k-body terms. This must
+      be set for stores in the columnar layout.
+    positions: a `bool` indicating whether the store is in the positions layout
+      or not. If True, `PositionsExample` will be returned.
+    widths: a `List[int]` as the native widths of all k-body terms if the store
+      is in the native mixed-k layout.
+
+  Returns:
+    decode_fn: a `Callable`.
+
+  """
+  fields = [field for field in ENERGY_FIELDS if field in arrays]
+  columnar = 'features' not in arrays and not positions
+  if columnar:
+    terms = [i for i in range(len(kbody_dims))
+             if get_term_field(i) in arrays]
+    fields += [get_term_field(i) for i in terms]
+  if positions:
+    fields += list(POSITIONS_FIELDS) + ['forces']
+  elif atomic_forces:
+    fields += list(FORCES_FIELDS)
+
+  def _slice(indices):
+    """
+    Slice the batch. Contiguous indices are read as a single slice of the
+    memory maps and the other indices are sorted so that the reads are
+    sequential. Fancy indexing copies the rows once here, and `tf.py_func`
+    always copies the returned arrays into new tensors, so each batch is copied
+    once (contiguous) or twice (shuffled) from the page cache. This is still
+    cheaper than the tfrecords path, which copies the serialized records and
+    then parses and decodes them.
+    """
+    indices = np.sort(indices)
+    if len(indices) > 0 and indices[-1] - indices[0] + 1 == len(indices):
+      selection = slice(indices[0], indices[-1] + 1)
+    else:
+      selection = indices
+    return [np.asarray(arrays[field][selection]) for field in fields]
+
+  def _decode(indices):
+    """
+    The decode function.
+    """
+    with tf.name_scope("Slice"):
+      tensors = tf.py_func(
+        _slice, [indices],
+        [tf.as_dtype(arrays[field].dtype) for field in fields],
+        stateful=False)
+      batch = dict(zip(fields, tensors))
+      energy = tf.reshape(batch['energy'], [-1])
+      if positions:
+        return PositionsExample(
+          positions=tf.reshape(tf.cast(batch['positions'], tf.float32),
+                               [-1, num_f_components // 3, 3]),
+          energy=energy,
+          occurs=tf.reshape(batch['occurs'], [-1, 1, 1, num_atom_types]),
+          weights=tf.reshape(batch['weights'], [-1, 1, cnk, 1]),
+          y_weight=tf.reshape(batch['loss_weight'], [-1]),
+          forces=tf.reshape(batch['forces'], [-1, num_f_components]),
+          stoichiometry=tf.reshape(batch['stoichiometry'], [-1]))
+      if columnar:
+        features = assemble_features(
+          {i: tf.reshape(batch[get_term_field(i)],
+                         [-1, kbody_dims[i], ck2 if widths is None
+                          else widths[i]])
+           for i in terms},
+          kbody_dims, ck2, batch_size=tf.shape(energy)[0], widths=widths)
+      elif widths is not None:
+        features = tf.expand_dims(
+          unpack_native(batch['features'], kbody_dims, widths, ck2), axis=1)
+      else:
+        features = tf.reshape(batch['features'], [-1, 1, cnk, ck2])
+      occurs = tf.reshape(batch['occurs'], [-1, 1, 1, num_atom_types])
+      weights = tf.reshape(batch['weights'], [-1, 1, cnk, 1])
+      y_weight = tf.reshape(batch['loss_weight'], [-1])
+      if atomic_forces:
+        if widths is not None:
+          coef = unpack_native(
+            batch['coef'], kbody_dims, widths, ck2, num_groups=6)
+        else:
+          coef = tf.reshape(batch['coef'], [-1, cnk, ck2 * 6])
+        return ForcesExample(
+          features=features,
+          energy=energy,
+          occurs=occurs,
+          weights=weights,
+          y_weight=y_weight,
+          forces=tf.reshape(batch['forces'], [-1, num_f_components]),
+          coef=coef,
+          indexing=tf.reshape(
+            batch['indexing'], [-1, num_f_components, num_entries]))
+      elif split_dims is not None:
+        return BucketedExample(
+          features=features,
+          energy=energy,
+          occurs=occurs,
+          weights=weights,
+          y_weight=y_weight,
+          split_dims=tf.reshape(batch['sizes'], [-1, len(split_dims)]))
+      else:
+        return EnergyExample(features=features,
+                             energy=energy,
+                             occurs=occurs,
+                             weights=weights,
+                             y_weight=y_weight)
+
+  return _decode
+
+
+def get_bucket_id(sizes, total_dim, num_buckets):
+  """
+  Return the bucket id of an example given the real row counts of its k-body
+  terms. The buckets evenly divide the range of the total number of rows.
+
+  Args:
+    sizes: a 1D `int64` Tensor as the real row counts of the k-body terms.
+    total_dim: an `int` as the total number of rows of the fixed-length inputs.
+    num_buckets: an `int` as the number of buckets.
+
+  Returns:
+    bucket_id: a scalar `int64` Tensor.
+
+  """
+  with tf.name_scope("BucketId"):
+    bucket_id = tf.reduce_sum(sizes) * num_buckets // (total_dim + 1)
+    return tf.minimum(bucket_id, num_buckets - 1)
+
+
+def trim_batch(batch, split_dims):
+  """
+  Remove the zero paddings of a batch. Each k-body block is trimmed to the
+  maximum real row count of this batch. The removed rows all have zero binary
+  weights so the predicted energies are not affected.
+
+  Args:
+    batch: a `BucketedExample` whose `split_dims` are the real row counts of
+      shape `[-1, len(split_dims)]`.
+    split_dims: a `List[int]` as the full dims of the k-body terms.
+
+  Returns:
+    batch: a `BucketedExample` whose `split_dims` is a 1D `int64` Tensor as the
+      dims of the trimmed k-body blocks.
+
+  """
+  with tf.name_scope("Trim"):
+    # Keep at least one row for each k-body term so that every k-body network
+    # always has a valid input.
+    max_sizes = tf.maximum(tf.reduce_max(batch.split_dims, axis=0), 1)
+    max_sizes = tf.cast(max_sizes, tf.int32, name="max_sizes")
+    offsets = np.cumsum([0] + list(split_dims[:-1])).tolist()
+    indices = tf.concat(
+      [tf.range(offsets[i], offsets[i] + max_sizes[i])
+       for i in range(len(split_dims))], axis=0, name="indices")
+    features = tf.gather(batch.features, indices, axis=2, name="features")
+    weights = tf.gather(batch.weights, indices, axis=2, name="weights")
+    return BucketedExample(features=features,
+                           energy=batch.energy,
+                           occurs=batch.occurs,
+                           weights=weights,
+                           y_weight=batch.y_weight,
+                           split_dims=tf.cast(max_sizes, tf.int64))
+
+
+def get_num_parallel_calls():
+  """
+  Return the number of batches to decode in parallel. `AUTOTUNE` will be used
+  if the flag `num_parallel_calls` is not positive.
+  """
+  if FLAGS.num_parallel_calls > 0:
+    return FLAGS.num_parallel_calls
+  elif _AUTOTUNE is not None:
+    return _AUTOTUNE
+  else:
+    return cpu_count()
+
+
+# The views of the indexed stores.
+_views = {}
+
+
 def get_configs(for_training=True, dataset_name=None):
   """
   Return the configs for inputs.
@@ -194,12 +869,109 @@ def get_configs(for_training=True, dataset_name=None):
     dataset_name: a `str` as the name of the dataset.
 
   Returns:
-    configs: a `dict` of configs.
+    configs: a `dict` of configs. For an indexed store these are the configs of
+      the selected view: 'view_indices' gives the rows of the view.
 
   """
-  _, json_file = get_filenames(train=for_training, dataset_name=dataset_name)
+  tfrecords_file, json_file = get_indexed_filenames(dataset_name)
+  if not isfile(json_file):
+    _, json_file = get_filenames(train=for_training, dataset_name=dataset_name)
   with open(json_file) as f:
-    return dict(json.load(f))
+    configs = dict(json.load(f))
+  if not configs.get("indexed", False):
+    return configs
+
+  # Apply the view to the indexed store. The one-body weights are always fitted
+  # on the training view.
+  key = (json_file, for_training, FLAGS.view_test_size, FLAGS.num_folds,
+         FLAGS.fold)
+  if key not in _views:
+    store_dir = get_store_dir(tfrecords_file)
+    lookup_indices = configs["lookup_indices"]
+    indices = get_view_indices(len(lookup_indices), for_training)
+    weights = get_view_one_body_weights(
+      store_dir, configs, get_view_indices(len(lookup_indices), True))
+    _views[key] = {
+      "view_indices": [int(i) for i in indices],
+      "lookup_indices": [lookup_indices[i] for i in indices],
+      "initial_one_body_weights": weights,
+    }
+  configs.update(_views[key])
+  return configs
+
+
+
+def get_shard_filenames(tfrecords_file, configs):
+  """
+  Return the shard files of a dataset.
+
+  Args:
+    tfrecords_file: a `str` as the tfrecords file of the dataset.
+    configs: a `dict` as the configs of the dataset.
+
+  Returns:
+    filenames: a `List[str]` as the shard files. Datasets built before sharding
+      was supported have only one shard: `tfrecords_file`.
+
+  """
+  shards = configs.get("shards")
+  if not shards:
+    return [tfrecords_file]
+  return [join(dirname(tfrecords_file), shard) for shard in shards]
+
+
+def get_forces_shard_filenames(tfrecords_file, configs):
+  """
+  Return the shard files of the force-path fields of a dataset.
+
+  Args:
+    tfrecords_file: a `str` as the tfrecords file of the dataset.
+    configs: a `dict` as the configs of the dataset.
+
+  Returns:
+    filenames: a `List[str]` aligned with `get_shard_filenames` or None if the
+      force-path fields are saved together with the energy-path fields.
+
+  """
+  if "forces_shards" not in configs:
+    return None
+  shards = configs["forces_shards"]
+  if not shards:
+    return [get_forces_filename(tfrecords_file)]
+  return [join(dirname(tfrecords_file), shard) for shard in shards]
+
+
+def get_position_tables(dataset_name, for_training=True):
+  """
+  Return the per-stoichiometry pair tables of a dataset in the positions
+  layout. The `stoichiometry` of each example is the index into these tables.
+
+  Args:
+    dataset_name: a `str` as the name of the dataset.
+    for_training: a `bool` selecting between the training (True) and validation
+      (False) data.
+
+  Returns:
+    pairs: an `int32` array of shape `[num_stoichiometries, D, C(k, 2), 2]`.
+    units: a `float32` array of shape `[num_stoichiometries, D, C(k, 2)]`.
+
+  """
+  tfrecords_file, json_file = get_indexed_filenames(dataset_name)
+  if not isfile(json_file):
+    tfrecords_file, _ = get_filenames(for_training, dataset_name=dataset_name)
+  tables = np.load(get_pairs_filename(tfrecords_file))
+  return tables["pairs"], tables["units"]
+
+
+def get_compression_type(configs):
+  """
+  Return the compression type ('GZIP' or 'ZLIB') of the tfrecords files or None
+  if they are not compressed.
+  """
+  compression = configs.get("compression")
+  if not compression or compression.upper() == "NONE":
+    return None
+  return compression.upper()
 
 
 def get_dataset_size(dataset_name, for_training=True):
@@ -218,8 +990,111 @@ def get_dataset_size(dataset_name, for_training=True):
   return len(get_configs(for_training, dataset_name)['lookup_indices'])
 
 
+def get_decoded_example_size(configs, atomic_forces=False):
+  """
+  Return the number of bytes of a decoded example.
+
+  Args:
+    configs: a `dict` as the configs of the dataset.
+    atomic_forces: a `bool` indicating whether atomic forces are included.
+
+  Returns:
+    nbytes: an `int` as the size of a decoded example.
+
+  """
+  cnk, ck2 = configs["shape"][:2]
+  if configs.get("positions", False):
+    num_f_components = configs["indexing_shape"][0]
+    # positions, stoichiometry, energy, occurs, weights, loss_weight and forces
+    return num_f_components * 4 + 8 + 8 + configs["num_atom_types"] * 4 + \
+           cnk * 4 + 4 + num_f_components * 8
+  # features, energy, occurs, weights and loss_weight
+  nbytes = cnk * ck2 * 4 + 8 + configs["num_atom_types"] * 4 + cnk * 4 + 4
+  if atomic_forces:
+    num_f_components, num_entries = configs["indexing_shape"]
+    # coef, indexing and forces
+    nbytes += cnk * ck2 * 6 * 4 + num_f_components * num_entries * 4
+    nbytes += num_f_components * 8
+  return nbytes
+
+
+def get_cache_filename(dataset_name, for_training, configs, k_max=None,
+                       num_examples=None):
+  """
+  Return the cache filename for `tf.data.Dataset.cache`.
+
+  Args:
+    dataset_name: a `str` as the name of the dataset.
+    for_training: a `bool` selecting between the training (True) and validation
+      (False) data.
+    configs: a `dict` as the configs of the dataset.
+    k_max: an `int` as the maximum k of the active terms. This only matters for
+      datasets in the columnar layout.
+    num_examples: an `int` as the number of leading examples to cache. If None,
+      all examples will be cached.
+
+  Returns:
+    filename: a `str`. An empty string means caching in memory. None will be
+      returned if caching is disabled or the decoded examples exceed the budget
+      and `cache_dir` is not set.
+
+  """
+  if not FLAGS.cache:
+    return None
+  num_cached = len(configs["lookup_indices"])
+  if num_examples is not None:
+    num_cached = min(num_cached, num_examples)
+  nbytes = num_cached * get_decoded_example_size(
+    configs, atomic_forces=FLAGS.forces)
+  if nbytes <= FLAGS.cache_budget_mb * 1024 ** 2:
+    return ""
+  if FLAGS.cache_dir:
+    if not isdir(FLAGS.cache_dir):
+      makedirs(FLAGS.cache_dir)
+    # The inactive terms of a columnar dataset are cached as zeros.
+    if configs.get("columnar", False) and k_max is not None:
+      suffix = "-k{}".format(k_max)
+    else:
+      suffix = ""
+    if num_examples is not None:
+      suffix += "-n{}".format(num_examples)
+    return join(FLAGS.cache_dir, "{}-{}{}{}.cache".format(
+      dataset_name, "train" if for_training else "test",
+      "-forces" if FLAGS.forces else "", suffix))
+  tf.logging.warning(
+    "The decoded examples ({:.1f} MB) exceed the cache budget. Set "
+    "`cache_dir` to spill them to a local file.".format(nbytes / 1024 ** 2))
+  return None
+
+
+def get_input_saveables(checkpoint=None):
+  """
+  Return the saveable objects of the training input iterator.
+
+  Args:
+    checkpoint: a `str` as the checkpoint to restore. If given and it does not
+      contain the iterator state (e.g. it was saved before the state was
+      checkpointed), an empty list will be returned so that the variables can
+      still be restored.
+
+  Returns:
+    saveables: a `List[SaveableObject]`.
+
+  """
+  saveables = tf.get_collection(KcnnGraphKeys.INPUT_STATE)
+  if checkpoint and saveables:
+    names = set(name for name, _ in tf.train.list_variables(checkpoint))
+    for saveable in saveables:
+      if any(spec.name not in names for spec in saveable.specs):
+        tf.logging.warning(
+          "{} has no input iterator state. The data stream will restart from "
+          "the beginning.".format(checkpoint))
+        return []
+  return saveables
+
+
 def next_batch(dataset_name, for_training=True, batch_size=50, num_epochs=None,
-               shuffle=True):
+               shuffle=True, k_max=None, saveable=False, num_examples=None):
   """
   Provide batched inputs for kCON.
 
@@ -230,9 +1105,21 @@ def next_batch(dataset_name, for_training=True, batch_size=50, num_epochs=None,
     batch_size: an `int` as the number of examples per batch.
     num_epochs: an `int` as the maximum number of epochs to run.
     shuffle: a `bool` indicating whether the batches shall be shuffled or not.
+    k_max: an `int`. For datasets in the columnar layout only the features of
+      the k-body terms with k <= k_max are read. The features of the other
+      terms are zeros. If None, all terms are read.
+    saveable: a `bool`. If True and `save_input_state` is enabled, the state of
+      the iterator will be added to the collection `KcnnGraphKeys.INPUT_STATE`.
+      See `get_input_saveables`.
+    num_examples: an `int`. If set, only the first `num_examples` examples are
+      read and each epoch is batched separately, so every
+      `ceil(num_examples / batch_size)` batches cover exactly the same
+      examples. Bucketing is disabled in this case.
 
   Returns:
-    next_batch: a tuple of Tensors.
+    next_batch: a tuple of Tensors. If `bucket_by_size` is enabled, this will be
+      a `BucketedExample` whose `split_dims` should be used to split the
+      trimmed inputs.
 
   """
 
@@ -243,47 +1130,298 @@ def next_batch(dataset_name, for_training=True, batch_size=50, num_epochs=None,
     )
 
     configs = get_configs(for_training=for_training, dataset_name=dataset_name)
+    indexed = configs.get("indexed", False)
+    if indexed:
+      tfrecods_file, _ = get_indexed_filenames(dataset_name)
     shape = configs["shape"]
     cnk = shape[0]
     ck2 = shape[1]
     num_atom_types = configs["num_atom_types"]
-    dataset_size = get_dataset_size(dataset_name, for_training=for_training)
 
-    if FLAGS.forces:
+    # In the positions layout the features and the forces are computed in the
+    # graph so the positions and the forces are always read.
+    positions = configs.get("positions", False)
+    if FLAGS.forces or positions:
       num_f_components, num_entries = configs["indexing_shape"]
     else:
       num_f_components, num_entries = None, None
 
     # Set the number of parallel calls (threads).
-    num_parallel_calls = min(batch_size, FLAGS.num_parallel_calls)
-
-    # Initialize a basic dataset
-    dataset = tf.data.TFRecordDataset([tfrecods_file]).map(
-      partial(decode_protobuf,
-              cnk=cnk,
-              ck2=ck2,
-              num_atom_types=num_atom_types,
-              atomic_forces=FLAGS.forces,
-              num_f_components=num_f_components,
-              num_entries=num_entries),
-      num_parallel_calls=num_parallel_calls,
-    )
+    num_parallel_calls = get_num_parallel_calls()
 
-    # Repeat the dataset
-    dataset = dataset.repeat(count=num_epochs)
+    # Size-bucketed batching only supports energy examples because the force
+    # indexing matrices refer to the untrimmed feature matrices.
+    split_dims = configs["split_dims"]
+    bucketing = FLAGS.bucket_by_size
+    if bucketing and (FLAGS.forces or positions):
+      tf.logging.warning("`bucket_by_size` is ignored for forces training.")
+      bucketing = False
+    elif bucketing and num_examples is not None:
+      bucketing = False
 
-    # Shuffle it if needed
-    if shuffle:
-      min_queue_examples = int(dataset_size * 0.4) + 3 * batch_size
-      dataset = dataset.shuffle(buffer_size=min_queue_examples, seed=SEED)
+    # In the columnar layout only the features of the active k-body terms are
+    # read.
+    columnar = configs.get("columnar", False)
+    if columnar:
+      active_terms = get_active_terms(configs["kbody_terms"], k_max)
+    else:
+      active_terms = []
+
+    # The features and the coefficients of the native mixed-k layout are saved
+    # with the own widths of the k-body terms.
+    if configs.get("native", False) and not positions:
+      widths = get_kbody_widths(configs["kbody_terms"])
+    else:
+      widths = None
+
+    # The function for decoding a batch of serialized examples.
+    if positions:
+      decode_fn = partial(decode_positions_batch,
+                          cnk=cnk,
+                          num_atom_types=num_atom_types,
+                          num_f_components=num_f_components)
+    else:
+      decode_fn = partial(decode_protobuf_batch,
+                          cnk=cnk,
+                          ck2=ck2,
+                          num_atom_types=num_atom_types,
+                          atomic_forces=FLAGS.forces,
+                          num_f_components=num_f_components,
+                          num_entries=num_entries,
+                          split_dims=split_dims if bucketing else None,
+                          kbody_dims=split_dims,
+                          widths=widths)
 
-    # Setup the batch
-    dataset = dataset.batch(batch_size)
+    def _batch(dataset_, key_fn):
+      """
+      Batch the dataset. If bucketing is enabled, only examples of the same
+      size bucket will be batched together.
+      """
+      if not bucketing:
+        return dataset_.batch(batch_size)
+      return dataset_.apply(_group_by_window(
+        key_func=lambda *args: get_bucket_id(
+          key_fn(*args), cnk, FLAGS.num_buckets),
+        reduce_func=lambda _, window: window.batch(batch_size),
+        window_size=batch_size))
+
+    def _parse_sizes(example_proto):
+      """
+      Parse the real row counts of the k-body terms from a serialized example.
+      """
+      return tf.parse_single_example(
+        example_proto,
+        features={'sizes': _get_sizes_feature(split_dims)})['sizes']
+
+    filenames = get_shard_filenames(tfrecods_file, configs)
+    record_dataset = partial(tf.data.TFRecordDataset,
+                             compression_type=get_compression_type(configs))
+
+    # The force-path fields may be saved in a separate stream. Energy-only runs
+    # never read it. The features of the active k-body terms may also be saved
+    # in separate streams. All streams to read are aligned and zipped.
+    if FLAGS.forces:
+      forces_filenames = get_forces_shard_filenames(tfrecods_file, configs)
+    else:
+      forces_filenames = None
+    streams = [filenames]
+    for i in active_terms:
+      streams.append([get_term_filename(x, i) for x in filenames])
+    if forces_filenames is not None:
+      streams.append(forces_filenames)
+    streams = tuple(streams)
+
+    def read_fn(*names):
+      """
+      Read the records of the aligned streams.
+      """
+      if len(names) == 1:
+        return record_dataset(names[0])
+      return tf.data.Dataset.zip(tuple(record_dataset(x) for x in names))
+
+    def decode_records(batch_proto, *protos):
+      """
+      Decode a batch of the zipped records.
+      """
+      if positions:
+        return decode_fn(batch_proto)
+      if columnar:
+        term_protos = dict(zip(active_terms, protos[:len(active_terms)]))
+      else:
+        term_protos = None
+      if forces_filenames is not None:
+        forces_proto = protos[-1]
+      else:
+        forces_proto = None
+      return decode_fn(batch_proto, forces_proto=forces_proto,
+                       term_protos=term_protos)
+    store_format = configs.get("format", "tfrecords") == "npy"
+    if store_format:
+      # The memory-mapped arrays are already cached by the page cache.
+      cache_filename = None
+    else:
+      cache_filename = get_cache_filename(
+        dataset_name, for_training, configs, k_max=k_max,
+        num_examples=num_examples)
+
+    if store_format:
+      # Random-access shuffling of a NumPy feature store is just a permutation
+      # of the example indices. The batches are sliced from the memory-mapped
+      # arrays.
+      fields = list(ENERGY_FIELDS)
+      if columnar:
+        fields.remove('features')
+        fields += [get_term_field(i) for i in active_terms]
+      if positions:
+        fields.remove('features')
+        fields += list(POSITIONS_FIELDS) + ['forces']
+      elif FLAGS.forces:
+        fields += list(FORCES_FIELDS)
+      arrays = open_store(get_store_dir(tfrecods_file), fields)
+      if indexed:
+        indices = np.asarray(configs["view_indices"], dtype=np.int64)
+      else:
+        indices = np.arange(len(arrays['energy']), dtype=np.int64)
+      if num_examples is not None:
+        indices = indices[:num_examples]
+      if bucketing:
+        dataset = tf.data.Dataset.from_tensor_slices(
+          (indices, np.asarray(arrays['sizes'])[indices]))
+      else:
+        dataset = tf.data.Dataset.from_tensor_slices(indices)
+      if shuffle:
+        dataset = dataset.shuffle(buffer_size=len(indices), seed=SEED)
+      if num_examples is not None:
+        dataset = dataset.batch(batch_size).repeat(count=num_epochs)
+      elif bucketing:
+        dataset = dataset.repeat(count=num_epochs)
+        dataset = _batch(dataset, key_fn=lambda index, sizes: sizes)
+        dataset = dataset.map(lambda index, sizes: index)
+      else:
+        dataset = dataset.repeat(count=num_epochs)
+        dataset = dataset.batch(batch_size)
+      dataset = dataset.map(
+        get_store_decode_fn(arrays,
+                            cnk=cnk,
+                            ck2=ck2,
+                            num_atom_types=num_atom_types,
+                            atomic_forces=FLAGS.forces,
+                            num_f_components=num_f_components,
+                            num_entries=num_entries,
+                            split_dims=split_dims if bucketing else None,
+                            kbody_dims=split_dims,
+                            positions=positions,
+                            widths=widths),
+        num_parallel_calls=num_parallel_calls)
+
+    elif cache_filename is not None:
+      # Decode the whole dataset once and cache the decoded examples. The
+      # following epochs are shuffled and batched from the cache directly.
+      dataset = read_fn(*streams)
+      dataset = dataset.batch(batch_size).map(
+        decode_records, num_parallel_calls=num_parallel_calls)
+      dataset = dataset.apply(_unbatch())
+      if num_examples is not None:
+        # Only the fixed slice is cached and every epoch of it is batched in
+        # the same way.
+        dataset = dataset.take(num_examples)
+        dataset = dataset.cache(filename=cache_filename)
+        dataset = dataset.batch(batch_size).repeat(count=num_epochs)
+      else:
+        dataset = dataset.cache(filename=cache_filename)
+        dataset = dataset.repeat(count=num_epochs)
+        if shuffle:
+          dataset = dataset.shuffle(buffer_size=FLAGS.shuffle_buffer_size,
+                                    seed=SEED)
+        dataset = _batch(dataset, key_fn=lambda *example: example[-1])
+
+    else:
+      # Initialize a basic dataset of serialized examples. For sharded datasets
+      # the shard order is permuted every epoch and several shards are read
+      # concurrently. Together with the fixed-size shuffle buffer below this
+      # gives a two-level shuffle whose memory usage is independent of the
+      # dataset size.
+      if num_examples is not None:
+        dataset = read_fn(*streams).take(num_examples)
+        dataset = dataset.batch(batch_size).repeat(count=num_epochs)
+      elif shuffle and len(filenames) > 1:
+        dataset = tf.data.Dataset.from_tensor_slices(
+          streams if len(streams) > 1 else filenames)
+        dataset = dataset.shuffle(buffer_size=len(filenames), seed=SEED)
+        dataset = dataset.repeat(count=num_epochs)
+        dataset = dataset.interleave(
+          read_fn,
+          cycle_length=min(len(filenames), FLAGS.shard_cycle_length),
+          block_length=1)
+      else:
+        dataset = read_fn(*streams)
+        dataset = dataset.repeat(count=num_epochs)
+
+      # Shuffle the examples within a small buffer. Only the serialized strings
+      # are buffered here.
+      if shuffle and num_examples is None:
+        dataset = dataset.shuffle(buffer_size=FLAGS.shuffle_buffer_size,
+                                  seed=SEED)
+
+      # Batch the serialized examples first and then decode each batch at once.
+      if num_examples is None:
+        dataset = _batch(dataset, key_fn=lambda proto, *_: _parse_sizes(proto))
+      dataset = dataset.map(decode_records,
+                            num_parallel_calls=num_parallel_calls)
+
+    # Trim the zero paddings of each batch.
+    if bucketing:
+      dataset = dataset.map(partial(trim_batch, split_dims=split_dims),
+                            num_parallel_calls=num_parallel_calls)
+
+    # Overlap the decoding with the training steps.
+    dataset = dataset.prefetch(buffer_size=_AUTOTUNE or 2)
 
     tf.logging.info("The input pipeline is initialized.")
     tf.logging.info('BATCH_SIZE          = {}'.format(batch_size))
-    tf.logging.info('NUM_PARAELLEL_CALLS = {}'.format(num_parallel_calls))
+    tf.logging.info('NUM_PARAELLEL_CALLS = {}'.format(
+      'AUTOTUNE' if num_parallel_calls == _AUTOTUNE else num_parallel_calls))
     tf.logging.info('NUM_EPOCHS          = {}'.format(num_epochs))
+    if num_examples is not None:
+      tf.logging.info('NUM_EXAMPLES        = {}'.format(num_examples))
+    if store_format:
+      tf.logging.info('FORMAT              = npy')
+    if indexed:
+      tf.logging.info('VIEW                = {} ({} examples)'.format(
+        "train" if for_training else "test", len(configs["view_indices"])))
+    else:
+      tf.logging.info('NUM_SHARDS          = {}'.format(len(filenames)))
+    if forces_filenames is not None:
+      tf.logging.info('FORCES_STREAM       = separate')
+    if columnar:
+      tf.logging.info('ACTIVE_TERMS        = {}'.format(
+        " ".join(configs["kbody_terms"][i] for i in active_terms)))
+    if cache_filename is not None:
+      tf.logging.info('CACHE               = {}'.format(
+        cache_filename or 'memory'))
+    if bucketing:
+      tf.logging.info('NUM_BUCKETS         = {}'.format(FLAGS.num_buckets))
 
     iterator = dataset.make_one_shot_iterator()
+
+    # The iterator state includes the positions of the `repeat`, `interleave`
+    # and `TFRecordDataset` ops and the shuffle buffers with their random
+    # states. The `py_func` of the NumPy store and the in-memory cache can not
+    # be serialized.
+    if saveable and FLAGS.save_input_state:
+      if _make_saveable is None:
+        tf.logging.warning(
+          "The input state can not be saved with this version of TensorFlow.")
+      elif store_format or cache_filename == "":
+        tf.logging.warning(
+          "The input state can not be saved for the npy format or the "
+          "in-memory cache.")
+      else:
+        tf.add_to_collection(KcnnGraphKeys.INPUT_STATE,
+                             _make_saveable(iterator))
+        tf.logging.info('SAVE_INPUT_STATE    = True')
+        tf.logging.warning(
+          "About {} buffered records will be saved in each checkpoint.".format(
+            FLAGS.shuffle_buffer_size))
+
     return iterator.get_next()
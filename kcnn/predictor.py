@@ -7,13 +7,15 @@ from __future__ import print_function, absolute_import
 import numpy as np
 import tensorflow as tf
 import json
-from collections import Counter
+from collections import Counter, OrderedDict
 from ase import Atoms
 from ase.io.trajectory import Trajectory
 from tensorflow.core.framework import graph_pb2
 from tensorflow.python.framework import importer
 from constants import GHOST
-from save_model import get_tensors_to_restore
+from database import StructureRecord
+from save_model import get_tensors_to_restore, specialize_graph_def
+from save_model import fold_int8_weights
 from transformer import MultiTransformer, FixedLenMultiTransformer
 
 __author__ = 'Xin Chen'
@@ -51,7 +53,9 @@ class KcnnPredictor:
   An energy predictor based on the deep neural network of 'KCNN'.
   """
 
-  def __init__(self, graph_model_path, fixed=False):
+  def __init__(self, graph_model_path, fixed=False, xla_jit=False,
+               specialize=False, batch_buckets=(1, 8, 32, 128),
+               max_specialized=16):
     """
     Initialization method.
 
@@ -59,6 +63,22 @@ class KcnnPredictor:
       graph_model_path: a `str` as the freezed graph model to load.
       fixed: a `bool`. If True, a `FixedLenMultiTransformer` will be restored.
         Otherwise a `MultiTransformer` will be restored.
+      xla_jit: a `bool`. If True, the whole graph will be compiled with the XLA
+        JIT. Graphs exported with `xla_jit='scope'` always compile the ops of
+        the kCON model.
+      specialize: a `bool`. If True, each batch will be zero-padded to the
+        nearest size in `batch_buckets` and evaluated by a graph specialized
+        for its stoichiometry and batch size (see
+        `save_model.specialize_graph_def`). The specialized graphs are built on
+        the first use and cached.
+      batch_buckets: a `Tuple[int]` as the ascending static batch sizes of the
+        specialized graphs. Larger batches are split.
+      max_specialized: an `int` as the maximum number of cached specialized
+        graphs. The sessions of the least recently used graphs are closed.
+
+    Raises:
+      ValueError: if `fixed` is False but the graph is inference-optimized (see
+        `save_model.optimize_for_inference`) whose `split_dims` are constants.
 
     """
 
@@ -68,14 +88,29 @@ class KcnnPredictor:
       output_graph_def = graph_pb2.GraphDef()
       with open(graph_model_path, "rb") as f:
         output_graph_def.ParseFromString(f.read())
-        importer.import_graph_def(output_graph_def, name="")
+      # The int8 kernels of quantized graphs are dequantized only once here.
+      output_graph_def = fold_int8_weights(output_graph_def)
+      importer.import_graph_def(output_graph_def, name="")
 
     self._graph = graph
-    self._sess = tf.Session(graph=graph)
+    self._graph_def = output_graph_def
+    config = tf.ConfigProto()
+    if xla_jit:
+      config.graph_options.optimizer_options.global_jit_level = \
+        tf.OptimizerOptions.ON_1
+    self._config = config
+    self._sess = tf.Session(graph=graph, config=config)
+    self._specialize = specialize
+    self._batch_buckets = sorted(int(x) for x in batch_buckets)
+    self._specialized = OrderedDict()
+    self._max_specialized = max(int(max_specialized), 1)
     self._transformer = restore_transformer(self._graph, self._sess, fixed)
     assert isinstance(self._transformer, MultiTransformer)
 
     self._initialize_tensors()
+    if self._placeholder_split_dims is None and not fixed:
+      raise ValueError("The `split_dims` of this inference-optimized graph are "
+                       "constants. Set `fixed` to True.")
     self._y_atomic_1body = self._get_y_atomic_1body(
       self._transformer.atom_types
     )
@@ -189,7 +224,11 @@ class KcnnPredictor:
     self._placeholder_inputs = tensors["placeholders/inputs"]
     self._placeholder_occurs = tensors["placeholders/occurs"]
     self._placeholder_weights = tensors["placeholders/weights"]
-    self._placeholder_split_dims = tensors["placeholders/split_dims"]
+    # The `split_dims` of an inference-optimized graph are folded constants.
+    if tensors["placeholders/split_dims"].op.type == "Const":
+      self._placeholder_split_dims = None
+    else:
+      self._placeholder_split_dims = tensors["placeholders/split_dims"]
 
     # Tensors for predicting atomic forces
     if self._transformer.atomic_forces_enabled:
@@ -219,22 +258,24 @@ class KcnnPredictor:
     weights = self._sess.run(self._tensor_1body)
     return dict(zip(species, weights.flatten().tolist()))
 
-  def get_feed_dict(self, atoms_or_trajectory):
+  def _transform(self, atoms_or_trajectory):
     """
-    Return the feed dict for the inputs.
+    Transform the structures to the inputs of the graph.
 
     Args:
-      atoms_or_trajectory: an `ase.Atoms` or an `ase.io.TrajectoryReader` or a
-        list of `ase.Atoms` with the same stoichiometry.
+      atoms_or_trajectory: an `ase.Atoms` or a `StructureRecord` or an
+        `ase.io.TrajectoryReader` or a list of `ase.Atoms` (`StructureRecord`)
+        with the same stoichiometry.
 
     Returns:
       species: a list of `str` as the stoichiometry.
-      feed_dict: a `dict` as the feed dict to run.
+      split_dims: an `int` array as the dims of the k-body terms.
+      inputs: a `dict` of (placeholder name, batched array).
 
     """
     assert isinstance(self._transformer, MultiTransformer)
 
-    if isinstance(atoms_or_trajectory, Atoms):
+    if isinstance(atoms_or_trajectory, (Atoms, StructureRecord)):
       transform_func = self._transformer.transform
       ntotal = 1
       species = atoms_or_trajectory.get_chemical_symbols()
@@ -249,18 +290,108 @@ class KcnnPredictor:
     # The `transformed` is a named tupe: KcnnSample.
     transformed = transform_func(atoms_or_trajectory)
 
-    # Build the feed dict for running the session.
     ck2 = self._transformer.ck2
-    features = transformed.features.reshape((ntotal, 1, -1, ck2))
-    weights = transformed.binary_weights.reshape((ntotal, 1, -1, 1))
-    occurs = transformed.occurs.reshape((ntotal, 1, 1, -1))
-    split_dims = transformed.split_dims
+    inputs = {
+      "placeholders/inputs": transformed.features.reshape((ntotal, 1, -1, ck2)),
+      "placeholders/occurs": transformed.occurs.reshape((ntotal, 1, 1, -1)),
+      "placeholders/weights": transformed.binary_weights.reshape(
+        (ntotal, 1, -1, 1)),
+    }
+    return species, transformed.split_dims, inputs
+
+  @staticmethod
+  def _make_feed_dict(graph, inputs, split_dims):
+    """
+    Return the feed dict of a graph. `split_dims` is only fed if it is a
+    placeholder of the graph.
+    """
+    feed_dict = {graph.get_tensor_by_name(name + ":0"): value
+                 for name, value in inputs.items()}
+    tensor = graph.get_tensor_by_name("placeholders/split_dims:0")
+    if tensor.op.type == "Placeholder":
+      feed_dict[tensor] = split_dims
+    return feed_dict
+
+  def get_feed_dict(self, atoms_or_trajectory):
+    """
+    Return the feed dict for the inputs.
+
+    Args:
+      atoms_or_trajectory: an `ase.Atoms` or a `StructureRecord` or an
+        `ase.io.TrajectoryReader` or a list of `ase.Atoms` (`StructureRecord`)
+        with the same stoichiometry.
 
-    feed_dict = {self._placeholder_inputs: features,
-                 self._placeholder_occurs: occurs,
-                 self._placeholder_weights: weights,
-                 self._placeholder_split_dims: split_dims}
-    return species, feed_dict
+    Returns:
+      species: a list of `str` as the stoichiometry.
+      feed_dict: a `dict` as the feed dict to run.
+
+    """
+    species, split_dims, inputs = self._transform(atoms_or_trajectory)
+    return species, self._make_feed_dict(self._graph, inputs, split_dims)
+
+  def _get_specialized(self, split_dims, batch_size):
+    """
+    Return the cached graph and session specialized for the given `split_dims`
+    and batch size. Stoichiometries with the same `split_dims` (e.g. all
+    stoichiometries of a fixed-length transformer) share the graphs.
+    """
+    key = (tuple(int(x) for x in split_dims), batch_size)
+    if key in self._specialized:
+      self._specialized.move_to_end(key)
+      return self._specialized[key]
+
+    # Close the session of the least recently used graph.
+    if len(self._specialized) >= self._max_specialized:
+      _, (_, sess) = self._specialized.popitem(last=False)
+      sess.close()
+
+    graph_def = specialize_graph_def(
+      self._graph_def, split_dims, batch_size,
+      list(get_tensors_to_restore(forces=self.atomic_forces).keys()))
+    graph = tf.Graph()
+    with graph.as_default():
+      importer.import_graph_def(graph_def, name="")
+    self._specialized[key] = (graph,
+                              tf.Session(graph=graph, config=self._config))
+    return self._specialized[key]
+
+  def close(self):
+    """
+    Close the sessions of the restored graph and all specialized graphs.
+    """
+    while self._specialized:
+      _, (_, sess) = self._specialized.popitem()
+      sess.close()
+    self._sess.close()
+
+  def _run(self, fetches, split_dims, inputs):
+    """
+    Evaluate the fetches (`List[tf.Tensor]` of the restored graph) given the
+    inputs returned by `_transform`.
+    """
+    if not self._specialize:
+      return self._sess.run(
+        fetches, feed_dict=self._make_feed_dict(self._graph, inputs, split_dims))
+
+    # Pad each chunk of the batch with zeros to the nearest bucket. The zero
+    # binary weights of the padded examples mask their k-body contribs.
+    ntotal = len(inputs["placeholders/inputs"])
+    max_size = self._batch_buckets[-1]
+    results = []
+    for istart in range(0, ntotal, max_size):
+      size = min(max_size, ntotal - istart)
+      bucket = min(x for x in self._batch_buckets if x >= size)
+      graph, sess = self._get_specialized(split_dims, bucket)
+      padded = {}
+      for name, value in inputs.items():
+        value = value[istart: istart + size]
+        padded[name] = np.concatenate(
+          (value, np.zeros((bucket - size, ) + value.shape[1:], value.dtype)))
+      values = sess.run(
+        [graph.get_tensor_by_name(tensor.name) for tensor in fetches],
+        feed_dict=self._make_feed_dict(graph, padded, split_dims))
+      results.append([np.atleast_1d(value)[:size] for value in values])
+    return [np.concatenate(values) for values in zip(*results)]
 
   def predict_total_energy(self, atoms_or_trajectory):
     """
@@ -275,8 +406,8 @@ class KcnnPredictor:
       y_total: a 1D array of shape `[num_examples, ]` as the total energies.
 
     """
-    _, feed_dict = self.get_feed_dict(atoms_or_trajectory)
-    y_total = self._sess.run(self._operator_y_nn, feed_dict=feed_dict)
+    _, split_dims, inputs = self._transform(atoms_or_trajectory)
+    y_total = self._run([self._operator_y_nn], split_dims, inputs)[0]
     return np.negative(y_total)
 
   def predict(self, atoms_or_trajectory):
@@ -299,12 +430,12 @@ class KcnnPredictor:
         contribs. `D` is the total dimension.
 
     """
-    species, feed_dict = self.get_feed_dict(atoms_or_trajectory)
+    species, split_dims, inputs = self._transform(atoms_or_trajectory)
 
     # Run the operations to get the predicted energies.
-    y_total, y_kbody, y_1body = self._sess.run(
+    y_total, y_kbody, y_1body = self._run(
       [self._operator_y_nn, self._operator_y_kbody, self._operator_y_1body],
-      feed_dict=feed_dict
+      split_dims, inputs
     )
     y_1body = np.squeeze(y_1body)
 
@@ -0,0 +1,333 @@
+#!coding=utf-8
+"""
+This script is used to quantize an exported model to 8-bit and to calibrate the
+accuracy loss and the speedup on held-out data.
+
+Two modes are supported:
+
+  * 'eightbit': the graph is rewritten by the `quantize_weights` and the
+    `quantize_nodes` graph transforms, so the 1x1 convolutions of the k-body
+    networks run as `QuantizedConv2D` ops with 8-bit weights and activations.
+  * 'weights': only the convolution kernels are stored as per-channel symmetric
+    int8 and dequantized in the graph (`Cast` and `Mul`). `KcnnPredictor` folds
+    them back to float32 constants when loading (see
+    `save_model.fold_int8_weights`), so this mode only reduces the size of the
+    exported model, not the prediction time.
+
+"""
+from __future__ import print_function, absolute_import
+
+import re
+import time
+import numpy as np
+import tensorflow as tf
+import pipeline
+from predictor import restore_transformer
+from save_model import optimize_for_inference, _INFERENCE_TRANSFORMS
+from save_model import _get_output_node_names
+from tensorflow.core.framework import graph_pb2, node_def_pb2
+from tensorflow.python.framework import tensor_util
+
+__author__ = 'Xin Chen'
+__email__ = 'Bismarrck@me.com'
+
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string("frozen_graph", None,
+                           """The exported model to quantize.""")
+tf.app.flags.DEFINE_integer("num_calibration_examples", 1000,
+                            """The number of held-out examples to calibrate the
+                            quantized model.""")
+tf.app.flags.DEFINE_float("max_mae_delta", None,
+                          """The maximum allowed increase of the energy MAE.
+                          The quantized model will not be saved if the
+                          calibrated increase is larger.""")
+tf.app.flags.DEFINE_string("quantize_mode", "eightbit",
+                           """The quantization mode: 'eightbit' runs the
+                           convolutions with 8-bit ops and 'weights' only
+                           stores the kernels as int8.""")
+tf.app.flags.DEFINE_float("min_speedup", None,
+                          """The minimum speedup of the quantized model. The
+                          quantized model will not be saved if the calibrated
+                          speedup is smaller.""")
+
+
+"""
+The pattern of the names of the convolution kernels of the k-body networks.
+"""
+_KERNEL_PATTERN = re.compile(
+  r"^kCON/[^/]+/(Hidden\d+/1x1Conv\d+|k-Body)/weights$")
+
+
+def quantize_weights(weights):
+  """
+  Quantize the kernel of a 1x1 convolution to per-output-channel symmetric int8.
+
+  Args:
+    weights: a `float32` array of shape `[1, 1, C_in, C_out]`.
+
+  Returns:
+    quantized: an `int8` array with the same shape of `weights`.
+    scales: a `float32` array of shape `[C_out, ]` so that
+      `quantized * scales` approximates `weights`.
+
+  """
+  weights = np.asarray(weights, dtype=np.float32)
+  scales = np.abs(weights).reshape((-1, weights.shape[-1])).max(axis=0) / 127.0
+  scales[scales == 0.0] = 1.0
+  quantized = np.clip(np.round(weights / scales), -127, 127).astype(np.int8)
+  return quantized, scales.astype(np.float32)
+
+
+def _make_const(name, value):
+  """
+  Return a `Const` NodeDef.
+  """
+  node = node_def_pb2.NodeDef()
+  node.op = "Const"
+  node.name = name
+  node.attr["dtype"].type = tf.as_dtype(value.dtype).as_datatype_enum
+  node.attr["value"].tensor.CopyFrom(tensor_util.make_tensor_proto(value))
+  return node
+
+
+def quantize_graph_def(graph_def):
+  """
+  Replace the float kernels of the k-body networks of a frozen graph with int8
+  kernels and their dequantization ops. The dequantized kernels keep the names
+  of the original kernels so the consumers are unchanged.
+
+  Args:
+    graph_def: a frozen `GraphDef`.
+
+  Returns:
+    graph_def: the quantized `GraphDef`.
+    names: a `List[str]` as the names of the quantized kernels.
+
+  """
+  quantized_graph_def = graph_pb2.GraphDef()
+  quantized_graph_def.versions.CopyFrom(graph_def.versions)
+  quantized_graph_def.library.CopyFrom(graph_def.library)
+  names = []
+
+  for node in graph_def.node:
+    if node.op != "Const" or not _KERNEL_PATTERN.match(node.name):
+      quantized_graph_def.node.extend([node])
+      continue
+    weights = tensor_util.MakeNdarray(node.attr["value"].tensor)
+    if weights.dtype != np.float32 or weights.ndim != 4:
+      quantized_graph_def.node.extend([node])
+      continue
+
+    quantized, scales = quantize_weights(weights)
+
+    cast = node_def_pb2.NodeDef()
+    cast.op = "Cast"
+    cast.name = node.name + "/dequantize"
+    cast.input.append(node.name + "/quantized")
+    cast.attr["SrcT"].type = tf.int8.as_datatype_enum
+    cast.attr["DstT"].type = tf.float32.as_datatype_enum
+
+    mul = node_def_pb2.NodeDef()
+    mul.op = "Mul"
+    mul.name = node.name
+    mul.input.extend([cast.name, node.name + "/scales"])
+    mul.attr["T"].type = tf.float32.as_datatype_enum
+
+    quantized_graph_def.node.extend([
+      _make_const(node.name + "/quantized", quantized),
+      _make_const(node.name + "/scales", scales),
+      cast,
+      mul])
+    names.append(node.name)
+
+  return quantized_graph_def, names
+
+
+"""
+The graph transforms to rewrite a frozen graph with 8-bit ops. Small kernels are
+quantized as well because most kernels of the k-body networks are small.
+"""
+_EIGHTBIT_TRANSFORMS = _INFERENCE_TRANSFORMS[:-1] + [
+  "quantize_weights(minimum_size=0)",
+  "quantize_nodes",
+  "strip_unused_nodes",
+  "sort_by_execution_order",
+]
+
+
+def eightbit_graph_def(graph_def):
+  """
+  Rewrite a frozen graph so that the convolutions run with 8-bit ops.
+
+  Args:
+    graph_def: a frozen `GraphDef`.
+
+  Returns:
+    graph_def: the quantized `GraphDef`.
+    names: a `List[str]` as the names of the quantized ops.
+
+  """
+  names = set(node.name for node in graph_def.node)
+  forces = "kCON/Forces/forces" in names
+  output_node_names = _get_output_node_names(forces).split(",")
+  output_node_names = [name for name in output_node_names if name in names]
+  quantized_graph_def = optimize_for_inference(
+    graph_def, output_node_names, transforms=_EIGHTBIT_TRANSFORMS)
+  return quantized_graph_def, [node.name for node in quantized_graph_def.node
+                               if node.op.startswith("Quantized")]
+
+
+def _load_graph_def(filename):
+  """
+  Load a frozen `GraphDef`.
+  """
+  graph_def = graph_pb2.GraphDef()
+  with tf.gfile.GFile(filename, "rb") as fp:
+    graph_def.ParseFromString(fp.read())
+  return graph_def
+
+
+def _get_split_dims(graph_def):
+  """
+  Return the `split_dims` of the fixed-length transformer of an exported model.
+  """
+  with tf.Graph().as_default() as graph:
+    tf.import_graph_def(graph_def, name="")
+    with tf.Session(graph=graph) as sess:
+      clf = restore_transformer(graph, sess, fixed=True)
+  return np.asarray(clf.split_dims, dtype=np.int64)
+
+
+def _predict(graph_def, batches, split_dims):
+  """
+  Predict the energies of the batches with a frozen graph.
+
+  Returns:
+    y_nn: a `float32` array as the predicted energies.
+    seconds: a `float` as the mean time of predicting a batch. The first batch
+      is predicted once more before timing.
+
+  """
+  with tf.Graph().as_default() as graph:
+    tf.import_graph_def(graph_def, name="")
+    feeds = {}
+    for name in ("placeholders/split_dims", "placeholders/is_training"):
+      try:
+        tensor = graph.get_tensor_by_name(name + ":0")
+      except KeyError:
+        continue
+      if tensor.op.type == "Placeholder":
+        feeds[tensor] = split_dims if name.endswith("split_dims") else False
+    y_nn = graph.get_tensor_by_name("kCON/Energy/Sum/1_and_k:0")
+    feed_dicts = []
+    for features, occurs, weights in batches:
+      feed_dict = {"placeholders/inputs:0": features,
+                   "placeholders/occurs:0": occurs,
+                   "placeholders/weights:0": weights}
+      feed_dict.update(feeds)
+      feed_dicts.append(feed_dict)
+    with tf.Session(graph=graph) as sess:
+      sess.run(y_nn, feed_dict=feed_dicts[0])
+      outputs = []
+      tic = time.time()
+      for feed_dict in feed_dicts:
+        outputs.append(np.atleast_1d(sess.run(y_nn, feed_dict=feed_dict)))
+      seconds = (time.time() - tic) / len(feed_dicts)
+  return np.concatenate(outputs), seconds
+
+
+def calibrate(graph_def, quantized_graph_def, dataset_name, num_examples):
+  """
+  Compare the energy MAEs and the prediction times of the float and the
+  quantized models on the first examples of the validation set.
+
+  Args:
+    graph_def: the float `GraphDef`.
+    quantized_graph_def: the quantized `GraphDef`.
+    dataset_name: a `str` as the name of the dataset.
+    num_examples: an `int` as the number of examples to evaluate.
+
+  Returns:
+    mae: a `float` as the energy MAE of the float model.
+    mae_int8: a `float` as the energy MAE of the quantized model.
+    speedup: a `float` as the ratio of the prediction time of the float model
+      to that of the quantized model.
+
+  """
+  configs = pipeline.get_configs(for_training=False, dataset_name=dataset_name)
+  if configs.get("positions", False):
+    raise ValueError("Datasets in the positions layout are not supported.")
+
+  # The `split_dims` must be those of the exported model rather than the global
+  # ones of the dataset.
+  split_dims = _get_split_dims(graph_def)
+  if int(split_dims.sum()) != configs["shape"][0]:
+    raise ValueError("The model does not match the dataset {}: {} != {}".format(
+      dataset_name, int(split_dims.sum()), configs["shape"][0]))
+  batch_size = min(num_examples, 100)
+
+  with tf.Graph().as_default():
+    batch = pipeline.next_batch(dataset_name, for_training=False,
+                                batch_size=batch_size, num_epochs=1,
+                                shuffle=False)
+    batches = []
+    energies = []
+    with tf.Session() as sess:
+      while len(energies) * batch_size < num_examples:
+        try:
+          values = sess.run([batch.features, batch.occurs, batch.weights,
+                             batch.energy])
+        except tf.errors.OutOfRangeError:
+          break
+        batches.append(values[:3])
+        energies.append(values[3])
+
+  if not energies:
+    raise ValueError("No validation examples of {}".format(dataset_name))
+  y_true = np.concatenate(energies)[:num_examples]
+  y_float, t_float = _predict(graph_def, batches, split_dims)
+  y_int8, t_int8 = _predict(quantized_graph_def, batches, split_dims)
+  return (float(np.abs(y_float[:num_examples] - y_true).mean()),
+          float(np.abs(y_int8[:num_examples] - y_true).mean()),
+          t_float / t_int8)
+
+
+# noinspection PyUnusedLocal,PyMissingOrEmptyDocstring
+def main(unused):
+  if FLAGS.frozen_graph is None:
+    raise ValueError("`frozen_graph` must be set.")
+  graph_def = _load_graph_def(FLAGS.frozen_graph)
+  if FLAGS.quantize_mode == 'eightbit':
+    quantized_graph_def, names = eightbit_graph_def(graph_def)
+    print("Rewrote {} ops with 8-bit ops.".format(len(names)))
+  elif FLAGS.quantize_mode == 'weights':
+    quantized_graph_def, names = quantize_graph_def(graph_def)
+    print("Quantized {} kernels to int8.".format(len(names)))
+  else:
+    raise ValueError("Unknown quantize mode: " + FLAGS.quantize_mode)
+
+  mae, mae_int8, speedup = calibrate(graph_def, quantized_graph_def,
+                                     FLAGS.dataset,
+                                     FLAGS.num_calibration_examples)
+  delta = mae_int8 - mae
+  print("Energy MAE: float = {:.6f}, int8 = {:.6f}, delta = {:+.6f}".format(
+    mae, mae_int8, delta))
+  print("Speedup: {:.2f}x".format(speedup))
+  if FLAGS.max_mae_delta is not None and delta > FLAGS.max_mae_delta:
+    raise ValueError("The MAE delta {:.6f} exceeds the bound {:.6f}.".format(
+      delta, FLAGS.max_mae_delta))
+  if FLAGS.min_speedup is not None and speedup < FLAGS.min_speedup:
+    raise ValueError("The speedup {:.2f} is below the bound {:.2f}.".format(
+      speedup, FLAGS.min_speedup))
+
+  filename = "{}-int8.pb".format(FLAGS.frozen_graph[:-3])
+  with tf.gfile.GFile(filename, "wb") as fp:
+    fp.write(quantized_graph_def.SerializeToString())
+  print("Export the quantized model to {}: {} -> {} bytes".format(
+    filename, graph_def.ByteSize(), quantized_graph_def.ByteSize()))
+
+
+if __name__ == "__main__":
+  tf.app.run(main=main)
@@ -5,14 +5,17 @@ versions.
 """
 from __future__ import print_function, absolute_import
 
+import numpy as np
 import tensorflow as tf
 import json
 import pipeline
 import kcnn
 from os.path import join, dirname
 from constants import GHOST, VARIABLE_MOVING_AVERAGE_DECAY
-from tensorflow.python.framework import graph_io
+from tensorflow.core.framework import graph_pb2
+from tensorflow.python.framework import graph_io, tensor_util
 from tensorflow.python.tools import freeze_graph
+from tensorflow.tools.graph_transforms import TransformGraph
 
 __author__ = 'Xin Chen'
 __email__ = 'Bismarrck@me.com'
@@ -27,6 +30,12 @@ tf.app.flags.DEFINE_string('checkpoint', None,
 tf.app.flags.DEFINE_string("aux_nodes", None,
                            """Comma separated string as the names of the 
                            auxiliary nodes to expose.""")
+tf.app.flags.DEFINE_boolean("optimize_for_inference", False,
+                            """Also export an inference-optimized graph for 
+                            the fixed-length predictor: `split_dims` and 
+                            `is_training` are folded to constants, batch norms 
+                            are folded into the conv weights and the identity 
+                            ops are stripped.""")
 
 # TODO: test the batch normalization
 
@@ -54,6 +63,7 @@ def _get_transformer_repr(configs):
             "atomic_forces": configs["atomic_forces_enabled"],
             "lj": configs.get("lj", False),
             "cutoff": configs.get("cutoff", None),
+            "native": configs.get("native", False),
             "species": configs["species"]}
   return json.dumps(params)
 
@@ -74,6 +84,21 @@ def _get_output_node_names(forces=False):
   return ",".join(tensors)
 
 
+"""
+The graph transforms to optimize a frozen graph for inference. The batch norms
+with moving statistics are folded into the preceding 1x1 convolutions. Layer
+norms depend on the statistics of each input so they can not be folded.
+"""
+_INFERENCE_TRANSFORMS = [
+  "remove_nodes(op=Identity, op=CheckNumerics, op=StopGradient)",
+  "fold_constants(ignore_errors=true)",
+  "fold_batch_norms",
+  "fold_old_batch_norms",
+  "fold_constants(ignore_errors=true)",
+  "sort_by_execution_order",
+]
+
+
 def get_tensors_to_restore(forces=False):
   """
   Return a dict of (name, tensor_name) that should be restored from an exported
@@ -87,13 +112,16 @@ def get_tensors_to_restore(forces=False):
           for name in _get_output_node_names(forces=forces).split(",")}
 
 
-def _inference(dataset_name, conv_sizes):
+def _inference(dataset_name, conv_sizes, optimize=False):
   """
   Inference a model of `KCNN` with inputs feeded from placeholders.
 
   Args:
     dataset_name: a `str` as the name of the dataset.
     conv_sizes: a `str` of comma-separated integers as the numbers of kernels.
+    optimize: a `bool`. If True, `split_dims` will be the constant dims of the
+      dataset and `is_training` will be False so that they can be folded. The
+      exported graph only works with the fixed-length transformer.
 
   Returns:
     graph: a `tf.Graph` as the graph for inference.
@@ -122,9 +150,16 @@ def _inference(dataset_name, conv_sizes):
         tf.float32, shape=(None, 1, 1, num_atom_types), name="occurs")
       weights_ = tf.placeholder(
         tf.float32, shape=(None, 1, None, 1), name="weights")
-      split_dims_ = tf.placeholder(
-        tf.int64, shape=(len(split_dims, )), name="split_dims")
-      is_training_ = tf.placeholder(tf.bool, name="is_training")
+      if optimize:
+        # The constant keeps the name of the placeholder so that the predictor
+        # can detect the folded `split_dims`.
+        tf.constant(split_dims, dtype=tf.int64, name="split_dims")
+        split_dims_ = [int(x) for x in split_dims]
+        is_training_ = False
+      else:
+        split_dims_ = tf.placeholder(
+          tf.int64, shape=(len(split_dims, )), name="split_dims")
+        is_training_ = tf.placeholder(tf.bool, name="is_training")
 
       if atomic_forces:
         coef_ = tf.placeholder(
@@ -144,8 +179,135 @@ def _inference(dataset_name, conv_sizes):
   return graph
 
 
+def optimize_for_inference(graph_def, output_node_names, transforms=None):
+  """
+  Optimize a frozen graph for inference.
+
+  Args:
+    graph_def: a frozen `GraphDef`.
+    output_node_names: a `List[str]` as the nodes to keep. The placeholders
+      among them are the inputs.
+    transforms: a `List[str]` as the graph transforms to apply. Defaults to
+      `_INFERENCE_TRANSFORMS`.
+
+  Returns:
+    graph_def: the optimized `GraphDef`.
+
+  """
+  # The folded `split_dims` is a constant so it must not be an input.
+  placeholders = set(node.name for node in graph_def.node
+                     if node.op == "Placeholder")
+  inputs = [name for name in output_node_names if name in placeholders]
+  outputs = [name for name in output_node_names if name not in inputs]
+  return TransformGraph(graph_def, inputs, outputs,
+                        transforms or _INFERENCE_TRANSFORMS)
+
+
+def _to_const(node, value):
+  """
+  Replace a NodeDef with a `Const` NodeDef of the same name.
+  """
+  node.op = "Const"
+  del node.input[:]
+  node.ClearField("attr")
+  node.attr["dtype"].type = tf.as_dtype(value.dtype).as_datatype_enum
+  node.attr["value"].tensor.CopyFrom(tensor_util.make_tensor_proto(value))
+
+
+def fold_int8_weights(graph_def):
+  """
+  Fold the int8 kernels of a graph quantized by `quantize.py` back to float32
+  constants, so that the `Cast` and `Mul` dequantization ops do not run on
+  every prediction. Graphs without int8 kernels are returned as is.
+
+  Args:
+    graph_def: a frozen `GraphDef`.
+
+  Returns:
+    graph_def: a `GraphDef` with float32 kernels.
+
+  """
+  nodes = {node.name: node for node in graph_def.node}
+  kernels = {}
+  for node in graph_def.node:
+    if node.op != "Mul" or list(node.input) != [node.name + "/dequantize",
+                                                node.name + "/scales"]:
+      continue
+    quantized = nodes.get(node.name + "/quantized")
+    scales = nodes.get(node.name + "/scales")
+    if quantized is None or scales is None:
+      continue
+    kernels[node.name] = (
+      tensor_util.MakeNdarray(quantized.attr["value"].tensor).astype(
+        np.float32) * tensor_util.MakeNdarray(scales.attr["value"].tensor))
+  if not kernels:
+    return graph_def
+
+  removed = set()
+  for name in kernels:
+    removed.update([name + suffix
+                    for suffix in ("/quantized", "/scales", "/dequantize")])
+  folded = graph_pb2.GraphDef()
+  folded.versions.CopyFrom(graph_def.versions)
+  folded.library.CopyFrom(graph_def.library)
+  for node in graph_def.node:
+    if node.name in removed:
+      continue
+    new_node = folded.node.add()
+    new_node.CopyFrom(node)
+    if node.name in kernels:
+      _to_const(new_node, kernels[node.name])
+  return folded
+
+
+def specialize_graph_def(graph_def, split_dims, batch_size, output_node_names):
+  """
+  Specialize a frozen graph for one stoichiometry and one batch size. The
+  placeholders get static shapes, `split_dims` becomes a constant and
+  `is_training` becomes False so that all shapes can be inferred and the splits
+  are static when the graph is optimized by `optimize_for_inference`.
+
+  Args:
+    graph_def: a frozen `GraphDef` exported by `save_model`.
+    split_dims: a `List[int]` as the dims of the k-body terms of the
+      stoichiometry.
+    batch_size: an `int` as the static batch size.
+    output_node_names: a `List[str]` as the nodes to keep.
+
+  Returns:
+    graph_def: the specialized `GraphDef`.
+
+  """
+  total_dim = int(sum(split_dims))
+  static_dims = {
+    "placeholders/inputs": {0: batch_size, 2: total_dim},
+    "placeholders/weights": {0: batch_size, 2: total_dim},
+    "placeholders/occurs": {0: batch_size},
+    "placeholders/coefficients": {0: batch_size, 1: total_dim},
+    "placeholders/indexing": {0: batch_size},
+  }
+
+  specialized = graph_pb2.GraphDef()
+  specialized.CopyFrom(graph_def)
+  for node in specialized.node:
+    if node.op != "Placeholder":
+      continue
+    if node.name in static_dims:
+      dims = [dim.size if dim.size >= 0 else None
+              for dim in node.attr["shape"].shape.dim]
+      for axis, size in static_dims[node.name].items():
+        dims[axis] = size
+      node.attr["shape"].shape.CopyFrom(tf.TensorShape(dims).as_proto())
+    elif node.name == "placeholders/split_dims":
+      _to_const(node, np.asarray(split_dims, dtype=np.int64))
+    elif node.name == "placeholders/is_training":
+      _to_const(node, np.asarray(False))
+
+  return optimize_for_inference(specialized, output_node_names)
+
+
 def save_model(checkpoint_dir, dataset, conv_sizes, verbose=True,
-               auxiliary_outputs=None):
+               auxiliary_outputs=None, optimize=False):
   """
   take a GraphDef proto, a SaverDef proto, and a set of variable values stored
   in a checkpoint file, and output a GraphDef with all of the variable ops
@@ -157,6 +319,9 @@ def save_model(checkpoint_dir, dataset, conv_sizes, verbose=True,
     conv_sizes: a `str` of comma-separated integers as the numbers of kernels.
     verbose: a `bool` indicating whether or not should log the progress.
     auxiliary_outputs: a `List[str]` as the of additional tensors to expose.
+    optimize: a `bool`. If True, an inference-optimized graph for the
+      fixed-length predictor will also be exported. See
+      `optimize_for_inference`.
 
   See Also:
     https://www.tensorflow.org/extend/tool_developers
@@ -228,6 +393,45 @@ def save_model(checkpoint_dir, dataset, conv_sizes, verbose=True,
     if verbose:
       print("Export the model to {}".format(graph_path))
 
+  if optimize:
+    _save_optimized_model(checkpoint_path, dataset, conv_sizes, graph_path,
+                          output_node_names.split(","), verbose=verbose)
+
+
+def _save_optimized_model(checkpoint_path, dataset, conv_sizes, graph_path,
+                          output_node_names, verbose=True):
+  """
+  Export the inference-optimized graph to `{graph_path}-optimized.pb`.
+
+  Args:
+    checkpoint_path: a `str` as the checkpoint of the moving averaged variables
+      saved by `save_model`.
+    dataset: a `str` as the name of dataset to use.
+    conv_sizes: a `str` of comma-separated integers as the numbers of kernels.
+    graph_path: a `str` as the exported graph.
+    output_node_names: a `List[str]` as the nodes to keep.
+    verbose: a `bool` indicating whether or not should log the progress.
+
+  """
+  graph = _inference(dataset, conv_sizes, optimize=True)
+  with tf.Session(graph=graph) as sess:
+    saver = tf.train.Saver(var_list=tf.global_variables())
+    saver.restore(sess, checkpoint_path)
+    graph_def = tf.graph_util.convert_variables_to_constants(
+      sess, graph.as_graph_def(), output_node_names)
+
+  graph_def = optimize_for_inference(graph_def, output_node_names)
+  optimized_path = "{}-optimized.pb".format(graph_path[:-3])
+  with tf.gfile.GFile(optimized_path, "wb") as fp:
+    fp.write(graph_def.SerializeToString())
+
+  if verbose:
+    with tf.gfile.GFile(graph_path, "rb") as fp:
+      frozen = graph_pb2.GraphDef()
+      frozen.ParseFromString(fp.read())
+    print("Export the optimized model to {}: {} -> {} nodes".format(
+      optimized_path, len(frozen.node), len(graph_def.node)))
+
 
 # noinspection PyUnusedLocal,PyMissingOrEmptyDocstring
 def main(unused):
@@ -236,7 +440,8 @@ def main(unused):
   else:
     aux_nodes = None
   save_model(FLAGS.checkpoint_dir, FLAGS.dataset, FLAGS.conv_sizes,
-             auxiliary_outputs=aux_nodes)
+             auxiliary_outputs=aux_nodes,
+             optimize=FLAGS.optimize_for_inference)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,321 @@
+# coding=utf-8
+"""
+This module provides the writers of the transformed examples and the reader of
+the memory-mapped NumPy feature store.
+
+Two output formats are supported:
+
+  * 'tfrecords': each example is serialized as a `tf.train.Example`.
+  * 'npy': each field is saved as a contiguous `.npy` array of shape
+    `[num_examples, ...]` in the store dir so that batches can be sliced from
+    memory-mapped arrays directly.
+
+In the columnar layout the feature matrix is split by k-body terms and the
+block of the i-th term is saved as the field `get_term_field(i)`: a separate
+`.npy` array or a separate tfrecords stream. Readers may then skip the terms
+that will not be evaluated.
+
+In the positions layout the features and the force-path auxiliary fields are
+replaced by the padded atomic positions and the index of the stoichiometry of
+each example. The static pair tables of all stoichiometries are saved once in
+`get_pairs_filename(filename)`.
+
+"""
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import tensorflow as tf
+from os import makedirs
+from os.path import join, isdir, splitext, isfile
+from tensorflow.python.training.training import Features, Example
+
+__author__ = 'Xin Chen'
+__email__ = 'Bismarrck@me.com'
+
+
+"""
+The dtypes of the fields of an example.
+"""
+_dtypes = {
+  "features": np.float32,
+  "energy": np.float64,
+  "occurs": np.float32,
+  "weights": np.float32,
+  "loss_weight": np.float32,
+  "sizes": np.int64,
+  "forces": np.float64,
+  "coef": np.float32,
+  "indexing": np.int32,
+  "counts": np.float64,
+  "positions": np.float64,
+  "stoichiometry": np.int64,
+}
+
+"""
+The fields of the energy examples and the additional fields for forces.
+"""
+ENERGY_FIELDS = ("features", "energy", "occurs", "weights", "loss_weight",
+                 "sizes")
+FORCES_FIELDS = ("forces", "coef", "indexing")
+
+"""
+The fields replacing the features and the force-path auxiliary fields in the
+positions layout.
+"""
+POSITIONS_FIELDS = ("positions", "stoichiometry")
+
+
+def get_term_field(index):
+  """
+  Return the field name of the features of the `index`-th k-body term in the
+  columnar layout.
+  """
+  return "features-{:02d}".format(index)
+
+
+def is_term_field(key):
+  """
+  Return True if `key` is the field of the features of a k-body term.
+  """
+  return key.startswith("features-")
+
+
+def _get_dtype(key):
+  """
+  Return the dtype of a field.
+  """
+  if is_term_field(key):
+    return _dtypes['features']
+  return _dtypes[key]
+
+
+def _bytes_feature(value):
+  """
+  Convert the `value` to Protobuf bytes.
+  """
+  return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _float_feature(value):
+  """
+  Convert the `value` to Protobuf float32.
+  """
+  return tf.train.Feature(float_list=tf.train.FloatList(value=[value]))
+
+
+def _int64_feature(values):
+  """
+  Convert the list of integers `values` to Protobuf int64.
+  """
+  return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+
+def get_forces_filename(filename):
+  """
+  Return the file of the force-path fields given the tfrecords file of the
+  energy-path fields, e.g. 'binary/qm7-train.tfrecords' ->
+  'binary/qm7-train.forces.tfrecords'.
+  """
+  stem, ext = splitext(filename)
+  return "{}.forces{}".format(stem, ext)
+
+
+def get_term_filename(filename, index):
+  """
+  Return the file of the features of the `index`-th k-body term given the
+  tfrecords file of the energy-path fields, e.g. 'binary/qm7-train.tfrecords'
+  -> 'binary/qm7-train.features-00.tfrecords'.
+  """
+  stem, ext = splitext(filename)
+  return "{}.{}{}".format(stem, get_term_field(index), ext)
+
+
+def get_pairs_filename(filename):
+  """
+  Return the file of the per-stoichiometry pair tables of a dataset in the
+  positions layout given its tfrecords file, e.g. 'binary/qm7-train.tfrecords'
+  -> 'binary/qm7-train.pairs.npz'.
+  """
+  return "{}.pairs.npz".format(splitext(filename)[0])
+
+
+def get_store_dir(filename):
+  """
+  Return the dir of the NumPy feature store given the tfrecords file of the same
+  dataset, e.g. 'binary/qm7-train.tfrecords' -> 'binary/qm7-train'.
+  """
+  return splitext(filename)[0]
+
+
+class TFRecordsWriter(object):
+  """
+  Serialize the examples to one or more tfrecords files.
+  """
+
+  def __init__(self, shards, num_examples, forces_shards=None,
+               num_terms=None):
+    """
+    Initialization method.
+
+    Args:
+      shards: a `List[str]` as the shard files. The examples will be evenly
+        written to these files in order.
+      num_examples: an `int` as the total number of examples to write.
+      forces_shards: a `List[str]` as the shard files of the force-path fields
+        (`FORCES_FIELDS`). If given, these fields will be written to a separate
+        record stream aligned with `shards` so that energy-only runs do not
+        need to read them.
+      num_terms: an `int` as the number of k-body terms. If given, the examples
+        must be in the columnar layout and the features of each term will be
+        written to a separate record stream. See `get_term_filename`.
+
+    """
+    self._streams = {None: shards}
+    if forces_shards:
+      self._streams['forces'] = forces_shards
+    for i in range(num_terms or 0):
+      self._streams[get_term_field(i)] = [
+        get_term_filename(shard, i) for shard in shards]
+    self._examples_per_shard = int(np.ceil(num_examples / len(shards)))
+    self._writers = {}
+    self._index = 0
+
+  def _get_stream(self, key):
+    """
+    Return the stream of the field `key`.
+    """
+    if key in self._streams:
+      return key
+    elif key in FORCES_FIELDS and 'forces' in self._streams:
+      return 'forces'
+    return None
+
+  @staticmethod
+  def _serialize(example):
+    """
+    Serialize a `dict` of arrays to a `tf.train.Example`.
+    """
+    feature = {}
+    for key, value in example.items():
+      if key == 'loss_weight':
+        feature[key] = _float_feature(value)
+      elif key == 'sizes':
+        feature[key] = _int64_feature([int(size) for size in value])
+      else:
+        value = np.asarray(value, dtype=_get_dtype(key))
+        if is_term_field(key):
+          key = 'features'
+        feature[key] = _bytes_feature(value.tostring())
+    return Example(features=Features(feature=feature)).SerializeToString()
+
+  def write(self, example):
+    """
+    Write an example.
+
+    Args:
+      example: a `dict` of arrays. See `ENERGY_FIELDS`, `FORCES_FIELDS` and
+        `get_term_field`.
+
+    """
+    # Switch to the next shard.
+    if self._index % self._examples_per_shard == 0:
+      self.close()
+      ishard = self._index // self._examples_per_shard
+      for stream, shards in self._streams.items():
+        self._writers[stream] = tf.python_io.TFRecordWriter(shards[ishard])
+
+    records = {stream: {} for stream in self._streams}
+    for key, value in example.items():
+      records[self._get_stream(key)][key] = value
+    for stream, record in records.items():
+      self._writers[stream].write(self._serialize(record))
+    self._index += 1
+
+  def close(self):
+    """
+    Close the current shard.
+    """
+    for writer in self._writers.values():
+      writer.close()
+    self._writers = {}
+
+
+class NpyStoreWriter(object):
+  """
+  Write the examples to contiguous `.npy` arrays. The arrays are created as
+  writable memory maps when the first example arrives.
+  """
+
+  def __init__(self, store_dir, num_examples):
+    """
+    Initialization method.
+
+    Args:
+      store_dir: a `str` as the dir to save the `.npy` files.
+      num_examples: an `int` as the total number of examples to write.
+
+    """
+    if not isdir(store_dir):
+      makedirs(store_dir)
+    self._store_dir = store_dir
+    self._num_examples = num_examples
+    self._arrays = None
+    self._index = 0
+
+  def _create_arrays(self, example):
+    """
+    Create the memory-mapped arrays given the first example.
+    """
+    self._arrays = {}
+    for key, value in example.items():
+      value = np.asarray(value, dtype=_get_dtype(key))
+      self._arrays[key] = np.lib.format.open_memmap(
+        join(self._store_dir, "{}.npy".format(key)),
+        mode='w+',
+        dtype=_get_dtype(key),
+        shape=(self._num_examples, ) + value.shape)
+
+  def write(self, example):
+    """
+    Write an example.
+
+    Args:
+      example: a `dict` of arrays. See `ENERGY_FIELDS`, `FORCES_FIELDS` and
+        `get_term_field`.
+
+    """
+    if self._arrays is None:
+      self._create_arrays(example)
+    for key, value in example.items():
+      self._arrays[key][self._index] = value
+    self._index += 1
+
+  def close(self):
+    """
+    Flush the arrays to the disk.
+    """
+    if self._arrays is not None:
+      for array in self._arrays.values():
+        array.flush()
+      self._arrays = None
+
+
+def open_store(store_dir, fields):
+  """
+  Open the arrays of a NumPy feature store as read-only memory maps.
+
+  Args:
+    store_dir: a `str` as the dir of the store.
+    fields: a `List[str]` as the fields to open.
+
+  Returns:
+    arrays: a `dict` of read-only `np.memmap`.
+
+  """
+  arrays = {}
+  for field in fields:
+    filename = join(store_dir, "{}.npy".format(field))
+    if not isfile(filename):
+      raise IOError("The store file {} can not be accessed!".format(filename))
+    arrays[field] = np.load(filename, mmap_mode='r')
+  return arrays
@@ -0,0 +1,113 @@
+# coding=utf-8
+"""
+The unittests of reading compressed text files.
+"""
+from __future__ import print_function, absolute_import
+
+import bz2
+import gzip
+import lzma
+import unittest
+from os.path import join
+from tempfile import mkdtemp
+from compression import open_text, resolve_compressed, strip_compression_ext
+from compression import ThreadedLineReader
+
+__author__ = 'Xin Chen'
+__email__ = 'Bismarrck@me.com'
+
+
+# The last line has no trailing newline on purpose.
+_TEXT = "".join("{:d} H 0.0 0.0 {:.4f}\n".format(i, i * 0.1)
+                for i in range(2000)) + "end"
+
+_OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+
+def _write(filename, opener=None):
+  """
+  Write `_TEXT` to the file, compressed by `opener` if given.
+  """
+  if opener is None:
+    with open(filename, "w") as fp:
+      fp.write(_TEXT)
+  else:
+    with opener(filename, "wt") as fp:
+      fp.write(_TEXT)
+
+
+class CompressionTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workdir = mkdtemp()
+
+  def test_round_trip(self):
+    """
+    All formats should give the original lines, threaded or not and with
+    chunks that split the lines.
+    """
+    expected = _TEXT.splitlines(True)
+    for ext, opener in _OPENERS.items():
+      filename = join(self.workdir, "test.xyz" + ext)
+      _write(filename, opener)
+      for kwargs in ({"threaded": False},
+                     {"threaded": True},
+                     {"threaded": True, "chunk_size": 7, "max_chunks": 2}):
+        with open_text(filename, **kwargs) as fp:
+          self.assertListEqual(list(fp), expected, msg=(ext, kwargs))
+
+  def test_magic_bytes(self):
+    """
+    Compressed files without the extensions should be detected by their magic
+    bytes. Plain files should be opened as is.
+    """
+    for ext, opener in _OPENERS.items():
+      filename = join(self.workdir, "magic{}.xyz".format(ext[1:]))
+      _write(filename, opener)
+      with open_text(filename, threaded=False) as fp:
+        self.assertEqual(fp.read(), _TEXT)
+
+    filename = join(self.workdir, "plain.xyz")
+    _write(filename)
+    with open_text(filename) as fp:
+      self.assertNotIsInstance(fp, ThreadedLineReader)
+      self.assertEqual(fp.read(), _TEXT)
+
+  def test_early_close(self):
+    """
+    Closing the reader before the end should stop the background thread.
+    """
+    filename = join(self.workdir, "early.xyz.gz")
+    _write(filename, gzip.open)
+    reader = open_text(filename, chunk_size=16, max_chunks=1)
+    self.assertEqual(next(iter(reader)), _TEXT.splitlines(True)[0])
+    reader.close()
+    self.assertFalse(reader._thread.is_alive())
+
+  def test_corrupted_file(self):
+    """
+    The errors of the background thread should be raised when iterating.
+    """
+    filename = join(self.workdir, "corrupted.xyz.gz")
+    with open(filename, "wb") as fp:
+      fp.write(b"\x1f\x8b" + b"\x00" * 32)
+    with self.assertRaises(IOError):
+      with open_text(filename) as fp:
+        list(fp)
+
+  def test_resolve_compressed(self):
+    """
+    The plain file should be preferred and then the compressed versions.
+    """
+    filename = join(self.workdir, "resolve.xyz")
+    self.assertIsNone(resolve_compressed(filename))
+    _write(filename + ".bz2", bz2.open)
+    self.assertEqual(resolve_compressed(filename), filename + ".bz2")
+    _write(filename)
+    self.assertEqual(resolve_compressed(filename), filename)
+    self.assertEqual(strip_compression_ext(filename + ".xz"), filename)
+    self.assertEqual(strip_compression_ext(filename), filename)
+
+
+if __name__ == "__main__":
+  unittest.main()
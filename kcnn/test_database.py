@@ -0,0 +1,259 @@
+# coding=utf-8
+"""
+The unittests of the databases and the direct ingestion of frames.
+"""
+from __future__ import print_function, absolute_import
+
+import json
+import numpy as np
+import tensorflow as tf
+from ase import Atoms
+from ase.calculators.singlepoint import SinglePointCalculator
+from ase.io.trajectory import Trajectory
+from ase.db import connect
+from os.path import join, isfile
+from tempfile import mkdtemp
+from database import Database, FrameDatabase, ColumnarFrames, StructureRecord
+from database import _parse_extxyz_header, _parse_extxyz_properties
+from database import _get_extxyz_energy
+
+__author__ = 'Xin Chen'
+__email__ = 'Bismarrck@me.com'
+
+
+def _make_frames(num_frames, seed=0):
+  """
+  Return a list of random `StructureRecord` frames of CH4 and CH3.
+  """
+  rng = np.random.RandomState(seed)
+  frames = []
+  for i in range(num_frames):
+    numbers = [6, 1, 1, 1] + [1] * (i % 2)
+    frames.append(StructureRecord(numbers=numbers,
+                                  positions=rng.rand(len(numbers), 3),
+                                  energy=-float(i + 1),
+                                  forces=rng.rand(len(numbers), 3)))
+  return frames
+
+
+def _save_columnar(filename, frames):
+  """
+  Save the frames to a columnar `.npz` store.
+  """
+  np.savez(filename,
+           natoms=[len(frame) for frame in frames],
+           numbers=np.concatenate([frame.numbers for frame in frames]),
+           positions=np.concatenate([frame.positions for frame in frames]),
+           energy=[frame.energy for frame in frames],
+           forces=np.concatenate([frame.forces for frame in frames]))
+
+
+class FrameDatabaseTest(tf.test.TestCase):
+
+  def test_columnar_frames(self):
+    """
+    The frames of a columnar store should be sliced by their atom counts.
+    """
+    frames = _make_frames(3)
+    filename = join(mkdtemp(), "frames.npz")
+    _save_columnar(filename, frames)
+    store = ColumnarFrames(filename)
+    self.assertEqual(len(store), 3)
+    for i, frame in enumerate(frames):
+      record = store[i]
+      self.assertListEqual(record.get_chemical_symbols(),
+                           frame.get_chemical_symbols())
+      self.assertAllClose(record.positions, frame.positions)
+      self.assertAllClose(record.forces, frame.forces)
+      self.assertAlmostEqual(record.energy, frame.energy)
+
+  def test_unit_conversion(self):
+    """
+    The unit conversion should be applied to new records only, so accessing a
+    frame twice gives the same values and the frames are unchanged.
+    """
+    frames = _make_frames(2)
+    db = FrameDatabase(frames, unit_to_ev=2.0)
+    for _ in range(2):
+      record = db.get_record(2)
+      self.assertAlmostEqual(record.energy, -4.0)
+      self.assertAllClose(record.forces, frames[1].forces * 2.0)
+    self.assertAlmostEqual(frames[1].energy, -2.0)
+    self.assertAlmostEqual(db.energy_range[0], -4.0)
+    self.assertAlmostEqual(db.get_record(1).energy, -2.0)
+
+  def test_frames_without_calculator(self):
+    """
+    Frames without a calculator have no energy and should be rejected.
+    """
+    db = FrameDatabase([Atoms("CH4", positions=np.random.rand(5, 3))],
+                       unit_to_ev=2.0)
+    with self.assertRaises(ValueError):
+      db.get_record(1)
+
+  def test_indexing(self):
+    """
+    The one-based ids, slices without bounds and the read-only writes.
+    """
+    db = FrameDatabase(_make_frames(4), num_examples=3)
+    self.assertEqual(len(db), 3)
+    self.assertEqual(len(db[:]), 3)
+    self.assertEqual(len(db[:2]), 1)
+    self.assertEqual(len(db[2:]), 2)
+    self.assertEqual(len(db[np.int64(1)]), 4)
+    with self.assertRaises(ValueError):
+      db.get_record(4)
+    with self.assertRaises(IOError):
+      db.write(db[1])
+
+  def test_from_file(self):
+    """
+    Trajectories and columnar stores should be loaded as `FrameDatabase`s with
+    persisted statistics.
+    """
+    workdir = mkdtemp()
+    frames = _make_frames(4)
+
+    npzfile = join(workdir, "frames.npz")
+    _save_columnar(npzfile, frames)
+    trajfile = join(workdir, "frames.traj")
+    traj = Trajectory(trajfile, 'w')
+    for frame in frames:
+      atoms = Atoms(numbers=frame.numbers, positions=frame.positions)
+      atoms.calc = SinglePointCalculator(atoms, energy=frame.energy,
+                                         forces=frame.forces)
+      traj.write(atoms)
+    traj.close()
+
+    for filename in (npzfile, trajfile):
+      db = Database.from_file(filename, num_examples=3, unit_to_ev=0.5)
+      self.assertIsInstance(db, FrameDatabase)
+      self.assertEqual(db.num_examples, 3)
+      self.assertDictEqual(db.max_occurs, {"C": 1, "H": 4})
+      self.assertAllClose(db.energy_range, (-1.5, -0.5))
+      self.assertAllClose(db.get_record(2).forces, frames[1].forces * 0.5)
+      self.assertTrue(isfile(filename + ".aux"))
+
+  def test_rebuild_with_another_unit(self):
+    """
+    The saved statistics should be refreshed if the unit or the number of
+    examples is changed.
+    """
+    filename = join(mkdtemp(), "frames.npz")
+    _save_columnar(filename, _make_frames(4))
+
+    db = Database.from_file(filename, num_examples=3, unit_to_ev=None)
+    self.assertAllClose(db.energy_range, (-3.0, -1.0))
+
+    db = Database.from_file(filename, num_examples=3, unit_to_ev=2.0)
+    self.assertAllClose(db.energy_range, (-6.0, -2.0))
+    with open(filename + ".aux") as fp:
+      self.assertAlmostEqual(json.load(fp)["unit_to_ev"], 2.0)
+
+    db = Database.from_file(filename, num_examples=None, unit_to_ev=2.0)
+    self.assertEqual(db.statistics.num_examples, 4)
+    self.assertAllClose(db.energy_range, (-8.0, -2.0))
+
+    # The statistics of the same unit and size are reused.
+    db = FrameDatabase(ColumnarFrames(filename), filename=filename,
+                       unit_to_ev=2.0)
+    self.assertIsNotNone(db._stats)
+
+
+class DatabaseTest(tf.test.TestCase):
+
+  def test_write(self):
+    """
+    Bulk writes should update the statistics incrementally and only persist
+    them when asked.
+    """
+    dbfile = join(mkdtemp(), "test.db")
+    db = Database(connect(dbfile))
+    for frame in _make_frames(3):
+      db.write(frame)
+    self.assertEqual(db.statistics.num_examples, 3)
+    self.assertDictEqual(db.max_occurs, {"C": 1, "H": 4})
+    self.assertAllClose(db.energy_range, (-3.0, -1.0))
+
+    # Only the statistics of the empty database were saved before.
+    with open(dbfile + ".aux") as fp:
+      self.assertEqual(json.load(fp)["num_examples"], 0)
+    db.save_statistics()
+    with open(dbfile + ".aux") as fp:
+      self.assertEqual(json.load(fp)["num_examples"], 3)
+
+    db = Database.from_db(dbfile)
+    self.assertEqual(db.statistics.num_examples, 3)
+    self.assertDictEqual(db.formula_counter, {"C1H3": 2, "C1H4": 1})
+
+
+class ExtxyzTest(tf.test.TestCase):
+
+  def test_parse_header(self):
+    """
+    Quoted values may contain spaces and equal signs.
+    """
+    header = _parse_extxyz_header(
+      'Lattice="5.0 0.0 0.0 0.0 5.0 0.0 0.0 0.0 5.0" '
+      'Properties=species:S:1:pos:R:3 energy=-12.3 pbc="T T F" '
+      "comment='a = b' free_energy = -12.5")
+    self.assertEqual(header["Lattice"], "5.0 0.0 0.0 0.0 5.0 0.0 0.0 0.0 5.0")
+    self.assertEqual(header["Properties"], "species:S:1:pos:R:3")
+    self.assertEqual(header["pbc"], "T T F")
+    self.assertEqual(header["comment"], "a = b")
+    self.assertEqual(header["free_energy"], "-12.5")
+    self.assertAlmostEqual(_get_extxyz_energy(header), -12.3)
+
+  def test_parse_properties(self):
+    """
+    Each property should span its own number of columns.
+    """
+    columns = _parse_extxyz_properties(
+      "species:S:1:forces:R:3:pos:R:3:Z:I:1:magmoms:R:1")
+    self.assertEqual(columns["species"], slice(0, 1))
+    self.assertEqual(columns["forces"], slice(1, 4))
+    self.assertEqual(columns["pos"], slice(4, 7))
+    self.assertEqual(columns["Z"], slice(7, 8))
+    self.assertEqual(columns["magmoms"], slice(8, 9))
+    with self.assertRaises(ValueError):
+      _parse_extxyz_properties("species:S:1:pos:R")
+
+  def test_energy_keys(self):
+    """
+    The energy keys are case-insensitive and a missing energy is an error.
+    """
+    self.assertAlmostEqual(_get_extxyz_energy({"ENERGY": "1.5"}), 1.5)
+    self.assertAlmostEqual(_get_extxyz_energy({"free_energy": "2.5"}), 2.5)
+    with self.assertRaises(ValueError):
+      _get_extxyz_energy(_parse_extxyz_header('pbc="F F F" stress="0 0 0"'))
+
+  def test_xyz_to_database(self):
+    """
+    The columns of each frame should follow its own `Properties`.
+    """
+    xyzfile = join(mkdtemp(), "test.xyz")
+    with open(xyzfile, "w") as fp:
+      fp.write(
+        "2\n"
+        'Lattice="5.0 0.0 0.0 0.0 5.0 0.0 0.0 0.0 5.0" '
+        'Properties=species:S:1:forces:R:3:pos:R:3 energy=-12.3 pbc="T T T"\n'
+        "H 0.01 0.00 -0.02 0.00 0.00 0.00\n"
+        "H -0.01 0.00 0.02 0.00 0.00 0.74\n"
+        "1\n"
+        "Properties=pos:R:3:Z:I:1 Energy=-1.0\n"
+        "0.0 0.0 0.0 8\n")
+    db = Database.from_xyz(xyzfile, num_examples=None, xyz_format='extxyz',
+                           verbose=False)
+    self.assertEqual(db.num_examples, 2)
+    first, second = db[1], db[2]
+    self.assertAlmostEqual(first.get_total_energy(), -12.3)
+    self.assertAllClose(first.positions[1], [0.0, 0.0, 0.74])
+    self.assertAllClose(first.get_forces()[1], [-0.01, 0.0, 0.02])
+    self.assertAllClose(first.cell.diagonal(), [5.0, 5.0, 5.0])
+    self.assertTrue(all(first.pbc))
+    self.assertListEqual(second.get_chemical_symbols(), ["O"])
+    self.assertAlmostEqual(second.get_total_energy(), -1.0)
+
+
+if __name__ == "__main__":
+  tf.test.main()
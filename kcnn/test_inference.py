@@ -0,0 +1,253 @@
+# coding=utf-8
+"""
+The unittests of the kCON inference.
+"""
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import tensorflow as tf
+from ase.atoms import Atoms
+from constants import GHOST
+from transformer import Transformer
+from inference import inference_energy, inference_forces
+from inference import inference_features, inference_forces_from_positions
+
+__author__ = 'Xin Chen'
+__email__ = 'Bismarrck@me.com'
+
+
+# The k-body terms of the test batches and their dims.
+KBODY_TERMS = ["CCX", "CHX", "CCH", "CHH"]
+SPLIT_DIMS = [1, 2, 3, 6]
+NUM_ATOM_TYPES = 3
+
+
+def make_inputs(seed, sparse_weights=False, batch_size=4):
+  """
+  Return a random batch of inputs for `inference_energy`.
+
+  Args:
+    seed: an `int` as the random seed.
+    sparse_weights: a `bool`. If True, about 40% of the weights will be zeros.
+      Otherwise all weights are ones.
+    batch_size: an `int` as the batch size.
+
+  Returns:
+    features: a `float32` array of shape `[batch_size, 1, D, 3]`.
+    occurs: a `float32` array of shape `[batch_size, 1, 1, NUM_ATOM_TYPES]`.
+    weights: a `float32` array of shape `[batch_size, 1, D, 1]`.
+
+  """
+  rng = np.random.RandomState(seed)
+  dim = sum(SPLIT_DIMS)
+  features = rng.rand(batch_size, 1, dim, 3).astype(np.float32)
+  occurs = rng.rand(batch_size, 1, 1, NUM_ATOM_TYPES).astype(np.float32)
+  if sparse_weights:
+    weights = (rng.rand(batch_size, 1, dim, 1) > 0.4).astype(np.float32)
+  else:
+    weights = np.ones((batch_size, 1, dim, 1), dtype=np.float32)
+  return features, occurs, weights
+
+
+def _get_energy_kwargs(occurs, weights, **kwargs):
+  """
+  Return the keyword arguments of `inference_energy` for the test batches. The
+  constants are created in the default graph.
+  """
+  params = dict(occurs=tf.constant(occurs),
+                weights=tf.constant(weights),
+                split_dims=SPLIT_DIMS,
+                num_atom_types=NUM_ATOM_TYPES,
+                kbody_terms=KBODY_TERMS,
+                is_training=False,
+                num_kernels=(8, 4),
+                verbose=False,
+                summary=False)
+  params.update(kwargs)
+  return params
+
+
+class FusedInferenceTest(tf.test.TestCase):
+
+  def test_fused(self):
+    """
+    The fused networks should reuse the variables of the per-term networks and
+    give the same energies and input gradients.
+    """
+    features, occurs, weights = make_inputs(0)
+
+    with tf.Graph().as_default():
+      inputs = tf.constant(features)
+      kwargs = _get_energy_kwargs(occurs, weights, trainable_k_max=2)
+      y_split, _ = inference_energy(inputs, reuse=False, **kwargs)
+      num_variables = len(tf.global_variables())
+      y_fused, _ = inference_energy(inputs, reuse=True, fused=True, **kwargs)
+      self.assertEqual(num_variables, len(tf.global_variables()))
+
+      dydz_split = tf.gradients(y_split, inputs)[0]
+      dydz_fused = tf.gradients(y_fused, inputs)[0]
+
+      with self.test_session() as sess:
+        sess.run(tf.global_variables_initializer())
+        values = sess.run([y_split, y_fused, dydz_split, dydz_fused])
+        self.assertAllClose(values[0], values[1], atol=1e-5)
+        self.assertAllClose(values[2], values[3], atol=1e-5)
+
+
+class SparseInferenceTest(tf.test.TestCase):
+
+  def test_sparse(self):
+    """
+    Skipping the zero-weight rows should give the same energies, contribs and
+    input gradients.
+    """
+    features, occurs, weights = make_inputs(1, sparse_weights=True)
+
+    with tf.Graph().as_default():
+      inputs = tf.constant(features)
+      kwargs = _get_energy_kwargs(occurs, weights)
+      y_dense, contribs_dense = inference_energy(inputs, reuse=False, **kwargs)
+      y_sparse, contribs_sparse = inference_energy(
+        inputs, reuse=True, sparse=True, **kwargs)
+
+      dydz_dense = tf.gradients(y_dense, inputs)[0]
+      dydz_sparse = tf.gradients(y_sparse, inputs)[0]
+
+      with self.test_session() as sess:
+        sess.run(tf.global_variables_initializer())
+        values = sess.run([y_dense, y_sparse, contribs_dense, contribs_sparse,
+                           dydz_dense, dydz_sparse])
+        for i in range(0, len(values), 2):
+          self.assertAllClose(values[i], values[i + 1], atol=1e-5)
+
+
+class PruneInferenceTest(tf.test.TestCase):
+
+  def test_prune(self):
+    """
+    Pruning the gated-off k-body terms should give the same energies, contribs
+    and input gradients without creating their variables.
+    """
+    features, occurs, weights = make_inputs(2)
+
+    with tf.Graph().as_default():
+      inputs = tf.constant(features)
+      kwargs = _get_energy_kwargs(occurs, weights, trainable_k_max=2)
+      y_pruned, _ = inference_energy(inputs, reuse=False, prune=True, **kwargs)
+      for var in tf.global_variables():
+        self.assertNotIn("CCH", var.op.name)
+        self.assertNotIn("CHH", var.op.name)
+
+    with tf.Graph().as_default():
+      inputs = tf.constant(features)
+      kwargs = _get_energy_kwargs(occurs, weights, trainable_k_max=2)
+      y_gated, contribs_gated = inference_energy(inputs, reuse=False, **kwargs)
+      y_pruned, contribs_pruned = inference_energy(
+        inputs, reuse=True, prune=True, **kwargs)
+      y_fused, contribs_fused = inference_energy(
+        inputs, reuse=True, prune=True, fused=True, **kwargs)
+
+      dydz_gated = tf.gradients(y_gated, inputs)[0]
+      dydz_pruned = tf.gradients(y_pruned, inputs)[0]
+      dydz_fused = tf.gradients(y_fused, inputs)[0]
+
+      with self.test_session() as sess:
+        sess.run(tf.global_variables_initializer())
+        values = sess.run([y_gated, contribs_gated, dydz_gated])
+        for outputs in ([y_pruned, contribs_pruned, dydz_pruned],
+                        [y_fused, contribs_fused, dydz_fused]):
+          for expected, value in zip(values, sess.run(outputs)):
+            self.assertAllClose(expected, value, atol=1e-5)
+
+
+class SegmentSumForcesTest(tf.test.TestCase):
+
+  def test_segment_sum(self):
+    """
+    The segment-sum force assembly should give the same forces and gradients as
+    the default gather-based assembly.
+    """
+    batch_size = 3
+    num_rows = 5
+    ck2 = 3
+    num_f = 6
+    num_entries = 4
+    rng = np.random.RandomState(2)
+    features = rng.rand(batch_size, 1, num_rows, ck2).astype(np.float32)
+    coef = rng.rand(batch_size, num_rows, ck2 * 6).astype(np.float32)
+    # Each flattened coefficient contributes to at most one force component.
+    indexing = np.zeros((batch_size, num_f, num_entries), dtype=np.int32)
+    for i in range(batch_size):
+      perm = rng.permutation(num_rows * ck2 * 6)[:num_f * num_entries] + 1
+      perm[rng.rand(perm.size) < 0.3] = 0
+      indexing[i] = perm.reshape((num_f, num_entries))
+
+    with tf.Graph().as_default():
+      inputs = tf.constant(features)
+      w = tf.Variable(rng.rand(1, 1, 1, ck2).astype(np.float32))
+      y_total = tf.reduce_sum(tf.square(inputs * w), axis=(1, 2, 3))
+      kwargs = dict(y_total=y_total,
+                    inputs=inputs,
+                    coefficients=tf.constant(coef),
+                    indexing=tf.constant(indexing),
+                    summary=False)
+      with tf.name_scope("gather"):
+        f_gather = inference_forces(segment_sum=False, **kwargs)
+      with tf.name_scope("segment_sum"):
+        f_segment = inference_forces(segment_sum=True, **kwargs)
+      dfdw_gather = tf.gradients(tf.reduce_sum(tf.square(f_gather)), w)[0]
+      dfdw_segment = tf.gradients(tf.reduce_sum(tf.square(f_segment)), w)[0]
+
+      with self.test_session() as sess:
+        sess.run(tf.global_variables_initializer())
+        values = sess.run([f_gather, f_segment, dfdw_gather, dfdw_segment])
+        self.assertAllClose(values[0], values[1], atol=1e-5)
+        self.assertAllClose(values[2], values[3], atol=1e-5)
+
+
+class PositionsInferenceTest(tf.test.TestCase):
+
+  def test_features_and_forces(self):
+    """
+    The features computed from the positions in the graph and their derivatives
+    should match the outputs of `Transformer`.
+    """
+    species = ["C", "H", "H", "H", "O"]
+    rng = np.random.RandomState(3)
+    list_of_atoms = [Atoms(species, positions=rng.rand(5, 3) * 3.0)
+                     for _ in range(2)]
+    clf = Transformer(species + [GHOST], atomic_forces=True)
+    pairs, units = clf.get_position_indices()
+
+    samples = [clf.transform(atoms) for atoms in list_of_atoms]
+    features = np.array([sample[0] for sample in samples])[:, np.newaxis]
+    coef = np.array([sample[1] for sample in samples])
+    indexing = np.array([sample[2] for sample in samples])
+    coords = np.array([atoms.get_positions() for atoms in list_of_atoms])
+
+    with tf.Graph().as_default():
+      positions = tf.constant(coords, dtype=tf.float32)
+      inputs = inference_features(positions,
+                                  tf.zeros([len(coords)], dtype=tf.int64),
+                                  pairs=pairs[np.newaxis],
+                                  units=units[np.newaxis],
+                                  kbody_terms=clf.kbody_terms,
+                                  split_dims=clf.split_dims)
+      w = tf.constant(rng.rand(1, 1, 1, clf.ck2), dtype=tf.float32)
+      y_total = tf.reduce_sum(tf.square(inputs * w), axis=(1, 2, 3))
+      f_positions = inference_forces_from_positions(
+        y_total, positions, summary=False)
+      f_indexing = inference_forces(y_total,
+                                    inputs,
+                                    coefficients=tf.constant(coef),
+                                    indexing=tf.constant(indexing),
+                                    summary=False)
+
+      with self.test_session() as sess:
+        values = sess.run([inputs, f_positions, f_indexing])
+        self.assertAllClose(values[0], features, atol=1e-5)
+        self.assertAllClose(values[1], values[2], atol=1e-4)
+
+
+if __name__ == "__main__":
+  tf.test.main()
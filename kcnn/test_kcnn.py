@@ -0,0 +1,87 @@
+# coding=utf-8
+"""
+The unittests of the kCON model options.
+"""
+from __future__ import print_function, absolute_import
+
+import tensorflow as tf
+from kcnn import kcnn as inference
+from kcnn import get_session_config, FLAGS
+from test_inference import make_inputs, KBODY_TERMS, SPLIT_DIMS
+from test_inference import NUM_ATOM_TYPES
+
+__author__ = 'Xin Chen'
+__email__ = 'Bismarrck@me.com'
+
+
+def _is_compiled(op):
+  """
+  Return True if the op is marked for the XLA JIT compilation.
+  """
+  try:
+    return op.get_attr("_XlaCompile")
+  except ValueError:
+    return False
+
+
+class XlaJitTest(tf.test.TestCase):
+
+  def tearDown(self):
+    FLAGS.xla_jit = 'none'
+
+  def test_session_config(self):
+    """
+    Only the 'global' mode should set the global JIT level.
+    """
+    for mode, level in (('none', tf.OptimizerOptions.DEFAULT),
+                        ('scope', tf.OptimizerOptions.DEFAULT),
+                        ('global', tf.OptimizerOptions.ON_1)):
+      FLAGS.xla_jit = mode
+      config = get_session_config()
+      self.assertEqual(
+        config.graph_options.optimizer_options.global_jit_level, level)
+    FLAGS.xla_jit = 'all'
+    with self.assertRaises(ValueError):
+      get_session_config()
+
+  def test_jit_scope(self):
+    """
+    The 'scope' mode should only mark the ops of the kCON model and their
+    gradients. The energies should be unchanged.
+    """
+    features, occurs, weights = make_inputs(0)
+
+    values = []
+    for mode in ('none', 'scope'):
+      FLAGS.xla_jit = mode
+      with tf.Graph().as_default() as graph:
+        tf.set_random_seed(1)
+        inputs = tf.constant(features)
+        y_calc, _, _ = inference(inputs, tf.constant(occurs),
+                                 tf.constant(weights),
+                                 split_dims=SPLIT_DIMS,
+                                 num_atom_types=NUM_ATOM_TYPES,
+                                 kbody_terms=KBODY_TERMS,
+                                 is_training=False,
+                                 num_kernels=(8, 4),
+                                 verbose=False,
+                                 add_summary=False)
+        loss = tf.reduce_sum(y_calc, name="loss")
+        tf.gradients(loss, inputs)
+        grad_ops = [op for op in graph.get_operations()
+                    if op.name.startswith("gradients/kCON/")]
+
+        self.assertEqual(_is_compiled(y_calc.op), mode == 'scope')
+        self.assertEqual(any(map(_is_compiled, grad_ops)), mode == 'scope')
+        self.assertFalse(_is_compiled(loss.op))
+
+        with self.test_session(graph=graph,
+                               config=get_session_config()) as sess:
+          sess.run(tf.global_variables_initializer())
+          values.append(sess.run(y_calc))
+
+    self.assertAllClose(values[0], values[1], atol=1e-5)
+
+
+if __name__ == "__main__":
+  tf.test.main()
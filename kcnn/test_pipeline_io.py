@@ -0,0 +1,332 @@
+# coding=utf-8
+"""
+The unittests of decoding the stored datasets in the input pipeline.
+"""
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import tensorflow as tf
+from functools import partial
+from os.path import join
+from tempfile import mkdtemp
+from constants import KcnnGraphKeys
+from transformer import pack_native
+from pipeline import decode_protobuf, decode_protobuf_batch
+from pipeline import BucketedExample, trim_batch, get_store_decode_fn
+from pipeline import get_active_terms, get_input_saveables, _make_saveable
+from pipeline import get_view_indices, unpack_native, FLAGS
+from store import NpyStoreWriter, open_store, ENERGY_FIELDS
+from store import TFRecordsWriter, get_forces_filename, get_term_field
+from store import get_term_filename
+
+__author__ = 'Xin Chen'
+__email__ = 'Bismarrck@me.com'
+
+
+def _make_example(cnk, ck2, num_atom_types, seed):
+  """
+  Serialize a random energy example.
+  """
+  rng = np.random.RandomState(seed)
+
+  def _bytes(x):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[x.tobytes()]))
+
+  example = tf.train.Example(features=tf.train.Features(feature={
+    'features': _bytes(rng.rand(cnk * ck2).astype(np.float32)),
+    'energy': _bytes(rng.rand(1).astype(np.float64)),
+    'occurs': _bytes(rng.rand(num_atom_types).astype(np.float32)),
+    'weights': _bytes(rng.rand(cnk).astype(np.float32)),
+    'loss_weight': tf.train.Feature(
+      float_list=tf.train.FloatList(value=[rng.rand()])),
+  }))
+  return example.SerializeToString()
+
+
+class PipelineIOTest(tf.test.TestCase):
+
+  def test_decode_protobuf_batch(self):
+    """
+    The vectorized batch decoder should be identical to the per-example decoder
+    followed by `batch`.
+    """
+    cnk, ck2, num_atom_types, batch_size = 6, 3, 2, 4
+    protos = [_make_example(cnk, ck2, num_atom_types, i) for i in range(10)]
+    kwargs = dict(cnk=cnk, ck2=ck2, num_atom_types=num_atom_types)
+
+    with tf.Graph().as_default():
+      dataset = tf.data.Dataset.from_tensor_slices(protos)
+      old = dataset.map(partial(decode_protobuf, **kwargs)).batch(batch_size)
+      new = dataset.batch(batch_size).map(
+        partial(decode_protobuf_batch, **kwargs))
+      old_next = old.make_one_shot_iterator().get_next()
+      new_next = new.make_one_shot_iterator().get_next()
+
+      with tf.Session() as sess:
+        for _ in range(3):
+          old_values, new_values = sess.run([old_next, new_next])
+          for x, y in zip(old_values, new_values):
+            assert x.shape == y.shape
+            assert np.allclose(x, y)
+        try:
+          sess.run(new_next)
+        except tf.errors.OutOfRangeError:
+          pass
+        else:
+          raise AssertionError("The dataset should be exhausted!")
+
+  def test_split_forces_stream(self):
+    """
+    Decoding the separate energy and forces streams should give the same batches
+    as decoding the combined records.
+    """
+    cnk, ck2, num_atom_types, num_f, num_entries = 6, 3, 2, 9, 4
+    num_examples, batch_size = 10, 4
+    rng = np.random.RandomState(0)
+    examples = []
+    for _ in range(num_examples):
+      examples.append({
+        'features': rng.rand(cnk * ck2),
+        'energy': rng.rand(1),
+        'occurs': rng.rand(num_atom_types),
+        'weights': rng.rand(cnk),
+        'loss_weight': rng.rand(),
+        'forces': rng.rand(num_f),
+        'coef': rng.rand(cnk * ck2 * 6),
+        'indexing': rng.randint(0, cnk * ck2, size=num_f * num_entries),
+      })
+
+    workdir = mkdtemp()
+    combined = join(workdir, "combined.tfrecords")
+    energy = join(workdir, "split.tfrecords")
+    for writer in (TFRecordsWriter([combined], num_examples),
+                   TFRecordsWriter([energy], num_examples,
+                                   [get_forces_filename(energy)])):
+      for example in examples:
+        writer.write(example)
+      writer.close()
+
+    decode_fn = partial(decode_protobuf_batch, cnk=cnk, ck2=ck2,
+                        num_atom_types=num_atom_types, atomic_forces=True,
+                        num_f_components=num_f, num_entries=num_entries)
+
+    with tf.Graph().as_default():
+      old = tf.data.TFRecordDataset(combined).batch(batch_size).map(decode_fn)
+      new = tf.data.Dataset.zip(
+        (tf.data.TFRecordDataset(energy),
+         tf.data.TFRecordDataset(get_forces_filename(energy))))
+      new = new.batch(batch_size).map(
+        lambda e, f: decode_fn(e, forces_proto=f))
+      old_next = old.make_one_shot_iterator().get_next()
+      new_next = new.make_one_shot_iterator().get_next()
+
+      with tf.Session() as sess:
+        for _ in range(3):
+          old_values, new_values = sess.run([old_next, new_next])
+          for x, y in zip(old_values, new_values):
+            assert x.shape == y.shape
+            assert np.allclose(x, y)
+
+  def test_columnar_features(self):
+    """
+    Reading only the active k-body terms of a columnar dataset should give the
+    full features with the inactive blocks zeroed.
+    """
+    kbody_terms = ["C,C,X", "C,H,X", "C,C,H"]
+    kbody_dims = [2, 3, 4]
+    cnk, ck2, num_atom_types, num_examples, batch_size = 9, 3, 2, 6, 3
+    assert get_active_terms(kbody_terms, k_max=2) == [0, 1]
+    assert get_active_terms(kbody_terms) == [0, 1, 2]
+
+    rng = np.random.RandomState(1)
+    workdir = mkdtemp()
+    filename = join(workdir, "columnar.tfrecords")
+    writer = TFRecordsWriter([filename], num_examples,
+                             num_terms=len(kbody_dims))
+    expected = []
+    for _ in range(num_examples):
+      features = rng.rand(cnk, ck2).astype(np.float32)
+      example = {'energy': rng.rand(1),
+                 'occurs': rng.rand(num_atom_types),
+                 'weights': rng.rand(cnk),
+                 'loss_weight': rng.rand()}
+      for i, block in enumerate(np.split(features, np.cumsum(kbody_dims)[:-1])):
+        example[get_term_field(i)] = block
+      writer.write(example)
+      features[2 + 3:] = 0.0
+      expected.append(features)
+    writer.close()
+    expected = np.asarray(expected).reshape((-1, batch_size, 1, cnk, ck2))
+
+    with tf.Graph().as_default():
+      dataset = tf.data.Dataset.zip(
+        (tf.data.TFRecordDataset(filename),
+         tf.data.TFRecordDataset(get_term_filename(filename, 0)),
+         tf.data.TFRecordDataset(get_term_filename(filename, 1))))
+      dataset = dataset.batch(batch_size).map(
+        lambda proto, t0, t1: decode_protobuf_batch(
+          proto, cnk=cnk, ck2=ck2, num_atom_types=num_atom_types,
+          term_protos={0: t0, 1: t1}, kbody_dims=kbody_dims))
+      next_op = dataset.make_one_shot_iterator().get_next()
+
+      with tf.Session() as sess:
+        for i in range(len(expected)):
+          values = sess.run(next_op)
+          assert np.allclose(values.features, expected[i])
+
+  def test_native_features(self):
+    """
+    Unpacking the fields of the native mixed-k layout should give the dense
+    features and coefficients.
+    """
+    kbody_dims = [2, 3, 4]
+    widths = [1, 1, 3]
+    cnk, ck2, batch_size = 9, 3, 4
+    rng = np.random.RandomState(2)
+    features = rng.rand(batch_size, cnk, ck2).astype(np.float32)
+    coef = rng.rand(batch_size, cnk, 6, ck2).astype(np.float32)
+    features[:, :5, 1:] = 0.0
+    coef[:, :5, :, 1:] = 0.0
+    coef = coef.reshape((batch_size, cnk, 6 * ck2))
+
+    packed_features = np.asarray(
+      [pack_native(x, kbody_dims, widths) for x in features])
+    packed_coef = np.asarray(
+      [pack_native(x, kbody_dims, widths, num_groups=6) for x in coef])
+    assert packed_features.shape == (batch_size, 2 + 3 + 12)
+    assert packed_coef.shape == (batch_size, (2 + 3 + 12) * 6)
+
+    with tf.Graph().as_default():
+      ops = [unpack_native(tf.constant(packed_features), kbody_dims, widths,
+                           ck2),
+             unpack_native(tf.constant(packed_coef), kbody_dims, widths, ck2,
+                           num_groups=6)]
+      with tf.Session() as sess:
+        values = sess.run(ops)
+        assert np.allclose(values[0], features)
+        assert np.allclose(values[1], coef)
+
+  def test_input_state(self):
+    """
+    The input iterator should resume from the checkpointed position. Checkpoints
+    without the iterator state should still be restorable.
+    """
+    workdir = mkdtemp()
+    with tf.Graph().as_default():
+      dataset = tf.data.Dataset.range(100).shuffle(10, seed=1).batch(5)
+      iterator = dataset.make_one_shot_iterator()
+      next_op = iterator.get_next()
+      tf.add_to_collection(KcnnGraphKeys.INPUT_STATE, _make_saveable(iterator))
+      step = tf.Variable(0, name='step')
+
+      with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        for _ in range(3):
+          sess.run(next_op)
+        old = tf.train.Saver([step]).save(sess, join(workdir, "old"))
+        assert get_input_saveables(old) == []
+        new = tf.train.Saver([step] + get_input_saveables()).save(
+          sess, join(workdir, "new"))
+        expected = [sess.run(next_op) for _ in range(3)]
+
+      with tf.Session() as sess:
+        saveables = get_input_saveables(new)
+        assert len(saveables) == 1
+        tf.train.Saver([step] + saveables).restore(sess, new)
+        for values in expected:
+          assert np.array_equal(sess.run(next_op), values)
+
+  def test_view_indices(self):
+    """
+    The train and test views should partition the indexed store and the test
+    folds should cover every example exactly once.
+    """
+    num_examples = 103
+    FLAGS.num_folds = 0
+    FLAGS.view_test_size = 0.2
+    train = get_view_indices(num_examples, True)
+    test = get_view_indices(num_examples, False)
+    assert len(test) == 21
+    assert np.array_equal(np.union1d(train, test), np.arange(num_examples))
+    assert len(np.intersect1d(train, test)) == 0
+
+    FLAGS.num_folds = 5
+    folds = []
+    for fold in range(5):
+      FLAGS.fold = fold
+      train = get_view_indices(num_examples, True)
+      test = get_view_indices(num_examples, False)
+      assert len(np.intersect1d(train, test)) == 0
+      assert len(train) + len(test) == num_examples
+      folds.append(test)
+    assert np.array_equal(np.sort(np.concatenate(folds)),
+                          np.arange(num_examples))
+    FLAGS.num_folds = 0
+    FLAGS.fold = 0
+
+  def test_trim_batch(self):
+    """
+    Each k-body block should be trimmed to the maximum real size of the batch.
+    """
+    split_dims = [4, 3]
+    features = np.zeros((2, 1, 7, 3), dtype=np.float32)
+    weights = np.zeros((2, 1, 7, 1), dtype=np.float32)
+    sizes = np.array([[2, 1], [3, 0]], dtype=np.int64)
+    for i in range(2):
+      for j, offset in enumerate((0, 4)):
+        features[i, 0, offset: offset + sizes[i, j]] = 1.0
+        weights[i, 0, offset: offset + sizes[i, j]] = 1.0
+
+    with tf.Graph().as_default():
+      batch = BucketedExample(features=tf.constant(features),
+                              energy=tf.zeros(2, dtype=tf.float64),
+                              occurs=tf.zeros((2, 1, 1, 2)),
+                              weights=tf.constant(weights),
+                              y_weight=tf.ones(2),
+                              split_dims=tf.constant(sizes))
+      trimmed = trim_batch(batch, split_dims)
+      with tf.Session() as sess:
+        x, w, dims = sess.run(
+          [trimmed.features, trimmed.weights, trimmed.split_dims])
+
+    assert list(dims) == [3, 1]
+    assert x.shape == (2, 1, 4, 3)
+    assert np.allclose(x[:, 0, :3], features[:, 0, :3])
+    assert np.allclose(x[:, 0, 3], features[:, 0, 4])
+    assert np.allclose(w.sum(axis=(1, 2, 3)), sizes.sum(axis=1))
+
+  def test_npy_store(self):
+    """
+    Batches sliced from a NumPy feature store should match the written examples.
+    """
+    cnk, ck2, num_atom_types, num_examples = 6, 3, 2, 5
+    rng = np.random.RandomState(1)
+    examples = [{'features': rng.rand(cnk, ck2),
+                 'energy': np.atleast_2d(rng.rand()),
+                 'occurs': rng.rand(1, num_atom_types),
+                 'weights': rng.rand(cnk),
+                 'loss_weight': rng.rand(),
+                 'sizes': [4, 2]} for _ in range(num_examples)]
+    store_dir = join(mkdtemp(), "test-train")
+    writer = NpyStoreWriter(store_dir, num_examples)
+    for example in examples:
+      writer.write(example)
+    writer.close()
+
+    arrays = open_store(store_dir, ENERGY_FIELDS)
+    decode_fn = get_store_decode_fn(arrays, cnk=cnk, ck2=ck2,
+                                    num_atom_types=num_atom_types)
+    with tf.Graph().as_default():
+      batch = decode_fn(tf.constant([3, 0, 1], dtype=tf.int64))
+      with tf.Session() as sess:
+        features, energy = sess.run([batch.features, batch.energy])
+
+    # The indices are sorted within a batch.
+    assert features.shape == (3, 1, cnk, ck2)
+    for i, index in enumerate([0, 1, 3]):
+      assert np.allclose(features[i, 0], examples[index]['features'])
+      assert np.isclose(energy[i], examples[index]['energy'][0, 0])
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -0,0 +1,111 @@
+# coding=utf-8
+"""
+The unittests of the 8-bit quantization.
+"""
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import tensorflow as tf
+from quantize import quantize_weights, quantize_graph_def, eightbit_graph_def
+from save_model import fold_int8_weights
+
+__author__ = 'Xin Chen'
+__email__ = 'Bismarrck@me.com'
+
+
+class QuantizeTest(tf.test.TestCase):
+
+  def test_quantize_weights(self):
+    """
+    The per-channel errors should be bounded by half of the channel scales.
+    """
+    rng = np.random.RandomState(0)
+    weights = rng.randn(1, 1, 6, 4).astype(np.float32)
+    weights[..., 1] *= 100.0
+    weights[..., 3] = 0.0
+    quantized, scales = quantize_weights(weights)
+    self.assertEqual(quantized.dtype, np.int8)
+    self.assertEqual(scales.shape, (4, ))
+    self.assertTrue(np.all(np.abs(quantized[..., :3]).max(axis=(0, 1, 2))
+                           == 127))
+    self.assertTrue(np.all(
+      np.abs(quantized * scales - weights) <= scales / 2.0 + 1e-6))
+
+  def test_quantize_graph_def(self):
+    """
+    The quantized kernels should replace the float kernels by name and the
+    outputs should be close.
+    """
+    rng = np.random.RandomState(1)
+    features = rng.rand(4, 1, 5, 3).astype(np.float32)
+    name = "kCON/CCH/Hidden1/1x1Conv1/weights"
+
+    with tf.Graph().as_default() as graph:
+      inputs = tf.placeholder(tf.float32, (None, 1, None, 3), name="inputs")
+      kernel = tf.constant(rng.randn(1, 1, 3, 8).astype(np.float32), name=name)
+      outputs = tf.nn.conv2d(inputs, kernel, [1, 1, 1, 1], "SAME",
+                             name="outputs")
+      with self.test_session(graph=graph) as sess:
+        expected = sess.run(outputs, feed_dict={inputs: features})
+      graph_def = graph.as_graph_def()
+
+    quantized_graph_def, names = quantize_graph_def(graph_def)
+    self.assertListEqual(names, [name])
+
+    with tf.Graph().as_default() as graph:
+      tf.import_graph_def(quantized_graph_def, name="")
+      self.assertEqual(
+        graph.get_tensor_by_name(name + "/quantized:0").dtype, tf.int8)
+      with self.test_session(graph=graph) as sess:
+        values = sess.run("outputs:0", feed_dict={"inputs:0": features})
+        self.assertAllClose(expected, values, atol=0.05)
+
+    # The predictor folds the dequantized kernels back to float constants.
+    folded_graph_def = fold_int8_weights(quantized_graph_def)
+    self.assertNotIn("Cast", set(node.op for node in folded_graph_def.node))
+    self.assertEqual(len(folded_graph_def.node), len(graph_def.node))
+    self.assertIs(fold_int8_weights(graph_def), graph_def)
+
+    with tf.Graph().as_default() as graph:
+      tf.import_graph_def(folded_graph_def, name="")
+      self.assertEqual(graph.get_tensor_by_name(name + ":0").op.type, "Const")
+      with self.test_session(graph=graph) as sess:
+        folded = sess.run("outputs:0", feed_dict={"inputs:0": features})
+        self.assertAllClose(values, folded, atol=1e-5)
+
+  def test_eightbit_graph_def(self):
+    """
+    The convolutions should be rewritten with 8-bit ops and the outputs should
+    be close.
+    """
+    rng = np.random.RandomState(2)
+    features = rng.rand(4, 1, 5, 3).astype(np.float32)
+
+    with tf.Graph().as_default() as graph:
+      inputs = tf.placeholder(tf.float32, (None, 1, None, 3),
+                              name="placeholders/inputs")
+      kernel = tf.constant(rng.randn(1, 1, 3, 8).astype(np.float32),
+                           name="kCON/CCH/Hidden1/1x1Conv1/weights")
+      outputs = tf.nn.conv2d(inputs, kernel, [1, 1, 1, 1], "SAME")
+      outputs = tf.reduce_sum(outputs, axis=[1, 2, 3],
+                              name="kCON/Energy/Sum/1_and_k")
+      with self.test_session(graph=graph) as sess:
+        expected = sess.run(outputs, feed_dict={inputs: features})
+      graph_def = graph.as_graph_def()
+
+    quantized_graph_def, names = eightbit_graph_def(graph_def)
+    ops = set(node.op for node in quantized_graph_def.node)
+    self.assertIn("QuantizedConv2D", ops)
+    self.assertNotIn("Conv2D", ops)
+    self.assertGreater(len(names), 0)
+
+    with tf.Graph().as_default() as graph:
+      tf.import_graph_def(quantized_graph_def, name="")
+      with self.test_session(graph=graph) as sess:
+        values = sess.run("kCON/Energy/Sum/1_and_k:0",
+                          feed_dict={"placeholders/inputs:0": features})
+        self.assertAllClose(expected, values, rtol=0.05, atol=0.1)
+
+
+if __name__ == "__main__":
+  tf.test.main()
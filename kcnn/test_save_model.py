@@ -0,0 +1,97 @@
+# coding=utf-8
+"""
+The unittests of exporting models.
+"""
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib.layers import batch_norm, conv2d
+from save_model import optimize_for_inference, specialize_graph_def
+
+__author__ = 'Xin Chen'
+__email__ = 'Bismarrck@me.com'
+
+
+class OptimizeForInferenceTest(tf.test.TestCase):
+
+  def test_fold_batch_norm(self):
+    """
+    The batch norms should be folded into the convolutions and the optimized
+    graph should give the same outputs.
+    """
+    rng = np.random.RandomState(0)
+    features = rng.rand(4, 1, 5, 3).astype(np.float32)
+
+    with tf.Graph().as_default() as graph:
+      with tf.name_scope("placeholders"):
+        inputs = tf.placeholder(tf.float32, (None, 1, None, 3), name="inputs")
+      outputs = conv2d(inputs, num_outputs=8, kernel_size=1,
+                       activation_fn=None, biases_initializer=None)
+      outputs = batch_norm(outputs, scale=True, center=True,
+                           is_training=False)
+      outputs = tf.identity(tf.nn.relu(outputs), name="outputs")
+      output_node_names = ["placeholders/inputs", "outputs"]
+
+      with self.test_session(graph=graph) as sess:
+        sess.run(tf.global_variables_initializer())
+        for var in tf.global_variables():
+          sess.run(var.assign(rng.rand(*var.shape.as_list()) + 0.5))
+        expected = sess.run(outputs, feed_dict={inputs: features})
+        graph_def = tf.graph_util.convert_variables_to_constants(
+          sess, graph.as_graph_def(), output_node_names)
+
+    graph_def = optimize_for_inference(graph_def, output_node_names)
+    ops = set(node.op for node in graph_def.node)
+    self.assertNotIn("FusedBatchNorm", ops)
+    self.assertNotIn("Rsqrt", ops)
+
+    with tf.Graph().as_default() as graph:
+      tf.import_graph_def(graph_def, name="")
+      with self.test_session(graph=graph) as sess:
+        values = sess.run("outputs:0",
+                          feed_dict={"placeholders/inputs:0": features})
+        self.assertAllClose(expected, values, atol=1e-5)
+
+
+class SpecializeGraphDefTest(tf.test.TestCase):
+
+  def test_specialize(self):
+    """
+    The specialized graph should have static input shapes and constant
+    `split_dims` and should give the same outputs.
+    """
+    rng = np.random.RandomState(1)
+    split_dims = [2, 3]
+    features = rng.rand(4, 1, sum(split_dims), 3).astype(np.float32)
+
+    with tf.Graph().as_default() as graph:
+      with tf.name_scope("placeholders"):
+        inputs = tf.placeholder(tf.float32, (None, 1, None, 3), name="inputs")
+        split_dims_ = tf.placeholder(tf.int64, (2, ), name="split_dims")
+      blocks = tf.split(inputs, split_dims_, axis=2)
+      outputs = tf.add_n([tf.reduce_sum(block * float(i + 1), axis=(1, 2, 3))
+                          for i, block in enumerate(blocks)], name="outputs")
+      output_node_names = ["placeholders/inputs", "placeholders/split_dims",
+                           "outputs"]
+      with self.test_session(graph=graph) as sess:
+        expected = sess.run(outputs, feed_dict={inputs: features,
+                                                split_dims_: split_dims})
+      graph_def = graph.as_graph_def()
+
+    graph_def = specialize_graph_def(graph_def, split_dims, len(features),
+                                     output_node_names)
+
+    with tf.Graph().as_default() as graph:
+      tf.import_graph_def(graph_def, name="")
+      self.assertEqual(
+        graph.get_tensor_by_name("placeholders/split_dims:0").op.type, "Const")
+      inputs = graph.get_tensor_by_name("placeholders/inputs:0")
+      self.assertListEqual(inputs.shape.as_list(), [4, 1, 5, 3])
+      with self.test_session(graph=graph) as sess:
+        values = sess.run("outputs:0", feed_dict={inputs: features})
+        self.assertAllClose(expected, values, atol=1e-5)
+
+
+if __name__ == "__main__":
+  tf.test.main()
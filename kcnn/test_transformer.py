@@ -9,6 +9,7 @@ import numpy as np
 import transformer
 from ase import Atoms
 from utils import get_atoms_from_kbody_term
+from database import StructureRecord
 from itertools import repeat, chain, combinations
 from scipy.misc import comb
 from sklearn.metrics import pairwise_distances
@@ -172,6 +173,15 @@ class MultiTransformerTest(tf.test.TestCase):
     clf = transformer.MultiTransformer(["C", "X", "H", "Zn"])
     self.assertListEqual(clf.atom_types, ["C", "H", "Zn", "X"])
 
+  def test_cached_transformers(self):
+    """
+    The transformer of a stoichiometry should only be built once.
+    """
+    clf = transformer.MultiTransformer(["C", "H"], k_max=3)
+    first = clf._get_transformer(["C", "H", "H"])
+    self.assertIs(clf._get_transformer(["C", "H", "H"]), first)
+    self.assertEqual(len(clf._transformers), 1)
+
 
 class FixedLenMultiTransformerTest(tf.test.TestCase):
   """
@@ -202,6 +212,93 @@ class FixedLenMultiTransformerTest(tf.test.TestCase):
     self.assertListEqual(list(sample.split_dims), list(example.split_dims))
     self.assertTupleEqual(example.features.shape, (total_dim, 3))
 
+  def test_structure_record(self):
+    max_occurs = {"C": 2, "H": 4, "O": 1}
+    clf = transformer.FixedLenMultiTransformer(max_occurs, k_max=3)
+    species = get_species(max_occurs)
+    coords = get_example(len(species)) * 1.2
+    atoms = Atoms(species, coords)
+    record = StructureRecord.from_atoms(atoms)
+    self.assertListEqual(record.get_chemical_symbols(), species)
+    expected = clf.transform(atoms)
+    sample = clf.transform(record)
+    self.assertAllClose(sample.features, expected.features)
+    self.assertAllClose(sample.binary_weights, expected.binary_weights)
+    self.assertAllClose(sample.occurs, expected.occurs)
+
+  def test_native(self):
+    max_occurs = {"C": 2, "H": 3}
+    kwargs = dict(k_max=3, atomic_forces=True)
+    ghost = transformer.FixedLenMultiTransformer(max_occurs, **kwargs)
+    native = transformer.FixedLenMultiTransformer(
+      max_occurs, native=True, **kwargs)
+    self.assertListEqual(native.atom_types, ["C", "H"])
+    self.assertListEqual(native.kbody_terms,
+                         ["CC", "CH", "HH", "CCH", "CHH", "HHH"])
+    self.assertTupleEqual(native.shape, ghost.shape)
+
+    species = get_species({"C": 2, "H": 2})
+    atoms = Atoms(species, get_example(len(species)) * 1.2)
+    a = ghost.transform(atoms)
+    b = native.transform(atoms)
+    self.assertTupleEqual(a.indexing.shape, b.indexing.shape)
+    self.assertEqual(np.count_nonzero(a.indexing),
+                     np.count_nonzero(b.indexing))
+
+    # The blocks of the same k-body terms should be identical.
+    offsets = np.cumsum([0] + list(a.split_dims))
+    for i, kbody_term in enumerate(ghost.kbody_terms):
+      j = native.kbody_terms.index(kbody_term.replace("X", ""))
+      istart = int(np.sum(b.split_dims[:j]))
+      istop = istart + b.split_dims[j]
+      self.assertAllClose(a.features[offsets[i]: offsets[i + 1]],
+                          b.features[istart: istop])
+      self.assertAllClose(a.binary_weights[offsets[i]: offsets[i + 1]],
+                          b.binary_weights[istart: istop])
+
+    # The unused columns of the 2-body terms are not saved.
+    widths = [1, 1, 1, 3, 3, 3]
+    packed = transformer.pack_native(b.features, b.split_dims, widths)
+    self.assertEqual(len(packed), np.dot(b.split_dims, widths))
+    self.assertAllClose(np.sort(packed[packed != 0]),
+                        np.sort(b.features[b.features != 0]))
+
+  def test_shard_filenames(self):
+    filename = "binary/qm7-train.tfrecords"
+    self.assertListEqual(
+      transformer.get_shard_filenames(filename, 10, None), [filename])
+    self.assertListEqual(
+      transformer.get_shard_filenames(filename, 10, 10), [filename])
+    self.assertListEqual(
+      transformer.get_shard_filenames(filename, 10, 4),
+      ["binary/qm7-train-00000-of-00003.tfrecords",
+       "binary/qm7-train-00001-of-00003.tfrecords",
+       "binary/qm7-train-00002-of-00003.tfrecords"])
+
+
+
+class OneBodyCalculatorTest(tf.test.TestCase):
+
+  def test_from_counts(self):
+    atom_types = ["C", "H", "N", "X"]
+    rng = np.random.RandomState(0)
+    examples = []
+    for _ in range(20):
+      species = ["C"] * rng.randint(1, 4) + ["H"] * rng.randint(0, 6) + \
+                ["N"] * rng.randint(0, 2)
+      examples.append((species, rng.randn() - len(species)))
+
+    for algorithm in ("default", "minimal"):
+      calculator = transformer.OneBodyCalculator(
+        atom_types, len(examples), algorithm=algorithm)
+      for i, (species, y_true) in enumerate(examples):
+        calculator.add(i, species, y_true)
+      restored = transformer.OneBodyCalculator.from_counts(
+        atom_types, calculator.coef.copy(), calculator.b.copy(),
+        algorithm=algorithm)
+      self.assertDictEqual(restored.minima, calculator.minima)
+      self.assertAllClose(restored.compute(), calculator.compute())
+
 
 if __name__ == "__main__":
   tf.test.main()
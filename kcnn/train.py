@@ -9,7 +9,7 @@ import tensorflow as tf
 import time
 import kcnn
 import pipeline
-from kcnn import kcnn_from_dataset
+from kcnn import kcnn_from_dataset, get_session_config
 from save_model import save_model
 from os.path import join
 from tensorflow.python.client.timeline import Timeline
@@ -239,7 +239,9 @@ def train_model():
         if vk == -1 or vk == 2:
           var_list.append(var)
     else:
-      var_list = tf.global_variables()
+      # Resume the input stream from the latest checkpoint as well.
+      var_list = tf.global_variables() + pipeline.get_input_saveables(
+        tf.train.latest_checkpoint(FLAGS.train_dir))
 
     scaffold = tf.train.Scaffold(
       saver=tf.train.Saver(max_to_keep=FLAGS.max_to_keep, var_list=var_list))
@@ -279,7 +281,7 @@ def train_model():
                TimelineHook(),
                tf.train.StopAtStepHook(last_step=max_steps)],
         scaffold=scaffold,
-        config=tf.ConfigProto(
+        config=get_session_config(
           log_device_placement=FLAGS.log_device_placement,
           allow_soft_placement=True)) as mon_sess:
 
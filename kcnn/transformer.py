@@ -18,10 +18,11 @@ from os.path import basename, dirname, join, splitext
 from ase.atoms import Atoms
 from scipy.misc import comb
 from sklearn.metrics import pairwise_distances
-from tensorflow.python.training.training import Features, Example
 from constants import pyykko, GHOST, LJR
 from utils import get_atoms_from_kbody_term, safe_divide, compute_n_from_cnk
-from utils import Gauss
+from utils import Gauss, get_kbody_widths
+from store import TFRecordsWriter, NpyStoreWriter, get_store_dir
+from store import get_forces_filename, get_term_field, get_pairs_filename
 
 __author__ = 'Xin Chen'
 __email__ = 'Bismarrck@me.com'
@@ -328,18 +329,52 @@ def inverse_norm_prime(x, unit=1.0, order=1, z=None):
   return -z**2
 
 
-def _bytes_feature(value):
+def pack_native(array, split_dims, widths, num_groups=1):
   """
-  Convert the `value` to Protobuf bytes.
+  Pack a dense matrix of the fixed-length layout into the native mixed-k layout
+  in which each k-body term only keeps its own C(k, 2) columns.
+
+  Args:
+    array: a 2D array of shape `[sum(split_dims), num_groups * C(k_max, 2)]`.
+    split_dims: a `List[int]` as the dims of the k-body terms.
+    widths: a `List[int]` as the native widths of the k-body terms. See
+      `utils.get_kbody_widths`.
+    num_groups: an `int` as the number of column groups. The features have one
+      group and the coefficients matrix has six.
+
+  Returns:
+    packed: a 1D array of length `sum(split_dims * widths) * num_groups`.
+
   """
-  return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+  ck2 = array.shape[1] // num_groups
+  blocks = np.split(array, np.cumsum(split_dims)[:-1], axis=0)
+  return np.concatenate([
+    block.reshape((-1, num_groups, ck2))[:, :, :width].flatten()
+    for block, width in zip(blocks, widths)])
 
 
-def _float_feature(value):
+def get_shard_filenames(filename, num_examples, examples_per_shard=None):
   """
-  Convert the `value` to Protobuf float32.
+  Return the shard files of a tfrecords file. The shards are named
+  '{name}-{index:05d}-of-{num_shards:05d}.tfrecords'.
+
+  Args:
+    filename: a `str` as the tfrecords file.
+    num_examples: an `int` as the total number of examples to write.
+    examples_per_shard: an `int` as the maximum number of examples per shard.
+      If None or not smaller than `num_examples`, `filename` will be the only
+      shard.
+
+  Returns:
+    filenames: a `List[str]` as the shard files.
+
   """
-  return tf.train.Feature(float_list=tf.train.FloatList(value=[value]))
+  if not examples_per_shard or examples_per_shard >= num_examples:
+    return [filename]
+  num_shards = int(np.ceil(num_examples / examples_per_shard))
+  stem, ext = splitext(filename)
+  return ["{}-{:05d}-of-{:05d}{}".format(stem, i, num_shards, ext)
+          for i in range(num_shards)]
 
 
 class Transformer:
@@ -411,6 +446,11 @@ class Transformer:
         kbody_sizes.append(size)
       n = compute_n_from_cnk(offsets[-1], k_max)
 
+    # In the native mixed-k layout the 2-body terms are not padded with ghost
+    # atoms but the total dim is still C(N + 1, k_max).
+    native = num_ghosts == 0 and any(
+      len(get_atoms_from_kbody_term(x)) < k_max for x in kbody_terms)
+
     # Initialize internal variables.
     self._lj = lj
     self._k_max = k_max
@@ -430,7 +470,7 @@ class Transformer:
     self._binary_weights = self._get_binary_weights()
     self._atomic_forces = atomic_forces
     self._indexing_matrix = None
-    self._num_real = n - self._num_ghosts
+    self._num_real = n - self._num_ghosts - int(native)
     self._num_f_components = 3 * self._num_real
     self._num_entries = _get_num_force_entries(self._num_real, self._k_max)
     self._norm = norm
@@ -591,10 +631,10 @@ class Transformer:
       thres = 0.0
     for i, kbody_term in enumerate(self._kbody_terms):
       istart, istop = self._offsets[i], self._offsets[i + 1]
-      if GHOST in kbody_term:
-        table[istart: istop, 0] = thres
-      else:
-        table[istart: istop, :] = thres
+      # Only the columns of the real atom pairs are compared.
+      symbols = get_atoms_from_kbody_term(kbody_term)
+      k = len(symbols) - symbols.count(GHOST)
+      table[istart: istop, :comb(k, 2, exact=True)] = thres
     return table
 
   @staticmethod
@@ -853,7 +893,8 @@ class Transformer:
       # `split_dims` is fixed.
       istep = min(self._offsets[i + 1] - istart, mapping.shape[1])
       istop = istart + istep
-      for k in range(self._ck2):
+      # The native 2-body terms only have one column.
+      for k in range(mapping.shape[0]):
         features[istart: istop, k] = norm_dists[mapping[k]]
         if self._atomic_forces:
           cr[istart: istop, k] = self._cmatrix[mapping[k]]
@@ -1036,11 +1077,12 @@ class Transformer:
     start = 1
 
     for i in range(cnk):
-      if indexing[i].min() >= 0:
+      if indexing[i, 0, 0] >= 0:
         for j in range(ck2):
           a, b = indexing[i, j, :]
-          # The contributions from Atom-Ghost pairs should be ignored.
-          if a >= imax or b >= imax:
+          # The contributions from Atom-Ghost pairs and the unused columns of
+          # the native 2-body terms should be ignored.
+          if a < 0 or a >= imax or b >= imax:
             continue
           ax = a * 3 + 0
           ay = a * 3 + 1
@@ -1061,6 +1103,32 @@ class Transformer:
 
     return positions
 
+  def get_position_indices(self):
+    """
+    Return the static tables for computing the input feature matrix from the
+    atomic positions in the graph. See `inference.inference_features`.
+
+    Returns:
+      pairs: an `int32` array of shape `[self.shape[0], self.shape[1], 2]` as
+        the atom pairs of the entries before the conditional sorting. The
+        entries of the padded rows are -1 and the entries of the atom-ghost
+        pairs are -2.
+      units: a `float32` array of shape `self.shape` as the covalent radii of
+        the pairs. The radii of the masked entries are 1.
+
+    """
+    pairs = self._get_indexing_matrix().copy()
+    natoms = len(self._species)
+    valid = pairs[:, :, 0] >= 0
+    ghost = np.logical_and(
+      valid, pairs.max(axis=2) >= natoms - self._num_ghosts)
+    real = np.logical_and(valid, np.logical_not(ghost))
+    units = np.ones(self.shape, dtype=np.float32)
+    units[real] = self._cmatrix[
+      pairs[real][:, 0] * natoms + pairs[real][:, 1]]
+    pairs[ghost] = -2
+    return pairs.astype(np.int32), units
+
   def compress(self, features):
     """
     Apply the soft compressing algorithm. The compression is implemented by
@@ -1094,7 +1162,7 @@ class Transformer:
     Transform the given `ase.Atoms` object to an input feature matrix.
 
     Args:
-      atoms: an `ase.Atoms` object.
+      atoms: an `ase.Atoms` object or a `database.StructureRecord`.
       features: a 2D `float32` array or None as the location into which the
         result is stored. If not provided, a new array will be allocated.
 
@@ -1152,7 +1220,7 @@ class MultiTransformer:
 
   def __init__(self, atom_types, k_max=3, max_occurs=None, norm='exp',
                norm_order=1, include_all_k=True, periodic=False, lj=False,
-               atomic_forces=False, cutoff=None):
+               atomic_forces=False, cutoff=None, native=False):
     """
     Initialization method.
 
@@ -1174,10 +1242,22 @@ class MultiTransformer:
         enabled or not.
       lj: a `bool` indicating that this transformer targets on LJ systems.
       cutoff: a `float` as the cutoff.
+      native: a `bool`. If True and `include_all_k` is True with `k_max == 3`,
+        the 2-body terms will be native 2-body terms instead of 3-body terms
+        padded with a ghost atom. The features of each k-body term can then be
+        saved with its own width C(k, 2) to reduce the size of the datasets.
+        The transformed features are still dense. See `pack_native`.
 
     """
+    native = bool(native and include_all_k and k_max == 3)
+
     # Make sure the ghost atom is always the last one!
-    if include_all_k and k_max == 3:
+    if native:
+      num_ghosts = 0
+      if GHOST in atom_types:
+        raise ValueError("GHOST is not allowed in the native layout!")
+      atom_types = sorted(atom_types)
+    elif include_all_k and k_max == 3:
       num_ghosts = 1
       atom_types = list(atom_types)
       if GHOST in atom_types:
@@ -1210,7 +1290,13 @@ class MultiTransformer:
     self._species = species
     self._num_atom_types = len(atom_types)
     self._num_ghosts = num_ghosts
-    self._kbody_terms = get_kbody_terms_from_species(species, k_max)
+    self._native = native
+    if native:
+      # The rows of all 2-body terms are placed before the 3-body terms.
+      self._kbody_terms = get_kbody_terms_from_species(species, 2) + \
+                          get_kbody_terms_from_species(species, k_max)
+    else:
+      self._kbody_terms = get_kbody_terms_from_species(species, k_max)
     self._transformers = {}
     self._max_occurs = max_occurs
     self._norm_order = norm_order
@@ -1283,6 +1369,13 @@ class MultiTransformer:
     """
     return self._include_all_k
 
+  @property
+  def native(self):
+    """
+    Return True if the 2-body terms are not padded with ghost atoms.
+    """
+    return self._native
+
   @property
   def is_periodic(self):
     """
@@ -1345,19 +1438,20 @@ class MultiTransformer:
     """
     species = list(species) + [GHOST] * self._num_ghosts
     formula = get_formula(species)
-    clf = self._transformers.get(
-      formula, Transformer(species=species,
-                           k_max=self._k_max,
-                           kbody_terms=self._kbody_terms,
-                           split_dims=self._split_dims,
-                           norm=self._norm,
-                           norm_order=self._norm_order,
-                           periodic=self._periodic,
-                           atomic_forces=self._atomic_forces,
-                           lj=self._lj,
-                           cutoff=self._cutoff)
-    )
-    self._transformers[formula] = clf
+    clf = self._transformers.get(formula)
+    if clf is None:
+      # The transformer is only built on a cache miss.
+      clf = Transformer(species=species,
+                        k_max=self._k_max,
+                        kbody_terms=self._kbody_terms,
+                        split_dims=self._split_dims,
+                        norm=self._norm,
+                        norm_order=self._norm_order,
+                        periodic=self._periodic,
+                        atomic_forces=self._atomic_forces,
+                        lj=self._lj,
+                        cutoff=self._cutoff)
+      self._transformers[formula] = clf
     return clf
 
   def transform_trajectory(self, trajectory):
@@ -1366,8 +1460,9 @@ class MultiTransformer:
     symbols or an `ase.io.TrajectoryReader`) to input features.
 
     Args:
-      trajectory: a `list` of `ase.Atoms` or a `ase.io.TrajectoryReader`. All
-        objects should have the same chemical symbols.
+      trajectory: a `list` of `ase.Atoms` or `database.StructureRecord` or a
+        `ase.io.TrajectoryReader`. All objects should have the same chemical
+        symbols.
 
     Returns:
       sample: a `KcnnSample` object.
@@ -1432,7 +1527,8 @@ class MultiTransformer:
     Transform a single `ase.Atoms` object to input features.
 
     Args:
-      atoms: an `ase.Atoms` object as the target to transform.
+      atoms: an `ase.Atoms` object or a `database.StructureRecord` as the target
+        to transform.
 
     Returns:
       sample: a `KcnnSample` object.
@@ -1604,6 +1700,35 @@ class OneBodyCalculator:
     x[self.num_real_atom_types:] = 0.0
     return x
 
+  @classmethod
+  def from_counts(cls, atom_types, counts, energies, **kwargs):
+    """
+    Create a calculator from the cached stoichiometry counts.
+
+    Args:
+      atom_types: a list of `str` as the types of atoms.
+      counts: a `float64` array of shape `[num_examples, -1]` as the cached rows
+        of `coef`. The rows should be computed with `include_perturbations`
+        enabled if the new calculator includes the perturbations.
+      energies: a `float64` array of shape `[num_examples, ]` as the total
+        energies.
+      kwargs: additional key-value args of `OneBodyCalculator`.
+
+    Returns:
+      calculator: a `OneBodyCalculator`.
+
+    """
+    calculator = cls(atom_types, len(energies), **kwargs)
+    calculator.coef[:] = counts[:, :calculator.coef.shape[1]]
+    calculator.b[:] = energies
+    n = calculator.num_real_atom_types
+    for index in range(len(energies)):
+      sch = calculator.get_stoichiometry(calculator.coef[index, :n])
+      if sch not in calculator.minima or \
+              energies[index] < energies[calculator.minima[sch]]:
+        calculator.minima[sch] = index
+    return calculator
+
   def get_stoichiometry(self, atoms_counts):
     """
     A helper function to get the stoichiometry of a structure.
@@ -1621,7 +1746,7 @@ class FixedLenMultiTransformer(MultiTransformer):
 
   def __init__(self, max_occurs, periodic=False, k_max=3, norm='exp',
                norm_order=1, include_all_k=True, atomic_forces=False, lj=False,
-               cutoff=None):
+               cutoff=None, native=False):
     """
     Initialization method. 
     
@@ -1642,6 +1767,8 @@ class FixedLenMultiTransformer(MultiTransformer):
         enabled or not.
       lj: a `bool` indicating that this transformer targets on LJ systems.
       cutoff: a `float` as the cutoff.
+      native: a `bool` indicating whether the native mixed-k layout without
+        ghost atoms should be used or not.
     
     """
     super(FixedLenMultiTransformer, self).__init__(
@@ -1654,7 +1781,8 @@ class FixedLenMultiTransformer(MultiTransformer):
       periodic=periodic,
       atomic_forces=atomic_forces,
       lj=lj,
-      cutoff=cutoff
+      cutoff=cutoff,
+      native=native
     )
     self._split_dims = self._get_fixed_split_dims()
     self._total_dim = sum(self._split_dims)
@@ -1705,14 +1833,18 @@ class FixedLenMultiTransformer(MultiTransformer):
       num_loss_total, num_total, num_loss_total / num_total * 100))
 
   def _transform_and_save(self, filename, examples, num_examples, max_size,
-                          loss_fn=None, verbose=True, one_body_kwargs=None):
+                          loss_fn=None, verbose=True, one_body_kwargs=None,
+                          shards=None, output_format='tfrecords',
+                          split_forces=False, columnar=False,
+                          save_counts=False, positions=False):
     """
     Transform the given atomic coordinates to input features and save them to
-    tfrecord files using `tf.TFRecordWriter`.
+    tfrecords files or a NumPy feature store.
 
     Args:
       filename: a `str` as the file to save examples.
-      examples: a iterator which iterates through all examples.
+      examples: a iterator which iterates through all examples. Each example
+        should be an `ase.Atoms` or a `database.StructureRecord`.
       num_examples: an `int` as the number of examples.
       max_size: an `int` as the maximum size of all structures. This determines
         the dimension of the forces.
@@ -1720,6 +1852,22 @@ class FixedLenMultiTransformer(MultiTransformer):
       loss_fn: a `Callable` for transforming the calculated raw loss.
       one_body_kwargs: a `dict` as the key-value args for computing initial
         one-body weights.
+      shards: a `List[str]` as the shard files. The examples will be evenly
+        written to these files in order. Defaults to `[filename]`.
+      output_format: a `str` as the output format, 'tfrecords' or 'npy'. If
+        'npy', the examples will be saved as contiguous `.npy` arrays in the
+        dir `store.get_store_dir(filename)` and `shards` will be ignored.
+      split_forces: a `bool`. If True, the force-path fields will be written to
+        a separate tfrecords stream. See `store.get_forces_filename`.
+      columnar: a `bool`. If True, the features of each k-body term will be
+        saved as a separate field. See `store.get_term_field`.
+      save_counts: a `bool`. If True, the stoichiometry counts of the one-body
+        fit will be saved as the field 'counts' so that the one-body weights of
+        any subset can be computed later. See `OneBodyCalculator.from_counts`.
+      positions: a `bool`. If True, the padded atomic positions and the index
+        of the stoichiometry will be saved instead of the features and the
+        force-path auxiliary fields. The pair tables of all stoichiometries
+        will be saved to `store.get_pairs_filename(filename)`.
 
     Returns:
       weights: a `float32` array as the weights for linear fit of the energies.
@@ -1742,11 +1890,34 @@ class FixedLenMultiTransformer(MultiTransformer):
     # Start the timer
     tic = time.time()
 
-    with tf.python_io.TFRecordWriter(filename) as writer:
+    # Setup the writer.
+    if output_format == 'npy':
+      writer = NpyStoreWriter(get_store_dir(filename), num_examples)
+    else:
+      shards = shards or [filename]
+      # The forces are the only force-path field of the positions layout so
+      # they are always saved with the other fields.
+      if self._atomic_forces and split_forces and not positions:
+        forces_shards = [get_forces_filename(shard) for shard in shards]
+      else:
+        forces_shards = None
+      writer = TFRecordsWriter(shards, num_examples, forces_shards,
+                               num_terms=len(self._split_dims) if columnar
+                               else None)
+
+    try:
       if verbose:
         print("Start transforming {} ... ".format(filename))
 
       compress_stats = {}
+      formulas = []
+      tables = []
+
+      # In the native layout each k-body term is saved with its own width.
+      if self._native:
+        widths = get_kbody_widths(self._kbody_terms)
+      else:
+        widths = None
 
       for i, atoms in enumerate(examples):
 
@@ -1754,35 +1925,68 @@ class FixedLenMultiTransformer(MultiTransformer):
         y_true = atoms.get_total_energy()
         sample = self.transform(atoms)
 
-        x = _bytes_feature(sample.features.tostring())
-        y = _bytes_feature(np.atleast_2d(-y_true).tostring())
-        z = _bytes_feature(sample.occurs.tostring())
-        w = _bytes_feature(sample.binary_weights.tostring())
-        y_weight = _float_feature(loss_fn(y_true))
+        # The real rows of each k-body term are always placed at the beginning
+        # of its block, so the input pipeline can trim the zero paddings of a
+        # batch with these row counts.
+        kbody_sizes = self._get_transformer(species).kbody_sizes
 
-        if not self._atomic_forces:
-          example = Example(
-            features=Features(feature={'energy': y, 'features': x, 'occurs': z,
-                                       'weights': w, 'loss_weight': y_weight}))
+        if widths is not None:
+          features = pack_native(sample.features, sample.split_dims, widths)
         else:
+          features = sample.features
+
+        example = {'features': features,
+                   'energy': np.atleast_2d(-y_true),
+                   'occurs': sample.occurs,
+                   'weights': sample.binary_weights,
+                   'loss_weight': loss_fn(y_true),
+                   'sizes': kbody_sizes}
+
+        if columnar:
+          blocks = np.split(sample.features,
+                            np.cumsum(sample.split_dims)[:-1], axis=0)
+          del example['features']
+          for j, block in enumerate(blocks):
+            if widths is not None:
+              block = block[:, :widths[j]]
+            example[get_term_field(j)] = block
+
+        if self._atomic_forces:
           # Pad zeros to the forces so that all forces of this dataset have the
           # same dimension.
           forces = atoms.get_forces()
           pad = max_size - len(forces)
           if pad > 0:
             forces = np.pad(forces, ((0, pad), (0, 0)), mode='constant')
-          forces = _bytes_feature(forces.flatten().tostring())
-          coef = _bytes_feature(sample.coefficients.tostring())
-          indexing = _bytes_feature(sample.indexing.tostring())
-          example = Example(
-            features=Features(feature={'energy': y, 'features': x, 'occurs': z,
-                                       'weights': w, 'loss_weight': y_weight,
-                                       'indexing': indexing, 'coef': coef,
-                                       'forces': forces}))
-        writer.write(example.SerializeToString())
+          example['forces'] = forces.flatten()
+          if not positions:
+            if widths is not None:
+              example['coef'] = pack_native(
+                sample.coefficients, sample.split_dims, widths, num_groups=6)
+            else:
+              example['coef'] = sample.coefficients
+            example['indexing'] = sample.indexing
+
+        if positions:
+          formula = get_formula(species)
+          if formula not in formulas:
+            formulas.append(formula)
+            tables.append(
+              self._get_transformer(species).get_position_indices())
+          coords = atoms.get_positions()
+          pad = max_size - len(coords)
+          if pad > 0:
+            coords = np.pad(coords, ((0, pad), (0, 0)), mode='constant')
+          del example['features']
+          example['positions'] = coords.flatten()
+          example['stoichiometry'] = [formulas.index(formula)]
 
         # Add this example to the one-body database
         one_body.add(i, species, y_true)
+        if save_counts:
+          example['counts'] = one_body.coef[i]
+
+        writer.write(example)
 
         # Save the compress stats for this example
         for k, v in sample.compress_stats.items():
@@ -1799,10 +2003,22 @@ class FixedLenMultiTransformer(MultiTransformer):
         if self._cutoff is not None:
           self._log_compression_results(compress_stats)
 
+      if positions:
+        np.savez(get_pairs_filename(filename),
+                 formulas=np.asarray(formulas),
+                 pairs=np.stack([pairs for pairs, _ in tables]),
+                 units=np.stack([units for _, units in tables]))
+
       return one_body.compute()
 
+    finally:
+      writer.close()
+
   def _save_auxiliary_for_file(self, filename, max_size, lookup_indices=None,
-                               initial_1body_weights=None):
+                               initial_1body_weights=None, shards=None,
+                               output_format='tfrecords', split_forces=False,
+                               columnar=False, one_body_kwargs=None,
+                               positions=False):
     """
     Save auxiliary data for the given dataset.
 
@@ -1813,6 +2029,17 @@ class FixedLenMultiTransformer(MultiTransformer):
       initial_1body_weights: a `float32` array of shape `[num_atom_types, ]` as
         the initial weights for the one-body convolution kernels.
       lookup_indices: a `List[int]` as the indices of each given example.
+      shards: a `List[str]` as the shard files of this dataset.
+      output_format: a `str` as the output format, 'tfrecords' or 'npy'.
+      split_forces: a `bool` indicating whether the force-path fields are saved
+        in a separate tfrecords stream or not.
+      columnar: a `bool` indicating whether the features are saved by k-body
+        terms or not.
+      one_body_kwargs: a `dict` as the key-value args of the one-body fit. If
+        given, this file is an indexed store whose one-body weights are computed
+        per view by the input pipeline from the cached 'counts'.
+      positions: a `bool` indicating whether the examples are saved in the
+        positions layout or not.
 
     """
     if lookup_indices is not None:
@@ -1847,8 +2074,21 @@ class FixedLenMultiTransformer(MultiTransformer):
       "atomic_forces_enabled": self._atomic_forces,
       "indexing_shape": [max_size * 3, num_entries],
       "lj": self._lj,
-      "cutoff": self._cutoff
+      "cutoff": self._cutoff,
+      "shards": [basename(shard) for shard in (shards or [filename])
+                 if output_format == 'tfrecords'],
+      "format": output_format,
+      "columnar": columnar,
+      "positions": positions,
+      "native": self._native,
     }
+    if one_body_kwargs is not None:
+      auxiliary_properties["indexed"] = True
+      auxiliary_properties["one_body_kwargs"] = one_body_kwargs
+    if output_format == 'tfrecords' and self._atomic_forces and split_forces \
+        and not positions:
+      auxiliary_properties["forces_shards"] = [
+        get_forces_filename(name) for name in auxiliary_properties["shards"]]
 
     with open(join(dirname(filename),
                    "{}.json".format(splitext(basename(filename))[0])),
@@ -1856,10 +2096,13 @@ class FixedLenMultiTransformer(MultiTransformer):
       json.dump(auxiliary_properties, fp=fp, indent=2)
 
   def transform_and_save(self, database, train_file=None, test_file=None,
-                         loss_fn=None, verbose=True, one_body_kwargs=None):
+                         loss_fn=None, verbose=True, one_body_kwargs=None,
+                         examples_per_shard=None, output_format='tfrecords',
+                         split_forces=True, columnar=False, indexed=False,
+                         positions=False):
     """
-    Transform coordinates to input features and save them to tfrecord files
-    using `tf.TFRecordWriter`.
+    Transform coordinates to input features and save them to tfrecords files
+    or NumPy feature stores.
 
     Args:
       database: a `Database` as the parsed results from a xyz file.
@@ -1869,35 +2112,87 @@ class FixedLenMultiTransformer(MultiTransformer):
       loss_fn: a `Callable` for computing the exponential scaled RMSE loss.
       one_body_kwargs: a `dict` as the configs for the initial one-body weigts
         calculator.
+      examples_per_shard: an `int` as the maximum number of examples per
+        tfrecords file. If set, each dataset will be split into shards so that
+        the input pipeline can shuffle the shard order.
+      output_format: a `str` as the output format. 'tfrecords' (default) or
+        'npy'. The json configs are the same for both formats.
+      split_forces: a `bool`. If True, the force-path fields (coef, indexing
+        and forces) will be saved in separate tfrecords files so that
+        energy-only runs only read the energy-path fields.
+      columnar: a `bool`. If True, the features of each k-body term will be
+        saved as a separate `.npy` array or tfrecords stream so that the input
+        pipeline only reads the terms evaluated by the model.
+      indexed: a `bool`. If True, all examples of the database will be saved to
+        `train_file` as a single indexed NumPy feature store and `test_file`
+        will be ignored. The train, test and fold views are selected by the
+        input pipeline.
+      positions: a `bool`. If True, only the padded atomic positions and the
+        index of the stoichiometry of each example will be saved. The features
+        and the forces are computed in the graph from the positions with the
+        static pair tables of the stoichiometries. Only force datasets are
+        supported.
 
     """
     #fix a bug by Jinzhe Zeng
     max_size = len(self._species) - self._num_ghosts
 
+    if output_format == 'npy':
+      examples_per_shard = None
+
+    # An indexed store keeps all examples in a single NumPy feature store.
+    if indexed:
+      if output_format != 'npy':
+        raise ValueError("An indexed store must be saved in the npy format.")
+      test_file = None
+
+    if positions:
+      if not self._atomic_forces:
+        raise ValueError("The positions layout requires atomic forces.")
+      if columnar:
+        raise ValueError("The positions layout can not be columnar.")
+
     if test_file:
-      examples = database.examples(mode=tf.estimator.ModeKeys.EVAL)
+      examples = database.records(mode=tf.estimator.ModeKeys.EVAL)
       id_list = database.ids_of_testing_examples
       num_examples = len(id_list)
       if num_examples > 0:
+        shards = get_shard_filenames(
+          test_file, num_examples, examples_per_shard)
         self._transform_and_save(
           test_file,
           examples,
           num_examples,
           max_size,
           loss_fn=loss_fn,
-          verbose=verbose
+          verbose=verbose,
+          shards=shards,
+          output_format=output_format,
+          split_forces=split_forces,
+          columnar=columnar,
+          positions=positions
         )
         self._save_auxiliary_for_file(
           test_file,
           max_size=max_size,
-          lookup_indices=id_list
+          lookup_indices=id_list,
+          shards=shards,
+          output_format=output_format,
+          split_forces=split_forces,
+          columnar=columnar,
+          positions=positions
         )
 
     if train_file:
-      examples = database.examples(mode=tf.estimator.ModeKeys.TRAIN)
+      examples = database.records(mode=tf.estimator.ModeKeys.TRAIN)
       id_list = database.ids_of_training_examples
+      if id_list is None:
+        # The database is not splitted. All examples will be transformed.
+        id_list = list(range(1, len(database) + 1))
       num_examples = len(id_list)
       if num_examples > 0:
+        shards = get_shard_filenames(
+          train_file, num_examples, examples_per_shard)
         weights = self._transform_and_save(
           train_file,
           examples,
@@ -1905,11 +2200,23 @@ class FixedLenMultiTransformer(MultiTransformer):
           max_size,
           loss_fn=loss_fn,
           verbose=verbose,
-          one_body_kwargs=one_body_kwargs or {}
+          one_body_kwargs=one_body_kwargs or {},
+          shards=shards,
+          output_format=output_format,
+          split_forces=split_forces,
+          columnar=columnar,
+          save_counts=indexed,
+          positions=positions
         )
         self._save_auxiliary_for_file(
           train_file,
           max_size=max_size,
           initial_1body_weights=weights,
-          lookup_indices=id_list
+          lookup_indices=id_list,
+          shards=shards,
+          output_format=output_format,
+          split_forces=split_forces,
+          columnar=columnar,
+          one_body_kwargs=(one_body_kwargs or {}) if indexed else None,
+          positions=positions
         )
@@ -112,6 +112,22 @@ def get_atoms_from_kbody_term(kbody_term):
   return atoms
 
 
+def get_kbody_widths(kbody_terms):
+  """
+  Return the native widths, C(k, 2), of the given k-body terms. The widths of
+  the terms padded with ghost atoms are C(k_max, 2).
+
+  Args:
+    kbody_terms: a `List[str]` as the k-body terms.
+
+  Returns:
+    widths: a `List[int]` as the number of columns of each k-body term.
+
+  """
+  return [int(comb(len(get_atoms_from_kbody_term(x.replace(",", ""))), 2,
+                   exact=True)) for x in kbody_terms]
+
+
 def get_k_from_var(var):
   """
   Get the associated `k` for the given variable.
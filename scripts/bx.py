@@ -4,7 +4,10 @@ import numpy as np
 import re
 import time
 import sys
-from os.path import join
+from os.path import join, dirname, abspath
+
+sys.path.append(join(dirname(abspath(__file__)), "..", "kcnn"))
+from compression import open_text, resolve_compressed
 
 
 clusters = {"B28-": 28, "B35-": 35, "B37-": 37, "B38-": 38, "B39-": 39}
@@ -24,9 +27,10 @@ def get_regex_patterns(opted):
 
 def get_xyzfile(cluster, opted=False):
   if opted:
-    return "{}_opted.xyz".format(cluster)
+    xyzfile = "{}_opted.xyz".format(cluster)
   else:
-    return "{}.xyz".format(cluster)
+    xyzfile = "{}.xyz".format(cluster)
+  return resolve_compressed(xyzfile) or xyzfile
 
 
 def extract_xyz(filename, num_atoms, opted=False, verbose=False):
@@ -45,7 +49,7 @@ def extract_xyz(filename, num_atoms, opted=False, verbose=False):
   if verbose:
     sys.stdout.write("Extract cartesian coordinates ...\n")
 
-  with open(filename) as f:
+  with open_text(filename) as f:
     for line in f:
       if i == num_examples:
         num_examples *= 2
@@ -8,9 +8,12 @@ import numpy as np
 import re
 import sys
 from scipy.misc import comb
-from os.path import join
+from os.path import join, dirname, abspath
 from os import listdir
 
+sys.path.append(join(dirname(abspath(__file__)), "..", "kcnn"))
+from compression import open_text, resolve_compressed
+
 
 def get_regex_pattern():
   """
@@ -24,7 +27,8 @@ def extract_xyz(filename, verbose=False):
   Extract a raw xyz file of the GDB-9 dataset.
 
   Args:
-    filename: a `str` as the file to parse.
+    filename: a `str` as the file to parse. The file may be compressed with
+      gzip, bz2 or xz.
     verbose: a `bool`.
 
   Returns:
@@ -40,7 +44,9 @@ def extract_xyz(filename, verbose=False):
   num_atoms = None
   xyz_patt = get_regex_pattern()
   j = 0
-  with open(filename) as f:
+  # Each raw file only has a few lines, so a background decompression thread
+  # will not pay off here.
+  with open_text(filename, threaded=False) as f:
     for line in f:
       l = line.strip()
       if l == "":
@@ -97,10 +103,10 @@ def build_gdb9(raw_dir):
     ordered = ["C", "H", "N", "O", "F"]
 
     for i in range(ntotal):
-      xyzfile = "dsgdb9nsd_{:06d}.xyz".format(i + 1)
-      species, energy, coords = extract_xyz(
-        join(raw_dir, xyzfile), verbose=False
-      )
+      # Fall back to the plain name so that a missing file is reported by name.
+      xyzfile = join(raw_dir, "dsgdb9nsd_{:06d}.xyz".format(i + 1))
+      xyzfile = resolve_compressed(xyzfile) or xyzfile
+      species, energy, coords = extract_xyz(xyzfile, verbose=False)
       array_of_species.append(species)
       energies.append(energy)
       coordinates.append(coords)
@@ -6,8 +6,12 @@ http://quantum-machine.org/datasets/#md-datasets
 from __future__ import print_function
 
 import numpy as np
+import sys
 from os import listdir
-from os.path import isdir, isfile, join, basename
+from os.path import isdir, isfile, join, basename, dirname, abspath
+
+sys.path.append(join(dirname(abspath(__file__)), "..", "kcnn"))
+from compression import open_text
 
 
 lattcie = "\"20.0 0.0 0.0 0.0 20.0 0.0 0.0 0.0 20.0\""
@@ -27,7 +31,8 @@ def parse_and_convert_file(filename):
   Parse the given xyz file.
 
   Args:
-    filename: a `str` as the file to parse.
+    filename: a `str` as the file to parse. The file may be compressed with
+      gzip, bz2 or xz.
 
   Returns:
     xyz: an `ase` type xyz string for the input structure.
@@ -41,7 +46,7 @@ def parse_and_convert_file(filename):
   coords = []
   counter = 0
   
-  with open(filename) as f:
+  with open_text(filename, threaded=False) as f:
     for line in f:
       l = line.strip()
       if stage == 0: